@@ -134,7 +134,8 @@ case $1 in
         exec flask swpt_accounts "$@"
         ;;
     process_balance_changes | process_transfer_requests | process_finalization_requests \
-        | scan_accounts | scan_prepared_transfers | scan_registered_balance_changes)
+        | scan_accounts | scan_due_accounts | scan_prepared_transfers \
+        | scan_registered_balance_changes)
         exec flask swpt_accounts "$@"
         ;;
     flush_rejected_transfers | flush_prepared_transfers | flush_finalized_transfers \
@@ -0,0 +1,48 @@
+"""batch pending balance changes
+
+Revision ID: 3b8e41c0d2f7
+Revises: a5202da9c3ad
+Create Date: 2026-10-18 10:12:41.508214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from swpt_accounts.migration_helpers import ReplaceableObject
+
+# revision identifiers, used by Alembic.
+revision = '3b8e41c0d2f7'
+down_revision = 'a5202da9c3ad'
+branch_labels = None
+depends_on = None
+
+
+process_pending_balance_changes_batch_sp = ReplaceableObject(
+    "process_pending_balance_changes_batch(accounts account_pktype[])",
+    """
+    RETURNS void AS $$
+    DECLARE
+      a account_pktype%ROWTYPE;
+    BEGIN
+      -- The accounts are processed in a deterministic order, to
+      -- avoid deadlocks between concurrent transactions.
+      FOR a IN
+        SELECT DISTINCT debtor_id, creditor_id
+        FROM unnest(accounts)
+        ORDER BY debtor_id, creditor_id
+
+      LOOP
+        PERFORM process_pending_balance_changes(a.debtor_id, a.creditor_id);
+      END LOOP;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+
+def upgrade():
+    op.create_sp(process_pending_balance_changes_batch_sp)
+
+
+def downgrade():
+    op.drop_sp(process_pending_balance_changes_batch_sp)
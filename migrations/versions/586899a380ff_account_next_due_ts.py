@@ -0,0 +1,151 @@
+"""account next due ts
+
+Revision ID: 586899a380ff
+Revises: 3b8e41c0d2f7
+Create Date: 2026-10-18 14:36:07.204512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from swpt_accounts.migration_helpers import ReplaceableObject
+
+# revision identifiers, used by Alembic.
+revision = '586899a380ff'
+down_revision = '3b8e41c0d2f7'
+branch_labels = None
+depends_on = None
+
+
+insert_account_update_signal_sp = ReplaceableObject(
+    "insert_account_update_signal("
+    " INOUT acc account,"
+    " current_ts TIMESTAMP WITH TIME ZONE"
+    ")",
+    """
+    AS $$
+    BEGIN
+      acc.last_heartbeat_ts := current_ts;
+      acc.pending_account_update := FALSE;
+
+      UPDATE account
+      SET
+        last_change_seqnum=acc.last_change_seqnum,
+        last_change_ts=acc.last_change_ts,
+        principal=acc.principal,
+        interest=acc.interest,
+        last_transfer_number=acc.last_transfer_number,
+        last_transfer_committed_at=acc.last_transfer_committed_at,
+        status_flags=acc.status_flags,
+        total_locked_amount=acc.total_locked_amount,
+        pending_transfers_count=acc.pending_transfers_count,
+        last_transfer_id=acc.last_transfer_id,
+        last_heartbeat_ts=acc.last_heartbeat_ts,
+        pending_account_update=acc.pending_account_update,
+        next_due_ts=LEAST(next_due_ts, current_ts)
+      WHERE debtor_id=acc.debtor_id AND creditor_id=acc.creditor_id;
+
+      INSERT INTO account_update_signal (
+         debtor_id, creditor_id, last_change_seqnum,
+         last_change_ts, principal, interest,
+         interest_rate, last_interest_rate_change_ts,
+         last_transfer_number, last_transfer_committed_at,
+         last_config_ts, last_config_seqnum, creation_date,
+         negligible_amount, config_data, config_flags,
+         debtor_info_iri, debtor_info_content_type,
+         debtor_info_sha256, inserted_at
+      )
+      VALUES (
+         acc.debtor_id, acc.creditor_id, acc.last_change_seqnum,
+         acc.last_change_ts, acc.principal, acc.interest,
+         acc.interest_rate, acc.last_interest_rate_change_ts,
+         acc.last_transfer_number, acc.last_transfer_committed_at,
+         acc.last_config_ts, acc.last_config_seqnum, acc.creation_date,
+         acc.negligible_amount, acc.config_data, acc.config_flags,
+         acc.debtor_info_iri, acc.debtor_info_content_type,
+         acc.debtor_info_sha256, acc.last_change_ts
+      );
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+apply_account_change_sp = ReplaceableObject(
+    "apply_account_change("
+    " INOUT acc account_data,"
+    " principal_delta NUMERIC(24),"
+    " interest_delta FLOAT,"
+    " current_ts TIMESTAMP WITH TIME ZONE"
+    ")",
+    """
+    AS $$
+    DECLARE
+      new_principal NUMERIC(24) = acc.principal::NUMERIC(24) + principal_delta;
+    BEGIN
+      acc.interest := (
+        calc_current_balance(
+          acc.creditor_id,
+          acc.principal,
+          acc.interest,
+          acc.interest_rate,
+          acc.last_change_ts,
+          current_ts
+        )::FLOAT
+        - acc.principal::FLOAT
+        + interest_delta
+      );
+
+      acc.principal := contain_principal_overflow(new_principal);
+      IF acc.principal != new_principal THEN
+         acc.status_flags := acc.status_flags | 2;  -- set an overflow flag
+      END IF;
+
+      acc.last_change_seqnum := CASE
+        WHEN acc.last_change_seqnum = 2147483647 THEN -2147483648
+        ELSE acc.last_change_seqnum + 1
+      END;
+      acc.last_change_ts := GREATEST(acc.last_change_ts, current_ts);
+      acc.pending_account_update := TRUE;
+
+      UPDATE account
+      SET
+        last_change_seqnum=acc.last_change_seqnum,
+        last_change_ts=acc.last_change_ts,
+        principal=acc.principal,
+        interest=acc.interest,
+        last_transfer_number=acc.last_transfer_number,
+        last_transfer_committed_at=acc.last_transfer_committed_at,
+        status_flags=acc.status_flags,
+        total_locked_amount=acc.total_locked_amount,
+        pending_transfers_count=acc.pending_transfers_count,
+        last_transfer_id=acc.last_transfer_id,
+        last_heartbeat_ts=acc.last_heartbeat_ts,
+        pending_account_update=acc.pending_account_update,
+        next_due_ts=LEAST(next_due_ts, current_ts)
+      WHERE debtor_id=acc.debtor_id AND creditor_id=acc.creditor_id;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+
+def upgrade():
+    # NOTE: `now()` is evaluated only once, so the existing rows get
+    # the same value without rewriting the table. All the existing
+    # accounts become due, and will be visited by the first pass of
+    # the due accounts scanner.
+    with op.batch_alter_table('account', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('next_due_ts', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False, comment='The moment at which the account should be visited by the due accounts scanner. Every change in the account moves it to the present, and the due accounts scanner moves it to the future.'))
+        batch_op.create_index('idx_account_next_due_ts', ['next_due_ts'], unique=False)
+
+    op.replace_sp(insert_account_update_signal_sp, replaces="7a49b06e1eb6.insert_account_update_signal_sp")
+    op.replace_sp(apply_account_change_sp, replaces="7a49b06e1eb6.apply_account_change_sp")
+
+
+def downgrade():
+    op.replace_sp(apply_account_change_sp, replace_with="7a49b06e1eb6.apply_account_change_sp")
+    op.replace_sp(insert_account_update_signal_sp, replace_with="7a49b06e1eb6.insert_account_update_signal_sp")
+
+    with op.batch_alter_table('account', schema=None) as batch_op:
+        batch_op.drop_index('idx_account_next_due_ts')
+        batch_op.drop_column('next_due_ts')
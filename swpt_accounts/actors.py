@@ -1,5 +1,6 @@
 import logging
 import json
+import threading
 from datetime import datetime
 from flask import current_app
 from marshmallow import ValidationError
@@ -16,6 +17,7 @@ from swpt_accounts.models import (
 )
 from swpt_accounts.fetch_api_client import (
     get_if_account_is_reachable,
+    get_reachable_accounts,
     get_root_config_data_dict,
 )
 from swpt_accounts import procedures
@@ -63,6 +65,102 @@ def _on_prepare_transfer_signal(
     """Try to secure some amount, to eventually transfer it to another
     account.
     """
+    procedures.prepare_transfer(
+        **_make_transfer_request(
+            coordinator_type=coordinator_type,
+            coordinator_id=coordinator_id,
+            coordinator_request_id=coordinator_request_id,
+            min_locked_amount=min_locked_amount,
+            max_locked_amount=max_locked_amount,
+            debtor_id=debtor_id,
+            creditor_id=creditor_id,
+            recipient=recipient,
+            ts=ts,
+            max_commit_delay=max_commit_delay,
+            final_interest_rate_ts=final_interest_rate_ts,
+        )
+    )
+
+
+def _on_finalize_transfer_signal(
+    debtor_id: int,
+    creditor_id: int,
+    transfer_id: int,
+    coordinator_type: str,
+    coordinator_id: int,
+    coordinator_request_id: int,
+    committed_amount: int,
+    transfer_note_format: str,
+    transfer_note: str,
+    ts: str,
+    *args,
+    **kwargs
+) -> None:
+    """Finalize a prepared transfer."""
+
+    procedures.finalize_transfer(
+        **_make_finalization_request(
+            debtor_id=debtor_id,
+            creditor_id=creditor_id,
+            transfer_id=transfer_id,
+            coordinator_type=coordinator_type,
+            coordinator_id=coordinator_id,
+            coordinator_request_id=coordinator_request_id,
+            committed_amount=committed_amount,
+            transfer_note_format=transfer_note_format,
+            transfer_note=transfer_note,
+            ts=ts,
+        )
+    )
+
+
+def _on_pending_balance_change_signal(
+    debtor_id: int,
+    creditor_id: int,
+    change_id: int,
+    coordinator_type: str,
+    transfer_note_format: str,
+    transfer_note: str,
+    committed_at: datetime,
+    principal_delta: int,
+    other_creditor_id: int,
+    *args,
+    **kwargs
+) -> None:
+    """Queue a pendding balance change."""
+
+    procedures.insert_pending_balance_change(
+        **_make_pending_balance_change(
+            debtor_id=debtor_id,
+            creditor_id=creditor_id,
+            change_id=change_id,
+            coordinator_type=coordinator_type,
+            transfer_note_format=transfer_note_format,
+            transfer_note=transfer_note,
+            committed_at=committed_at,
+            principal_delta=principal_delta,
+            other_creditor_id=other_creditor_id,
+        )
+    )
+
+
+def _make_transfer_request(
+    coordinator_type: str,
+    coordinator_id: int,
+    coordinator_request_id: int,
+    min_locked_amount: int,
+    max_locked_amount: int,
+    debtor_id: int,
+    creditor_id: int,
+    recipient: str,
+    ts: datetime,
+    max_commit_delay: int,
+    final_interest_rate_ts: datetime = T_INFINITY,
+    verify_recipient: bool = True,
+    *args,
+    **kwargs
+) -> dict:
+    is_verified = True
     try:
         recipient_creditor_id = u64_to_i64(int(recipient))
     except ValueError:
@@ -74,12 +172,17 @@ def _on_prepare_transfer_signal(
                     "Invalid coordinator ID for agent transfer."
                 )  # pragma: no cover
             is_reachable = True
-        else:
+        elif verify_recipient:
             is_reachable = get_if_account_is_reachable(
                 debtor_id, recipient_creditor_id
             )
+        else:
+            # The recipient will be verified later, together with
+            # the other recipients in the batch.
+            is_reachable = True
+            is_verified = False
 
-    procedures.prepare_transfer(
+    request = dict(
         coordinator_type=coordinator_type,
         coordinator_id=coordinator_id,
         coordinator_request_id=coordinator_request_id,
@@ -92,9 +195,13 @@ def _on_prepare_transfer_signal(
         max_commit_delay=max_commit_delay,
         final_interest_rate_ts=final_interest_rate_ts,
     )
+    if not is_verified:
+        request["is_unverified"] = True
 
+    return request
 
-def _on_finalize_transfer_signal(
+
+def _make_finalization_request(
     debtor_id: int,
     creditor_id: int,
     transfer_id: int,
@@ -104,13 +211,11 @@ def _on_finalize_transfer_signal(
     committed_amount: int,
     transfer_note_format: str,
     transfer_note: str,
-    ts: str,
+    ts: datetime,
     *args,
     **kwargs
-) -> None:
-    """Finalize a prepared transfer."""
-
-    procedures.finalize_transfer(
+) -> dict:
+    return dict(
         debtor_id=debtor_id,
         creditor_id=creditor_id,
         transfer_id=transfer_id,
@@ -124,7 +229,7 @@ def _on_finalize_transfer_signal(
     )
 
 
-def _on_pending_balance_change_signal(
+def _make_pending_balance_change(
     debtor_id: int,
     creditor_id: int,
     change_id: int,
@@ -136,10 +241,8 @@ def _on_pending_balance_change_signal(
     other_creditor_id: int,
     *args,
     **kwargs
-) -> None:
-    """Queue a pendding balance change."""
-
-    procedures.insert_pending_balance_change(
+) -> dict:
+    return dict(
         debtor_id=debtor_id,
         creditor_id=creditor_id,
         change_id=change_id,
@@ -216,14 +319,142 @@ _MESSAGE_TYPES = {
     ),
 }
 
+_BATCHED_MESSAGE_TYPES = {
+    "PrepareTransfer": ("transfer_requests", _make_transfer_request),
+    "FinalizeTransfer": ("finalization_requests", _make_finalization_request),
+    "PendingBalanceChange": (
+        "pending_balance_changes",
+        _make_pending_balance_change,
+    ),
+}
+
 _LOGGER = logging.getLogger(__name__)
 
 
+class _RequestBatch:
+    def __init__(self):
+        self.size = 0
+        self.requests = {
+            field_name: [] for field_name, _ in _BATCHED_MESSAGE_TYPES.values()
+        }
+        self.is_full = threading.Event()
+        self.is_done = threading.Event()
+        self.error = None
+
+    def add(self, field_name: str, request: dict) -> None:
+        self.requests[field_name].append(request)
+        self.size += 1
+
+
+class _RequestBatchCollector:
+    """Group requests, received by different consumer threads, into
+    batches, and persist each batch in a single transaction.
+
+    The first thread that adds a request to a new batch becomes the
+    "leader". The leader waits until the batch gets full, or until
+    `max_wait` seconds have passed, and then persists the whole
+    batch. The other threads wait for the leader to finish, so that
+    all messages in the batch get acknowledged only after the batch
+    has been committed.
+    """
+
+    def __init__(self, max_size: int, max_wait: float):
+        assert max_size > 1
+        assert max_wait >= 0.0
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def submit(self, field_name: str, request: dict) -> None:
+        with self._lock:
+            batch = self._batch
+            is_leader = batch is None
+            if is_leader:
+                batch = self._batch = _RequestBatch()
+
+            batch.add(field_name, request)
+            if batch.size >= self.max_size:
+                self._batch = None
+                batch.is_full.set()
+
+        if is_leader:
+            batch.is_full.wait(self.max_wait)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+
+            try:
+                _verify_recipients(batch.requests["transfer_requests"])
+                procedures.insert_request_batch(**batch.requests)
+            except Exception as e:
+                batch.error = e
+                raise
+            finally:
+                batch.is_done.set()
+                db.session.close()
+        else:
+            batch.is_done.wait()
+            if batch.error is not None:
+                raise RuntimeError(
+                    "Failed to persist a batch of requests."
+                ) from batch.error
+
+
 TerminatedConsumtion = rabbitmq.TerminatedConsumtion
 
 
+def _verify_recipients(transfer_requests: list) -> None:
+    unverified_requests = [
+        r for r in transfer_requests if r.pop("is_unverified", False)
+    ]
+    if unverified_requests:
+        reachable_accounts = get_reachable_accounts(
+            (r["debtor_id"], r["recipient_creditor_id"])
+            for r in unverified_requests
+        )
+        for r in unverified_requests:
+            pk = (r["debtor_id"], r["recipient_creditor_id"])
+            if pk not in reachable_accounts:
+                r["recipient_creditor_id"] = None
+
+
 class SmpConsumer(rabbitmq.Consumer):
-    """Passes messages to proper handlers (actors)."""
+    """Passes messages to proper handlers (actors).
+
+    When `batch_size` is bigger than 1, the requests received by
+    different consumer threads will be persisted in batches of up to
+    `batch_size` requests. Note that the size of the batches can not
+    exceed the number of consumer threads.
+    """
+
+    def __init__(self, *args, batch_size=None, batch_wait=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._batch_collector = None
+        self._batch_collector_lock = threading.Lock()
+        self._batch_collector_is_initialized = False
+
+    def _get_batch_collector(self):
+        with self._batch_collector_lock:
+            if not self._batch_collector_is_initialized:
+                config = current_app.config
+                batch_size = (
+                    self._batch_size or config["PROTOCOL_BROKER_BATCH_SIZE"]
+                )
+                batch_wait = (
+                    config["APP_PROTOCOL_BROKER_BATCH_WAIT_SECONDS"]
+                    if self._batch_wait is None
+                    else self._batch_wait
+                )
+                if batch_size > 1:
+                    self._batch_collector = _RequestBatchCollector(
+                        batch_size, batch_wait
+                    )
+                self._batch_collector_is_initialized = True
+
+            return self._batch_collector
 
     def process_message(self, body, properties):
         content_type = getattr(properties, "content_type", None)
@@ -259,6 +490,17 @@ class SmpConsumer(rabbitmq.Consumer):
                 "The shard is not responsible for this account."
             )  # pragma: no cover
 
+        batch_collector = self._get_batch_collector()
+        if (
+            batch_collector is not None
+            and massage_type in _BATCHED_MESSAGE_TYPES
+        ):
+            field_name, make_request = _BATCHED_MESSAGE_TYPES[massage_type]
+            request = make_request(**message_content, verify_recipient=False)
+            db.session.close()
+            batch_collector.submit(field_name, request)
+            return True
+
         actor(**message_content)
         db.session.close()
         return True
@@ -2,6 +2,7 @@ import logging
 import json
 from base64 import b16decode
 from datetime import datetime, timedelta
+from typing import List, Tuple
 from marshmallow import ValidationError
 from flask import current_app
 from swpt_pythonlib import rabbitmq
@@ -115,6 +116,36 @@ def _on_try_to_delete_account(
     procedures.try_to_delete_account(debtor_id, creditor_id)
 
 
+def _on_capitalize_interests(
+    accounts: List[Tuple[int, int]], *args, **kwargs
+) -> None:
+    """Add the interest accumulated on each one of the accounts to the
+    principal, in a single transaction.
+
+    Does the same as `_on_capitalize_interest`, for every account.
+
+    """
+
+    procedures.capitalize_interests(
+        accounts=accounts,
+        min_capitalization_interval=timedelta(
+            days=current_app.config["APP_MIN_INTEREST_CAPITALIZATION_DAYS"]
+        ),
+    )
+
+
+def _on_try_to_delete_accounts(
+    accounts: List[Tuple[int, int]], *args, **kwargs
+) -> None:
+    """Mark the accounts as deleted, if possible, in a single transaction.
+
+    Does the same as `_on_try_to_delete_account`, for every account.
+
+    """
+
+    procedures.try_to_delete_accounts(accounts)
+
+
 _LOGGER = logging.getLogger(__name__)
 
 _MESSAGE_TYPES = {
@@ -134,6 +165,14 @@ _MESSAGE_TYPES = {
         schemas.TryToDeleteAccountMessageSchema(),
         _on_try_to_delete_account,
     ),
+    "CapitalizeInterests": (
+        schemas.CapitalizeInterestsMessageSchema(),
+        _on_capitalize_interests,
+    ),
+    "TryToDeleteAccounts": (
+        schemas.TryToDeleteAccountsMessageSchema(),
+        _on_try_to_delete_accounts,
+    ),
 }
 
 
@@ -170,13 +209,24 @@ class ChoresConsumer(rabbitmq.Consumer):
             _LOGGER.error("Message validation error: %s", str(e))
             return False
 
-        if is_valid_account(
-            message_content["debtor_id"], message_content["creditor_id"]
-        ):
-            # NOTE: Simply ignore chores for accounts this shard is not
-            #       responsible for. This is important because otherwise,
-            #       for example, an interest payment could be performed
-            #       twice, on both children shards.
+        # NOTE: Simply ignore chores for accounts this shard is not
+        #       responsible for. This is important because otherwise,
+        #       for example, an interest payment could be performed
+        #       twice, on both children shards.
+        if "accounts" in message_content:
+            accounts = [
+                (debtor_id, creditor_id)
+                for debtor_id, creditor_id in message_content["accounts"]
+                if is_valid_account(debtor_id, creditor_id)
+            ]
+            message_content["accounts"] = accounts
+            should_process = bool(accounts)
+        else:
+            should_process = is_valid_account(
+                message_content["debtor_id"], message_content["creditor_id"]
+            )
+
+        if should_process:
             actor(**message_content)
             db.session.close()
 
@@ -201,3 +251,22 @@ def create_chore_message(data):
         properties=properties,
         mandatory=True,
     )
+
+
+def create_chore_batch_messages(
+    message_type: str, accounts: List[Tuple[int, int]]
+) -> List[rabbitmq.Message]:
+    """Return messages of the given multi-account type, each one
+    containing at most `APP_CHORES_MAX_ACCOUNTS_PER_MESSAGE` accounts.
+    """
+
+    accounts = sorted(accounts)
+    max_count = max(
+        current_app.config["APP_CHORES_MAX_ACCOUNTS_PER_MESSAGE"], 1
+    )
+    return [
+        create_chore_message(
+            {"type": message_type, "accounts": accounts[i:i + max_count]}
+        )
+        for i in range(0, len(accounts), max_count)
+    ]
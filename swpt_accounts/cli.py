@@ -1,20 +1,26 @@
+import json
 import logging
 import os
 import time
 import sys
 import click
+import concurrent.futures
 import signal
 import random
+import multiprocessing
+import threading
 import pika
 from typing import Optional, Any
 from datetime import timedelta
 from flask import current_app
 from flask.cli import with_appcontext
-from sqlalchemy import select
+from sqlalchemy import select, text
 from flask_sqlalchemy.model import Model
-from swpt_pythonlib.utils import ShardingRealm
+from swpt_pythonlib.utils import ShardingRealm, calc_bin_routing_key
 from swpt_accounts import procedures
 from swpt_accounts.extensions import db
+from swpt_accounts.flusher import PipelinedFlusher
+from swpt_accounts.metrics import FlushMetrics, start_metrics_server
 from swpt_accounts.models import (
     SET_SEQSCAN_ON,
     SECONDS_IN_DAY,
@@ -26,7 +32,7 @@ from swpt_pythonlib.multiproc_utils import (
     try_unblock_signals,
     HANDLED_SIGNALS,
 )
-from swpt_pythonlib.flask_signalbus import SignalBus, get_models_to_flush
+from swpt_pythonlib.flask_signalbus import get_models_to_flush
 
 
 @click.group("swpt_accounts")
@@ -313,103 +319,252 @@ def delete_queue(url, queue):  # pragma: no cover
 
 @swpt_accounts.command("verify_shard_content")
 @with_appcontext
-def verify_shard_content():
+@click.option(
+    "-t", "--threads", type=int, help="The number of worker threads."
+)
+@click.option(
+    "-c",
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    help=(
+        "A file in which to record the verified ranges. When the"
+        " verification gets interrupted, running the command again"
+        " with the same checkpoint file will skip the already"
+        " verified ranges."
+    ),
+)
+def verify_shard_content(threads, checkpoint):
     """Verify that the shard contains only records belonging to the
     shard.
 
     If the verification is successful, the exit code will be 0. If a
     record has been found that does not belong to the shard, the exit
     code will be 1.
+
+    Each table is split into ranges of physical blocks, which are
+    verified in parallel by the worker threads. The routing keys are
+    calculated by the database server, and for each range only the
+    records with the smallest and the biggest routing keys are
+    checked against the sharding realm. (Because the records that
+    belong to the shard form a contiguous interval of routing keys,
+    this is enough.)
     """
     import swpt_accounts.models as m
 
-    class InvalidRecord(Exception):
-        """The record does not belong the shard."""
-
+    logger = logging.getLogger(__name__)
     sharding_realm: ShardingRealm = current_app.config["SHARDING_REALM"]
+    threads = threads or 1
+    tables = [
+        (m.Account, "debtor_id", "creditor_id"),
+        (m.TransferRequest, "debtor_id", "sender_creditor_id"),
+        (m.FinalizationRequest, "debtor_id", "sender_creditor_id"),
+        (m.PendingBalanceChange, "debtor_id", "creditor_id"),
+        (m.RejectedTransferSignal, "debtor_id", "sender_creditor_id"),
+        (m.PreparedTransferSignal, "debtor_id", "sender_creditor_id"),
+        (m.FinalizedTransferSignal, "debtor_id", "sender_creditor_id"),
+        (m.AccountTransferSignal, "debtor_id", "creditor_id"),
+        (m.AccountUpdateSignal, "debtor_id", "creditor_id"),
+        (m.AccountPurgeSignal, "debtor_id", "creditor_id"),
+        (m.RejectedConfigSignal, "debtor_id", "creditor_id"),
+        (m.PendingBalanceChangeSignal, "debtor_id", "creditor_id"),
+    ]
+
+    try:
+        with db.engine.connect() as conn:
+            if _can_calc_routing_keys_in_sql(conn):
+                _verify_shard_ranges(
+                    tables, sharding_realm, threads, checkpoint
+                )
+            else:  # pragma: no cover
+                logger.warning(
+                    "Routing keys can not be calculated by the database"
+                    " server. Falling back to record by record"
+                    " verification."
+                )
+                conn.execute(SET_SEQSCAN_ON)
+                for model, *columns in tables:
+                    _verify_shard_table(
+                        conn,
+                        sharding_realm,
+                        *[getattr(model, c) for c in columns],
+                    )
+    except _InvalidRecord:
+        logger.error(
+            "At least one record has been found that does not belong to"
+            " the shard."
+        )
+        sys.exit(1)
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+class _InvalidRecord(Exception):
+    """The record does not belong the shard."""
+
+
+# Calculates the same bits as `calc_bin_routing_key`. The bits are
+# interpreted as an integer, so that the natural order of the
+# calculated values matches the lexicographical order of the routing
+# keys.
+_SQL_ROUTING_KEY = (
+    "('x' || substr(md5(int8send({0}) || int8send({1})), 1, 6))"
+    "::bit(24)"
+)
+
+
+# Bigger than the TID of any row in the table.
+_MAX_TID = "(4294967295,0)"
+
+
+def _can_calc_routing_keys_in_sql(conn) -> bool:
+    stmt = text(
+        "SELECT "
+        + _SQL_ROUTING_KEY.format("CAST(:d AS int8)", "CAST(:c AS int8)")
+        + "::text"
+    )
+    for debtor_id, creditor_id in [
+        (0, 0),
+        (-1, 1234),
+        (1234, -1),
+        (-(2**63), 2**63 - 1),
+    ]:
+        bits = calc_bin_routing_key(debtor_id, creditor_id).replace(".", "")
+        sql_bits = conn.execute(
+            stmt, {"d": debtor_id, "c": creditor_id}
+        ).scalar_one()
+        if not (bits and sql_bits.startswith(bits)):
+            return False  # pragma: no cover
+
+    return True
+
+
+def _verify_shard_table(conn, sharding_realm, *table_columns):
     yield_per = current_app.config["APP_VERIFY_SHARD_YIELD_PER"]
     sleep_seconds = current_app.config["APP_VERIFY_SHARD_SLEEP_SECONDS"]
 
-    def verify_table(conn, *table_columns):
-        with conn.execution_options(yield_per=yield_per).execute(
-                select(*table_columns)
-        ) as result:
-            for n, row in enumerate(result):
-                if n % yield_per == 0 and sleep_seconds > 0.0:
-                    time.sleep(sleep_seconds)
-                if not sharding_realm.match(*row):
-                    raise InvalidRecord
-
-    with db.engine.connect() as conn:
-        conn.execute(SET_SEQSCAN_ON)
-        logger = logging.getLogger(__name__)
-        try:
-            verify_table(
-                conn,
-                m.Account.debtor_id,
-                m.Account.creditor_id,
-            )
-            verify_table(
-                conn,
-                m.TransferRequest.debtor_id,
-                m.TransferRequest.sender_creditor_id,
-            )
-            verify_table(
-                conn,
-                m.FinalizationRequest.debtor_id,
-                m.FinalizationRequest.sender_creditor_id,
-            )
-            verify_table(
-                conn,
-                m.PendingBalanceChange.debtor_id,
-                m.PendingBalanceChange.creditor_id,
-            )
-            verify_table(
-                conn,
-                m.RejectedTransferSignal.debtor_id,
-                m.RejectedTransferSignal.sender_creditor_id,
-            )
-            verify_table(
-                conn,
-                m.PreparedTransferSignal.debtor_id,
-                m.PreparedTransferSignal.sender_creditor_id,
-            )
-            verify_table(
-                conn,
-                m.FinalizedTransferSignal.debtor_id,
-                m.FinalizedTransferSignal.sender_creditor_id,
-            )
-            verify_table(
-                conn,
-                m.AccountTransferSignal.debtor_id,
-                m.AccountTransferSignal.creditor_id,
-            )
-            verify_table(
-                conn,
-                m.AccountUpdateSignal.debtor_id,
-                m.AccountUpdateSignal.creditor_id,
-            )
-            verify_table(
-                conn,
-                m.AccountPurgeSignal.debtor_id,
-                m.AccountPurgeSignal.creditor_id,
+    with conn.execution_options(yield_per=yield_per).execute(
+            select(*table_columns)
+    ) as result:
+        for n, row in enumerate(result):
+            if n % yield_per == 0 and sleep_seconds > 0.0:
+                time.sleep(sleep_seconds)
+            if not sharding_realm.match(*row):
+                raise _InvalidRecord
+
+
+def _verify_shard_ranges(tables, sharding_realm, threads, checkpoint):
+    logger = logging.getLogger(__name__)
+    engine = db.engine
+    blocks_per_range = current_app.config["APP_VERIFY_SHARD_BLOCKS_PER_RANGE"]
+    sleep_seconds = current_app.config["APP_VERIFY_SHARD_SLEEP_SECONDS"]
+    verified = _load_verify_shard_checkpoint(checkpoint, blocks_per_range)
+    lock = threading.Lock()
+    ranges = []
+
+    with engine.connect() as conn:
+        for model, d_column, c_column in tables:
+            table_name = model.__table__.name
+            verified_starts = verified.setdefault(table_name, [])
+            block_count = conn.execute(
+                text(
+                    "SELECT pg_relation_size(CAST(:t AS regclass))"
+                    " / current_setting('block_size') :: int"
+                ),
+                {"t": table_name},
+            ).scalar_one()
+            stmt = text(
+                "SELECT min(ARRAY[k, d, c]), max(ARRAY[k, d, c])"
+                f" FROM (SELECT {d_column} AS d, {c_column} AS c, "
+                + _SQL_ROUTING_KEY.format(d_column, c_column)
+                + "::int8 AS k"
+                f" FROM {table_name}"
+                " WHERE ctid >= CAST(:first_tid AS tid)"
+                " AND ctid < CAST(:last_tid AS tid)) AS t"
             )
-            verify_table(
-                conn,
-                m.RejectedConfigSignal.debtor_id,
-                m.RejectedConfigSignal.creditor_id,
+            for start in range(0, max(block_count, 1), blocks_per_range):
+                if start not in verified_starts:
+                    stop = start + blocks_per_range
+                    ranges.append(
+                        (table_name, stmt, start, stop, stop >= block_count)
+                    )
+
+    total_count = len(ranges)
+    finished_count = 0
+
+    def verify_range(table_name, stmt, start, stop, is_last):
+        nonlocal finished_count
+
+        with engine.connect() as conn:
+            smallest, biggest = conn.execute(
+                stmt,
+                {
+                    "first_tid": f"({start},0)",
+                    "last_tid": _MAX_TID if is_last else f"({stop},0)",
+                },
+            ).one()
+
+        for row in [smallest, biggest]:
+            if row is not None and not sharding_realm.match(row[1], row[2]):
+                logger.error(
+                    "The record (%i, %i) in %s does not belong to the"
+                    " shard.",
+                    row[1],
+                    row[2],
+                    table_name,
+                )
+                raise _InvalidRecord
+
+        with lock:
+            verified[table_name].append(start)
+            finished_count += 1
+            _save_verify_shard_checkpoint(
+                checkpoint, blocks_per_range, verified
             )
-            verify_table(
-                conn,
-                m.PendingBalanceChangeSignal.debtor_id,
-                m.PendingBalanceChangeSignal.creditor_id,
+            logger.info(
+                "Verified %i of %i ranges (%.1f%%).",
+                finished_count,
+                total_count,
+                100.0 * finished_count / total_count,
             )
-        except InvalidRecord:
-            logger.error(
-                "At least one record has been found that does not belong to"
-                " the shard."
+
+        if sleep_seconds > 0.0:
+            time.sleep(sleep_seconds)
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        done, not_done = concurrent.futures.wait(
+            [executor.submit(verify_range, *r) for r in ranges],
+            return_when=concurrent.futures.FIRST_EXCEPTION,
+        )
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            future.result()
+
+
+def _load_verify_shard_checkpoint(checkpoint, blocks_per_range):
+    if checkpoint is not None:
+        try:
+            with open(checkpoint) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            pass
+        else:
+            if data.get("blocks_per_range") == blocks_per_range:
+                return data["verified"]
+
+    return {}
+
+
+def _save_verify_shard_checkpoint(checkpoint, blocks_per_range, verified):
+    if checkpoint is not None:
+        tmp_checkpoint = checkpoint + ".tmp"
+        with open(tmp_checkpoint, "w") as f:
+            json.dump(
+                {"blocks_per_range": blocks_per_range, "verified": verified},
+                f,
             )
-            sys.exit(1)
+        os.replace(tmp_checkpoint, checkpoint)
 
 
 @swpt_accounts.command("create_chores_queue")
@@ -432,6 +587,66 @@ def create_chores_queue():  # pragma: no cover
     logger.info('Declared "%s" queue.', queue_name)
 
 
+class _NotificationListener:
+    """Listens for notifications on a PostgreSQL channel, using a
+    dedicated database connection.
+    """
+
+    def __init__(self, channel: str):
+        self.connection = db.engine.raw_connection()
+        self.driver_connection = self.connection.driver_connection
+        self.driver_connection.autocommit = True
+        self.driver_connection.execute(f"LISTEN {channel}")
+        self.is_first_wait = True
+
+    def wait(self, timeout: float) -> None:
+        """Wait until a notification arrives, or `timeout` seconds
+        pass. All received notifications are consumed.
+        """
+        if self.is_first_wait:
+            # The first pass should be done right away.
+            self.is_first_wait = False
+            return
+
+        for _ in self.driver_connection.notifies(
+            timeout=timeout, stop_after=1
+        ):
+            for _ in self.driver_connection.notifies(timeout=0.0):
+                pass
+
+
+def _make_iter_args_collections(iter_args_collections, channel, wait):
+    """Return an `iter_args_collections` function to be passed to a
+    `ThreadPoolProcessor`, and the number of seconds that the
+    processor should wait between the passes.
+
+    When APP_NOTIFY_PROCESSORS is enabled, instead of sleeping for
+    `wait` seconds between the passes, the processor will be woken up
+    as soon as new rows are inserted. In this case, `wait` is still
+    used as the maximum time between two passes.
+
+    """
+    if not current_app.config["APP_NOTIFY_PROCESSORS"]:
+        return iter_args_collections, wait
+
+    listener = _NotificationListener(channel)
+
+    def iter_args_collections_on_notification():
+        listener.wait(wait)
+        return iter_args_collections()
+
+    return iter_args_collections_on_notification, 0.0
+
+
+def _check_bucket(bucket_count: int, bucket_index: int) -> None:
+    if not 0 <= bucket_index < bucket_count:
+        logger = logging.getLogger(__name__)
+        logger.error(
+            "The bucket index must be between 0 and bucket count - 1."
+        )
+        sys.exit(1)
+
+
 @swpt_accounts.command("process_balance_changes")
 @with_appcontext
 @click.option(
@@ -446,13 +661,27 @@ def create_chores_queue():  # pragma: no cover
         " the queries to obtain pending balance changes."
     ),
 )
+@click.option(
+    "--bucket-count",
+    type=int,
+    default=1,
+    help="The total number of workers sharing the load (default 1).",
+)
+@click.option(
+    "--bucket-index",
+    type=int,
+    default=0,
+    help="The index of this worker, from 0 to bucket-count - 1.",
+)
 @click.option(
     "--quit-early",
     is_flag=True,
     default=False,
     help="Exit after some time (mainly useful during testing).",
 )
-def process_balance_changes(threads, wait, quit_early):
+def process_balance_changes(
+    threads, wait, bucket_count, bucket_index, quit_early
+):
     """Process pending balance changes.
 
     If --threads is not specified, the value of the configuration
@@ -460,16 +689,12 @@ def process_balance_changes(threads, wait, quit_early):
     set, the default number of threads is 1.
 
     If --wait is not specified, the default is 2 seconds.
-    """
 
-    # TODO: Consider allowing load-sharing between multiple processes
-    #       or containers. This may also be true for the other
-    #       "process_*" CLI commands. A possible way to do this is to
-    #       separate the `args collection` in multiple buckets,
-    #       assigning a dedicated process/container for each bucket.
-    #       Note that this would makes sense only if the load is
-    #       CPU-bound, which is unlikely, especially if we
-    #       re-implement the logic in stored procedures.
+    When several workers share the load, each one should be started
+    with the same --bucket-count, and a different --bucket-index. Each
+    worker will process only the accounts in its own bucket.
+    """
+    _check_bucket(bucket_count, bucket_index)
 
     threads = threads or int(
         current_app.config["PROCESS_BALANCE_CHANGES_THREADS"]
@@ -480,21 +705,33 @@ def process_balance_changes(threads, wait, quit_early):
         else current_app.config["APP_PROCESS_BALANCE_CHANGES_WAIT"]
     )
     max_count = current_app.config["APP_PROCESS_BALANCE_CHANGES_MAX_COUNT"]
+    batch_size = current_app.config["APP_PROCESS_BALANCE_CHANGES_BATCH_SIZE"]
 
     def iter_args_collections():
-        return procedures.iter_accounts_with_pending_balance_changes(
-            yield_per=max_count
-        )
+        for rows in procedures.iter_accounts_with_pending_balance_changes(
+            yield_per=max_count,
+            bucket_count=bucket_count,
+            bucket_index=bucket_index,
+        ):
+            yield [
+                (rows[i:i + batch_size],)
+                for i in range(0, len(rows), batch_size)
+            ]
 
-    def process_func(*args):
+    def process_func(accounts):
         try:
-            procedures.process_pending_balance_changes(*args)
+            procedures.process_pending_balance_changes_batch(
+                [tuple(account) for account in accounts]
+            )
         finally:
             db.session.close()
 
     logger = logging.getLogger(__name__)
     logger.info("Started balance changes processor.")
 
+    iter_args_collections, wait = _make_iter_args_collections(
+        iter_args_collections, procedures.PENDING_BALANCE_CHANGES_CHANNEL, wait
+    )
     ThreadPoolProcessor(
         threads,
         iter_args_collections=iter_args_collections,
@@ -517,13 +754,27 @@ def process_balance_changes(threads, wait, quit_early):
         " the queries to obtain pending transfer requests."
     ),
 )
+@click.option(
+    "--bucket-count",
+    type=int,
+    default=1,
+    help="The total number of workers sharing the load (default 1).",
+)
+@click.option(
+    "--bucket-index",
+    type=int,
+    default=0,
+    help="The index of this worker, from 0 to bucket-count - 1.",
+)
 @click.option(
     "--quit-early",
     is_flag=True,
     default=False,
     help="Exit after some time (mainly useful during testing).",
 )
-def process_transfer_requests(threads, wait, quit_early):
+def process_transfer_requests(
+    threads, wait, bucket_count, bucket_index, quit_early
+):
     """Process pending transfer requests.
 
     If --threads is not specified, the value of the configuration
@@ -531,8 +782,13 @@ def process_transfer_requests(threads, wait, quit_early):
     set, the default number of threads is 1.
 
     If --wait is not specified, the default is 2 seconds.
+
+    When several workers share the load, each one should be started
+    with the same --bucket-count, and a different --bucket-index. Each
+    worker will process only the accounts in its own bucket.
     """
 
+    _check_bucket(bucket_count, bucket_index)
     threads = threads or int(
         current_app.config["PROCESS_TRANSFER_REQUESTS_THREADS"]
     )
@@ -552,7 +808,9 @@ def process_transfer_requests(threads, wait, quit_early):
 
     def iter_args_collections():
         for rows in procedures.iter_accounts_with_transfer_requests(
-            yield_per=max_count
+            yield_per=max_count,
+            bucket_count=bucket_count,
+            bucket_index=bucket_index,
         ):
             yield [
                 (debtor_id, creditor_id, commit_period)
@@ -565,6 +823,9 @@ def process_transfer_requests(threads, wait, quit_early):
         finally:
             db.session.close()
 
+    iter_args_collections, wait = _make_iter_args_collections(
+        iter_args_collections, procedures.TRANSFER_REQUESTS_CHANNEL, wait
+    )
     ThreadPoolProcessor(
         threads,
         iter_args_collections=iter_args_collections,
@@ -587,13 +848,27 @@ def process_transfer_requests(threads, wait, quit_early):
         " the queries to obtain pending finalization requests."
     ),
 )
+@click.option(
+    "--bucket-count",
+    type=int,
+    default=1,
+    help="The total number of workers sharing the load (default 1).",
+)
+@click.option(
+    "--bucket-index",
+    type=int,
+    default=0,
+    help="The index of this worker, from 0 to bucket-count - 1.",
+)
 @click.option(
     "--quit-early",
     is_flag=True,
     default=False,
     help="Exit after some time (mainly useful during testing).",
 )
-def process_finalization_requests(threads, wait, quit_early):
+def process_finalization_requests(
+    threads, wait, bucket_count, bucket_index, quit_early
+):
     """Process pending finalization requests.
 
     If --threads is not specified, the value of the configuration
@@ -601,8 +876,13 @@ def process_finalization_requests(threads, wait, quit_early):
     not set, the default number of threads is 1.
 
     If --wait is not specified, the default is 2 seconds.
+
+    When several workers share the load, each one should be started
+    with the same --bucket-count, and a different --bucket-index. Each
+    worker will process only the accounts in its own bucket.
     """
 
+    _check_bucket(bucket_count, bucket_index)
     threads = (
         threads
         if threads is not None
@@ -633,7 +913,9 @@ def process_finalization_requests(threads, wait, quit_early):
 
     def iter_args_collections():
         for rows in procedures.iter_accounts_with_finalization_requests(
-            yield_per=max_count
+            yield_per=max_count,
+            bucket_count=bucket_count,
+            bucket_index=bucket_index,
         ):
             yield [
                 (
@@ -653,6 +935,9 @@ def process_finalization_requests(threads, wait, quit_early):
     logger = logging.getLogger(__name__)
     logger.info("Started finalization requests processor.")
 
+    iter_args_collections, wait = _make_iter_args_collections(
+        iter_args_collections, procedures.FINALIZATION_REQUESTS_CHANNEL, wait
+    )
     ThreadPoolProcessor(
         threads,
         iter_args_collections=iter_args_collections,
@@ -664,28 +949,144 @@ def process_finalization_requests(threads, wait, quit_early):
 @swpt_accounts.command("scan_accounts")
 @with_appcontext
 @click.option("-h", "--hours", type=float, help="The number of hours.")
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=1,
+    help="The number of worker processes (default 1).",
+)
 @click.option(
     "--quit-early",
     is_flag=True,
     default=False,
     help="Exit after some time (mainly useful during testing).",
 )
-def scan_accounts(hours, quit_early):
+def scan_accounts(hours, workers, quit_early):
     """Start a process that executes accounts maintenance operations.
 
     The specified number of hours determines the intended duration of
     a single pass through the accounts table. If the number of hours
     is not specified, the default is 8 hours.
+
+    When more than one worker is specified, each worker process scans
+    a different part of the table. The combined reading speed of the
+    workers is limited by APP_ACCOUNTS_SCAN_MAX_BLOCKS_PER_SECOND.
+
+    The position reached by each worker is saved periodically, so
+    that an interrupted pass is continued when the process is
+    restarted (with the same number of workers).
     """
 
     from swpt_accounts.table_scanners import AccountScanner
 
     logger = logging.getLogger(__name__)
+    if workers < 1:
+        logger.error("The number of workers must be positive.")
+        sys.exit(1)
+
     logger.info("Started accounts scanner.")
     hours = hours or current_app.config["APP_ACCOUNTS_SCAN_HOURS"]
     assert hours > 0.0
-    scanner = AccountScanner()
-    scanner.run(db.engine, timedelta(hours=hours), quit_early=quit_early)
+
+    max_blocks_per_second = current_app.config[
+        "APP_ACCOUNTS_SCAN_MAX_BLOCKS_PER_SECOND"
+    ]
+    if workers == 1:
+        AccountScanner().run_worker(
+            db.engine,
+            timedelta(hours=hours),
+            max_blocks_per_second=max_blocks_per_second,
+            quit_early=quit_early,
+        )
+        return
+
+    worker_indexes = multiprocessing.Value("i", 0)
+
+    def _scan() -> None:  # pragma: no cover
+        from swpt_accounts import create_app
+
+        with worker_indexes.get_lock():
+            worker_index = worker_indexes.value
+            worker_indexes.value += 1
+
+        app = create_app()
+        with app.app_context():
+            AccountScanner().run_worker(
+                db.engine,
+                timedelta(hours=hours),
+                workers,
+                worker_index,
+                max_blocks_per_second=max_blocks_per_second,
+                quit_early=quit_early,
+            )
+
+    spawn_worker_processes(processes=workers, target=_scan)
+    sys.exit(1)
+
+
+@swpt_accounts.command("scan_due_accounts")
+@with_appcontext
+@click.option(
+    "-w",
+    "--wait",
+    type=float,
+    help="The number of seconds to wait when there are no due accounts.",
+)
+@click.option(
+    "--bucket-count",
+    type=int,
+    default=1,
+    help="The total number of workers sharing the load (default 1).",
+)
+@click.option(
+    "--bucket-index",
+    type=int,
+    default=0,
+    help="The index of this worker, from 0 to bucket-count - 1.",
+)
+@click.option(
+    "--quit-early",
+    is_flag=True,
+    default=False,
+    help="Exit after some time (mainly useful during testing).",
+)
+def scan_due_accounts(wait, bucket_count, bucket_index, quit_early):
+    """Start a process that executes due accounts maintenance operations.
+
+    Unlike "scan_accounts", this command does not read the whole
+    accounts table. Instead, every account is visited only when a
+    maintenance operation (sending a heartbeat or a pending account
+    update, purging, deletion, or interest capitalization) could be
+    due for it. Changes in the debtors' settings (the interest rate
+    and the debtor info), are still applied only by "scan_accounts",
+    which therefore can be run with a bigger number of --hours.
+
+    If --wait is not specified, the default is 10 seconds.
+
+    When several workers share the load, each one should be started
+    with the same --bucket-count, and a different --bucket-index.
+    """
+    from swpt_accounts.table_scanners import AccountScanner
+
+    _check_bucket(bucket_count, bucket_index)
+
+    wait = (
+        wait
+        if wait is not None
+        else current_app.config["APP_SCAN_DUE_ACCOUNTS_WAIT"]
+    )
+
+    logger = logging.getLogger(__name__)
+    logger.info("Started due accounts scanner.")
+
+    AccountScanner().run_due(
+        db.engine,
+        wait,
+        bucket_count=bucket_count,
+        bucket_index=bucket_index,
+        quit_early=quit_early,
+    )
 
 
 @swpt_accounts.command("scan_prepared_transfers")
@@ -712,7 +1113,7 @@ def scan_prepared_transfers(days, quit_early):
     days = days or current_app.config["APP_PREPARED_TRANSFERS_SCAN_DAYS"]
     assert days > 0.0
     scanner = PreparedTransferScanner()
-    scanner.run(db.engine, timedelta(days=days), quit_early=quit_early)
+    scanner.run_worker(db.engine, timedelta(days=days), quit_early=quit_early)
 
 
 @swpt_accounts.command("scan_registered_balance_changes")
@@ -741,7 +1142,7 @@ def scan_registered_balance_changes(days, quit_early):
     )
     assert days > 0.0
     scanner = RegisteredBalanceChangeScanner()
-    scanner.run(db.engine, timedelta(days=days), quit_early=quit_early)
+    scanner.run_worker(db.engine, timedelta(days=days), quit_early=quit_early)
 
 
 @swpt_accounts.command("consume_messages")
@@ -771,6 +1172,12 @@ def scan_registered_balance_changes(days, quit_early):
     type=int,
     help="The prefetch window in terms of whole messages.",
 )
+@click.option(
+    "-b",
+    "--batch-size",
+    type=int,
+    help="The maximum number of requests written in one transaction.",
+)
 @click.option(
     "--draining-mode",
     is_flag=True,
@@ -778,7 +1185,7 @@ def scan_registered_balance_changes(days, quit_early):
 )
 def consume_messages(
     url, queue, processes, threads, prefetch_size, prefetch_count,
-    draining_mode
+    batch_size, draining_mode
 ):
     """Consume and process incoming Swaptacular Messaging Protocol
     messages.
@@ -798,10 +1205,12 @@ def consume_messages(
 
     * PROTOCOL_BROKER_PREFETCH_SIZE (default 0, meaning unlimited)
 
+    * PROTOCOL_BROKER_BATCH_SIZE (default 1, meaning no batching)
+
     """
 
     def _consume_messages(
-        url, queue, threads, prefetch_size, prefetch_count
+        url, queue, threads, prefetch_size, prefetch_count, batch_size
     ):  # pragma: no cover
         """Consume messages in a subprocess."""
 
@@ -817,6 +1226,7 @@ def consume_messages(
             prefetch_size=prefetch_size,
             prefetch_count=prefetch_count,
             draining_mode=draining_mode,
+            batch_size=batch_size,
         )
         for sig in HANDLED_SIGNALS:
             signal.signal(sig, consumer.stop)
@@ -841,6 +1251,7 @@ def consume_messages(
         threads=threads,
         prefetch_size=prefetch_size,
         prefetch_count=prefetch_count,
+        batch_size=batch_size,
     )
     sys.exit(1)
 
@@ -953,9 +1364,41 @@ def consume_chore_messages(
     "--wait",
     type=float,
     help=(
-        "Flush every FLOAT seconds."
-        " If not specified, the value of the FLUSH_PERIOD environment"
-        " variable will be used, defaulting to 2 seconds if empty."
+        "When there are no messages to flush, wait up to FLOAT seconds"
+        " before checking again. If not specified, the value of the"
+        " FLUSH_PERIOD environment variable will be used, defaulting"
+        " to 2 seconds if empty."
+    ),
+)
+@click.option(
+    "--bucket-count",
+    type=int,
+    default=1,
+    help="The total number of workers sharing the load (default 1).",
+)
+@click.option(
+    "--bucket-index",
+    type=int,
+    default=0,
+    help="The index of this worker, from 0 to bucket-count - 1.",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    help=(
+        "Serve Prometheus metrics on this port (and the next ports, when"
+        " there are more than one worker processes). If not specified,"
+        " the value of the FLUSH_METRICS_PORT environment variable will"
+        " be used. If it is zero or empty, no metrics will be served."
+    ),
+)
+@click.option(
+    "--priority-lanes",
+    is_flag=True,
+    default=False,
+    help=(
+        "Flush the transfer-related messages first, and give them a"
+        " bigger share of the flushing capacity."
     ),
 )
 @click.option(
@@ -969,6 +1412,10 @@ def flush_messages(
     message_types: list[str],
     processes: int,
     wait: float,
+    bucket_count: int,
+    bucket_index: int,
+    metrics_port: Optional[int],
+    priority_lanes: bool,
     quit_early: bool,
 ) -> None:
     """Send pending messages to the message broker.
@@ -976,7 +1423,18 @@ def flush_messages(
     If a list of MESSAGE_TYPES is given, flushes only these types of
     messages. If no MESSAGE_TYPES are specified, flushes all messages.
 
+    When several workers share the load, each one should be started
+    with the same --bucket-count, and a different --bucket-index. Each
+    worker will flush only the messages about the accounts in its own
+    bucket, preserving the order of the messages about each account.
+
+    When --priority-lanes is given, the messages which are on the
+    transfer path (prepared, finalized, and rejected transfers) are
+    flushed first, and the other messages get a smaller share of the
+    flushing capacity (but are never starved).
+
     """
+    _check_bucket(bucket_count, bucket_index)
     logger = logging.getLogger(__name__)
     models_to_flush = get_models_to_flush(
         current_app.extensions["signalbus"], message_types
@@ -984,6 +1442,16 @@ def flush_messages(
     logger.info(
         "Started flushing %s.", ", ".join(m.__name__ for m in models_to_flush)
     )
+    processes = (
+        processes
+        if processes is not None
+        else current_app.config["FLUSH_PROCESSES"]
+    )
+    metrics_port = (
+        metrics_port
+        if metrics_port is not None
+        else current_app.config["FLUSH_METRICS_PORT"]
+    )
 
     def _flush(
         models_to_flush: list[type[Model]],
@@ -992,47 +1460,43 @@ def flush_messages(
         from swpt_accounts import create_app
 
         app = create_app()
-        stopped = False
+        with app.app_context():
+            metrics = None
+            if metrics_port:
+                metrics = FlushMetrics(models_to_flush)
+                start_metrics_server(
+                    metrics,
+                    db.engine,
+                    metrics_port,
+                    metrics_port + max(processes, 1) - 1,
+                )
+
+            flusher = PipelinedFlusher(
+                models_to_flush,
+                wait,
+                bucket_count=bucket_count,
+                bucket_index=bucket_index,
+                metrics=metrics,
+                priority_lanes=priority_lanes,
+            )
 
         def stop(signum: Any = None, frame: Any = None) -> None:
-            nonlocal stopped
-            stopped = True
+            flusher.stop()
 
         for sig in HANDLED_SIGNALS:
             signal.signal(sig, stop)
         try_unblock_signals()
 
         with app.app_context():
-            signalbus: SignalBus = current_app.extensions["signalbus"]
             time.sleep(wait * random.random())
-
-            while not stopped:
-                started_at = time.time()
-                try:
-                    count = signalbus.flushmany(models_to_flush)
-                except Exception:
-                    logger.exception(
-                        "Caught error while sending pending signals."
-                    )
-                    sys.exit(1)
-
-                if count > 0:
-                    logger.info(
-                        "%i signals have been successfully processed.", count
-                    )
-                else:
-                    logger.debug("0 signals have been processed.")
-
-                if quit_early:
-                    break
-                time.sleep(max(0.0, wait + started_at - time.time()))
+            try:
+                flusher.run(quit_early)
+            except Exception:
+                logger.exception("Caught error while sending pending signals.")
+                sys.exit(1)
 
     spawn_worker_processes(
-        processes=(
-            processes
-            if processes is not None
-            else current_app.config["FLUSH_PROCESSES"]
-        ),
+        processes=processes,
         target=_flush,
         models_to_flush=models_to_flush,
         wait=(
@@ -1,10 +1,11 @@
 import logging
 import time
 import asyncio
+import threading
 from collections import OrderedDict
 from functools import partial
 from urllib.parse import urljoin
-from typing import Optional, Iterable, Dict, Tuple
+from typing import Optional, Iterable, Dict, Tuple, Set
 import typing
 import requests
 from flask import current_app, url_for
@@ -13,18 +14,73 @@ from swpt_accounts.extensions import (
     aiohttp_session,
     asyncio_loop,
 )
+from swpt_pythonlib.utils import u64_to_i64, i64_to_u64
 from swpt_accounts.models import ROOT_CREDITOR_ID, RootConfigData
 from swpt_accounts.schemas import parse_root_config_data
 
+# The maximum number of accounts that a bulk "reachable" request can
+# contain.
+MAX_BULK_REACHABLE_COUNT = 1000
+
 _fetch_conifg_path = partial(
     url_for, "fetch.config", _external=False, creditorId=ROOT_CREDITOR_ID
 )
 _root_config_data_lru_cache: typing.OrderedDict[
     int, Tuple[Optional[RootConfigData], float]
 ] = OrderedDict()
+_root_config_data_requests: Dict[
+    Tuple[asyncio.AbstractEventLoop, int], asyncio.Future
+] = {}
+_root_config_data_lock = threading.Lock()
+_root_config_data_stats: Dict[str, int] = dict.fromkeys(
+    ["hits", "misses", "evictions", "coalesced"], 0
+)
+_reachable_accounts_cache: typing.OrderedDict[
+    Tuple[int, int], float
+] = OrderedDict()
+_unreachable_accounts_cache: typing.OrderedDict[
+    Tuple[int, int], float
+] = OrderedDict()
+_reachability_lock = threading.Lock()
 
 
 def get_if_account_is_reachable(debtor_id: int, creditor_id: int) -> bool:
+    """Return whether the given account is reachable.
+
+    Recently received answers are cached, so that popular accounts
+    are not queried over and over again. The caches are not notified
+    when an account gets deleted, or scheduled for deletion (the
+    account may be located on another shard). Therefore, a cached
+    answer can be stale for up to `APP_FETCH_REACHABLE_CACHE_SECONDS`
+    (or `APP_FETCH_UNREACHABLE_CACHE_SECONDS` for negative answers).
+
+    """
+    try:
+        return _lookup_reachability(debtor_id, creditor_id)
+    except KeyError:
+        pass
+
+    try:
+        is_reachable = _make_reachable_request(debtor_id, creditor_id)
+    except requests.RequestException as e:
+        _log_error(e)
+        return False
+
+    _register_reachability(debtor_id, creditor_id, is_reachable)
+    return is_reachable
+
+
+def forget_account_reachability(debtor_id: int, creditor_id: int) -> None:
+    """Remove the given account from the reachability caches of the
+    current process."""
+
+    pk = (debtor_id, creditor_id)
+    with _reachability_lock:
+        _reachable_accounts_cache.pop(pk, None)
+        _unreachable_accounts_cache.pop(pk, None)
+
+
+def _make_reachable_request(debtor_id: int, creditor_id: int) -> bool:
     with current_app.test_request_context():
         path = url_for(
             "fetch.reachable",
@@ -34,30 +90,117 @@ def get_if_account_is_reachable(debtor_id: int, creditor_id: int) -> bool:
         )
 
     url = urljoin(current_app.config["FETCH_API_URL"], path)
+    response = requests_session.get(url)
+    status_code = response.status_code
+    if status_code == 204:
+        return True
+    if status_code != 404:
+        response.raise_for_status()  # pragma: no cover
 
-    try:
-        response = requests_session.get(url)
-        status_code = response.status_code
-        if status_code == 204:
-            return True
-        if status_code != 404:
-            response.raise_for_status()  # pragma: no cover
+    return False
 
-    except requests.RequestException as e:
-        _log_error(e)
 
-    return False
+def get_reachable_accounts(
+    accounts: Iterable[Tuple[int, int]]
+) -> Set[Tuple[int, int]]:
+    """Return the reachable accounts among the given `(debtor_id,
+    creditor_id)` pairs.
+
+    Duplicated pairs are queried only once, and the queries are sent
+    in bulk. Accounts for which the bulk query gives no answer (for
+    example, because they are located on another shard) are queried
+    one by one.
+
+    """
+    reachable_accounts: Set[Tuple[int, int]] = set()
+    unknown_accounts = []
+    uncached_accounts = []
+
+    for pk in dict.fromkeys(accounts):
+        try:
+            if _lookup_reachability(*pk):
+                reachable_accounts.add(pk)
+        except KeyError:
+            uncached_accounts.append(pk)
+
+    with current_app.test_request_context():
+        path = url_for("fetch.reachable_bulk", _external=False)
+
+    url = urljoin(current_app.config["FETCH_API_URL"], path)
+
+    for i in range(0, len(uncached_accounts), MAX_BULK_REACHABLE_COUNT):
+        chunk = uncached_accounts[i:i + MAX_BULK_REACHABLE_COUNT]
+        try:
+            response = requests_session.post(
+                url,
+                json={
+                    "accounts": [
+                        [i64_to_u64(d), i64_to_u64(c)] for d, c in chunk
+                    ],
+                },
+            )
+            if response.status_code in (404, 405):  # pragma: no cover
+                # The bulk query is not supported (by the proxy).
+                unknown_accounts.extend(chunk)
+                continue
+
+            response.raise_for_status()
+            data = response.json()
+
+        except (requests.RequestException, ValueError) as e:
+            _log_error(e)
+            continue
+
+        chunk_reachable_accounts = {
+            (u64_to_i64(d), u64_to_i64(c)) for d, c in data["reachable"]
+        }
+        chunk_unknown_accounts = {
+            (u64_to_i64(d), u64_to_i64(c)) for d, c in data["unknown"]
+        }
+        for pk in chunk:
+            if pk in chunk_unknown_accounts:
+                unknown_accounts.append(pk)
+            else:
+                is_reachable = pk in chunk_reachable_accounts
+                _register_reachability(*pk, is_reachable)
+                if is_reachable:
+                    reachable_accounts.add(pk)
+
+    reachable_accounts.update(
+        pk for pk in unknown_accounts if get_if_account_is_reachable(*pk)
+    )
+    return reachable_accounts
 
 
 def get_root_config_data_dict(
-    debtor_ids: Iterable[int], cache_seconds: float = 7200.0
+    debtor_ids: Iterable[int],
+    cache_seconds: float = 7200.0,
+    negative_cache_seconds: Optional[float] = None,
 ) -> Dict[int, Optional[RootConfigData]]:
-    cutoff_ts = time.time() - cache_seconds
+    """Return a dictionary with the root config data for the given
+    debtors. The value will be `None` for debtors which do not exist.
+
+    Found config data will be cached for up to `cache_seconds`
+    seconds. Non-existing debtors will be cached for up to
+    `negative_cache_seconds` seconds (but never longer than
+    `cache_seconds`).
+
+    """
+    if negative_cache_seconds is None:
+        negative_cache_seconds = current_app.config[
+            "APP_FETCH_DATA_NEGATIVE_CACHE_SECONDS"
+        ]
+
+    current_ts = time.time()
+    cutoff_ts = current_ts - cache_seconds
+    negative_cutoff_ts = max(cutoff_ts, current_ts - negative_cache_seconds)
     result_dict: Dict[int, Optional[RootConfigData]] = {
         debtor_id: None for debtor_id in debtor_ids
     }
     results = asyncio_loop.run_until_complete(
-        _fetch_root_config_data_list(debtor_ids, cutoff_ts)
+        _fetch_root_config_data_list(
+            debtor_ids, cutoff_ts, negative_cutoff_ts
+        )
     )
 
     for debtor_id, result in zip(debtor_ids, results):
@@ -69,6 +212,16 @@ def get_root_config_data_dict(
     return result_dict
 
 
+def get_root_config_data_cache_stats() -> Dict[str, int]:
+    """Return the values of the root config data cache counters."""
+
+    with _root_config_data_lock:
+        stats = dict(_root_config_data_stats)
+        stats["size"] = len(_root_config_data_lru_cache)
+
+    return stats
+
+
 def _log_error(e):
     try:
         raise e
@@ -96,16 +249,86 @@ async def _make_root_config_data_request(
         ) from None  # pragma: no cover
 
 
+def _clear_reachability() -> None:
+    with _reachability_lock:
+        _reachable_accounts_cache.clear()
+        _unreachable_accounts_cache.clear()
+
+
+def _lookup_reachability(debtor_id: int, creditor_id: int) -> bool:
+    config = current_app.config
+    current_ts = time.time()
+    pk = (debtor_id, creditor_id)
+
+    with _reachability_lock:
+        for cache, is_reachable, cache_seconds in [
+            (
+                _reachable_accounts_cache,
+                True,
+                config["APP_FETCH_REACHABLE_CACHE_SECONDS"],
+            ),
+            (
+                _unreachable_accounts_cache,
+                False,
+                config["APP_FETCH_UNREACHABLE_CACHE_SECONDS"],
+            ),
+        ]:
+            ts = cache.get(pk)
+            if ts is not None:
+                if ts >= current_ts - cache_seconds:
+                    return is_reachable
+                del cache[pk]
+
+    raise KeyError
+
+
+def _register_reachability(
+    debtor_id: int, creditor_id: int, is_reachable: bool
+) -> None:
+    config = current_app.config
+    if is_reachable:
+        cache = _reachable_accounts_cache
+        max_size = config["APP_FETCH_REACHABLE_CACHE_SIZE"]
+    else:
+        cache = _unreachable_accounts_cache
+        max_size = config["APP_FETCH_UNREACHABLE_CACHE_SIZE"]
+
+    pk = (debtor_id, creditor_id)
+    with _reachability_lock:
+        cache.pop(pk, None)
+
+        while len(cache) >= max_size:
+            try:
+                cache.popitem(last=False)
+            except KeyError:  # pragma: nocover
+                break
+
+        cache[pk] = time.time()
+
+
 def _clear_root_config_data() -> None:
-    _root_config_data_lru_cache.clear()
+    with _root_config_data_lock:
+        _root_config_data_lru_cache.clear()
+        for key in _root_config_data_stats:
+            _root_config_data_stats[key] = 0
 
 
 def _lookup_root_config_data(
-    debtor_id: int, cutoff_ts: float
+    debtor_id: int, cutoff_ts: float, negative_cutoff_ts: float
 ) -> Optional[RootConfigData]:
-    config_data, ts = _root_config_data_lru_cache[debtor_id]
-    if ts < cutoff_ts:
-        raise KeyError
+    with _root_config_data_lock:
+        try:
+            config_data, ts = _root_config_data_lru_cache[debtor_id]
+            if ts < (
+                cutoff_ts if config_data is not None else negative_cutoff_ts
+            ):
+                raise KeyError
+        except KeyError:
+            _root_config_data_stats["misses"] += 1
+            raise
+
+        _root_config_data_lru_cache.move_to_end(debtor_id)
+        _root_config_data_stats["hits"] += 1
 
     return config_data
 
@@ -115,34 +338,69 @@ def _register_root_config_data(
 ) -> None:
     max_size = current_app.config["APP_FETCH_DATA_CACHE_SIZE"]
 
-    while len(_root_config_data_lru_cache) >= max_size:
-        try:
-            _root_config_data_lru_cache.popitem(last=False)
-        except KeyError:  # pragma: nocover
-            break
+    with _root_config_data_lock:
+        _root_config_data_lru_cache.pop(debtor_id, None)
+
+        while len(_root_config_data_lru_cache) >= max_size:
+            try:
+                _root_config_data_lru_cache.popitem(last=False)
+            except KeyError:  # pragma: nocover
+                break
+            _root_config_data_stats["evictions"] += 1
 
-    _root_config_data_lru_cache[debtor_id] = (config_data, time.time())
+        _root_config_data_lru_cache[debtor_id] = (config_data, time.time())
 
 
 async def _fetch_root_config_data(
-    debtor_id: int, cutoff_ts: float
+    debtor_id: int, cutoff_ts: float, negative_cutoff_ts: float
 ) -> Optional[RootConfigData]:
     try:
-        config_data = _lookup_root_config_data(debtor_id, cutoff_ts)
+        return _lookup_root_config_data(
+            debtor_id, cutoff_ts, negative_cutoff_ts
+        )
     except KeyError:
+        pass
+
+    # Concurrent fetches for the same debtor, running on the same
+    # event loop, share a single HTTP request.
+    key = (asyncio.get_running_loop(), debtor_id)
+    with _root_config_data_lock:
+        request = _root_config_data_requests.get(key)
+        if request is None:
+            request = asyncio.ensure_future(
+                _make_and_register_root_config_data_request(debtor_id)
+            )
+            _root_config_data_requests[key] = request
+        else:
+            _root_config_data_stats["coalesced"] += 1
+
+    return await asyncio.shield(request)
+
+
+async def _make_and_register_root_config_data_request(
+    debtor_id: int,
+) -> Optional[RootConfigData]:
+    try:
         config_data = await _make_root_config_data_request(debtor_id)
         _register_root_config_data(debtor_id, config_data)
+    finally:
+        with _root_config_data_lock:
+            del _root_config_data_requests[
+                (asyncio.get_running_loop(), debtor_id)
+            ]
 
     return config_data
 
 
 async def _fetch_root_config_data_list(
-    debtor_ids: Iterable[int], cutoff_ts: float
+    debtor_ids: Iterable[int], cutoff_ts: float, negative_cutoff_ts: float
 ) -> Iterable:
     with current_app.test_request_context():
         return await asyncio.gather(
             *(
-                _fetch_root_config_data(debtor_id, cutoff_ts)
+                _fetch_root_config_data(
+                    debtor_id, cutoff_ts, negative_cutoff_ts
+                )
                 for debtor_id in debtor_ids
             ),
             return_exceptions=True,
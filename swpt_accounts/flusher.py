@@ -0,0 +1,394 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Optional, Iterable
+from flask import current_app
+from sqlalchemy import select, delete
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import tuple_
+from swpt_accounts.extensions import db
+from swpt_accounts.models import account_bucket_clause, get_memoization_stats
+from swpt_accounts.metrics import FlushMetrics
+
+
+class BurstSizeController:
+    """Chooses the burst size for one type of signals.
+
+    The burst size starts at `initial_size`, and stays between
+    `min_size` and `max_size`. When fetching or publishing a burst
+    takes longer than `target_seconds`, or the memory used by the
+    process exceeds `max_memory_mb` (0 means no limit), the burst size
+    is halved. When a full burst is fetched and published in less than
+    half of `target_seconds`, the burst size grows by 50%.
+
+    """
+
+    GROWTH_FACTOR = 1.5
+    SHRINK_FACTOR = 0.5
+
+    def __init__(
+        self,
+        initial_size: int,
+        min_size: int,
+        max_size: int,
+        target_seconds: float,
+        max_memory_mb: float = 0,
+    ):
+        self.size = max(initial_size, 1)
+        self.min_size = max(min(min_size, self.size), 1)
+        self.max_size = max(max_size, self.size)
+        self.target_seconds = target_seconds
+        self.max_memory_mb = max_memory_mb
+        self._fetch_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def observe_fetch(self, seconds: float) -> int:
+        """Register the time it took to fetch a burst of signals, and
+        return the new burst size."""
+
+        with self._lock:
+            self._fetch_seconds = seconds
+            if seconds > self.target_seconds:
+                self._resize(self.SHRINK_FACTOR)
+            return self.size
+
+    def observe_publish(self, count: int, seconds: float) -> int:
+        """Register the time it took to publish a burst of `count`
+        signals, and return the new burst size."""
+
+        with self._lock:
+            slowest = max(seconds, self._fetch_seconds)
+            if seconds > self.target_seconds or self._is_memory_exceeded():
+                self._resize(self.SHRINK_FACTOR)
+            elif count >= self.size and slowest < self.target_seconds / 2:
+                self._resize(self.GROWTH_FACTOR)
+            return self.size
+
+    def _resize(self, factor: float) -> None:
+        size = round(self.size * factor)
+        self.size = min(max(size, self.min_size), self.max_size)
+
+    def _is_memory_exceeded(self) -> bool:
+        if self.max_memory_mb <= 0:
+            return False
+
+        memory_mb = _get_memory_mb()
+        return memory_mb is not None and memory_mb > self.max_memory_mb
+
+
+def _get_memory_mb() -> Optional[float]:
+    # Returns the resident set size of the current process, or `None`
+    # if it can not be determined.
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):  # pragma: no cover
+        return None
+
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class PipelinedFlusher:
+    """Sends pending signals to the message broker.
+
+    Fetching a burst of signals from the database, publishing the
+    burst (and waiting for the publisher confirms), and deleting the
+    published signals from the database, are done by three different
+    threads. Thus, the next burst can be fetched while the previous
+    burst is being published, and the burst before that is being
+    deleted. The number of bursts in flight is limited by
+    `APP_FLUSH_PIPELINE_DEPTH`, which limits the memory usage, and the
+    number of used database connections.
+
+    Several flushers can share the load by flushing only the signals
+    about the accounts in their own bucket (see `bucket_count` and
+    `bucket_index`). All the signals about a given account are
+    flushed by the same flusher, in the order of their primary keys.
+
+    The number of signals in each burst is chosen separately for each
+    type of signals, by a `BurstSizeController`. It starts at the
+    configured burst count for the given type of signals, and adapts
+    to the observed fetch and publish times, within the bounds given
+    by `APP_FLUSH_MIN_BURST_COUNT` and `APP_FLUSH_MAX_BURST_COUNT`.
+
+    By default, one burst is fetched from each signal table in turn.
+    When `priority_lanes` is `True`, the signal tables are visited in
+    the order of their `flush_priority` (highest first), and up to
+    `flush_weight` consecutive bursts are fetched from each table.
+    Thus, a backlog of low priority signals can not significantly
+    delay the high priority signals. Moreover, while a higher priority
+    table has more signals (its last burst was full), only one burst
+    of `APP_FLUSH_MIN_BURST_COUNT` signals is fetched from each lower
+    priority table, so that the lower priority tables still progress,
+    but do not compete with the higher priority tables for the
+    pipeline.
+
+    When all the tables have been emptied, the flusher waits before
+    querying them again. The wait begins at
+    `APP_FLUSH_MIN_WAIT_SECONDS`, and doubles on each consecutive
+    query which does not find any signals, until `max_wait` seconds
+    is reached.
+
+    """
+
+    def __init__(
+        self,
+        models: Iterable[type],
+        max_wait: float,
+        min_wait: Optional[float] = None,
+        depth: Optional[int] = None,
+        bucket_count: int = 1,
+        bucket_index: int = 0,
+        metrics: Optional[FlushMetrics] = None,
+        priority_lanes: bool = False,
+    ):
+        assert 0 <= bucket_index < bucket_count
+        config = current_app.config
+        if min_wait is None:
+            min_wait = config["APP_FLUSH_MIN_WAIT_SECONDS"]
+        if depth is None:
+            depth = config["APP_FLUSH_PIPELINE_DEPTH"]
+
+        self.app = current_app._get_current_object()
+        self.models = list(models)
+        self.max_wait = max_wait
+        self.min_wait = min(min_wait, max_wait)
+        self.depth = max(depth, 1)
+        self.bucket_count = bucket_count
+        self.bucket_index = bucket_index
+        self.metrics = metrics
+        self.burst_sizes = {
+            model: BurstSizeController(
+                initial_size=model.signalbus_burst_count,
+                min_size=config["APP_FLUSH_MIN_BURST_COUNT"],
+                max_size=config["APP_FLUSH_MAX_BURST_COUNT"],
+                target_seconds=config["APP_FLUSH_TARGET_BURST_SECONDS"],
+                max_memory_mb=config["APP_FLUSH_MAX_MEMORY_MB"],
+            )
+            for model in self.models
+        }
+        self.flushed_count = 0
+        if priority_lanes:
+            self._schedule = [
+                (model, max(model.flush_weight, 1), model.flush_priority)
+                for model in sorted(
+                    self.models, key=lambda m: -m.flush_priority
+                )
+            ]
+        else:
+            self._schedule = [(model, 1, 0) for model in self.models]
+        self._stopped = threading.Event()
+        self._error: Optional[Exception] = None
+        self._lock = threading.Lock()
+        self._bursts_in_flight = threading.BoundedSemaphore(self.depth)
+        self._publish_queue: queue.Queue = queue.Queue()
+        self._delete_queue: queue.Queue = queue.Queue()
+
+    def stop(self) -> None:
+        """Tell the flusher to stop (may be called from another thread,
+        or from a signal handler)."""
+
+        self._stopped.set()
+
+    def run(self, quit_early: bool = False) -> int:
+        """Flush signals until stopped, and return the number of
+        flushed signals.
+
+        When `quit_early` is `True`, returns as soon as all the
+        tables have been emptied. Raises the first error that occurred
+        in any of the pipeline stages.
+
+        """
+        stages = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._publish_queue, self._publish, self._delete_queue),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._delete_queue, self._delete, None),
+                daemon=True,
+            ),
+        ]
+        for thread in stages:
+            thread.start()
+
+        try:
+            self._fetch_bursts(quit_early)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._publish_queue.put(None)
+            for thread in stages:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+        return self.flushed_count
+
+    def _fetch_bursts(self, quit_early: bool) -> None:
+        wait = 0.0
+
+        while not self._stopped.is_set():
+            fetched_count = 0
+            has_more = False
+            busy_priority = None
+
+            for model, weight, priority in self._schedule:
+                shrink = busy_priority is not None and priority < busy_priority
+                for _ in range(1 if shrink else weight):
+                    burst = self._fetch_burst(model, shrink)
+                    if burst is None:
+                        return
+
+                    count, is_full = burst
+                    fetched_count += count
+                    if not is_full:
+                        break
+                else:
+                    has_more = True
+                    if busy_priority is None:
+                        busy_priority = priority
+
+            if has_more:
+                wait = 0.0
+                continue
+
+            if quit_early:
+                break
+
+            if fetched_count > 0:
+                wait = self.min_wait
+            else:
+                wait = min(max(2 * wait, self.min_wait), self.max_wait)
+
+            self._stopped.wait(wait)
+
+    def _fetch_burst(
+        self, model, shrink: bool = False
+    ) -> Optional[tuple[int, bool]]:
+        # Fetches a burst of signals, and passes it to the publishing
+        # stage. Returns the number of fetched signals, and whether
+        # the burst is full (that is, there may be more signals).
+        # Returns `None` if the flusher has been stopped. When
+        # `shrink` is `True`, the smallest allowed burst is fetched.
+        burst_sizes = self.burst_sizes[model]
+        burst_count = burst_sizes.min_size if shrink else burst_sizes.size
+        query = (
+            self._get_query(model)
+            .with_for_update(skip_locked=True)
+            .limit(burst_count)
+        )
+        self._bursts_in_flight.acquire()
+        if self._stopped.is_set():
+            self._bursts_in_flight.release()
+            return None
+
+        session = Session(db.engine, expire_on_commit=False)
+        started_at = time.monotonic()
+        try:
+            signals = session.execute(query).scalars().all()
+        except Exception:
+            self._release_burst(session)
+            raise
+
+        new_burst_count = burst_sizes.observe_fetch(
+            time.monotonic() - started_at
+        )
+        if self.metrics is not None:
+            self.metrics.observe_burst_size(model, new_burst_count)
+
+        if signals:
+            self._publish_queue.put((model, session, signals))
+        else:
+            self._release_burst(session)
+
+        return len(signals), len(signals) >= burst_count
+
+    def _get_query(self, model):
+        query = select(model).order_by(*inspect(model).primary_key)
+        if self.bucket_count > 1:
+            query = query.where(
+                account_bucket_clause(
+                    *model.get_account_columns(),
+                    self.bucket_count,
+                    self.bucket_index,
+                )
+            )
+        return query
+
+    def _run_stage(self, in_queue, process, out_queue) -> None:
+        with self.app.app_context():
+            while True:
+                burst = in_queue.get()
+                if burst is None:
+                    break
+
+                if self._error is None:
+                    try:
+                        process(*burst)
+                    except Exception as e:
+                        if self.metrics is not None:
+                            self.metrics.observe_error(burst[0])
+                        self._fail(e)
+
+                if out_queue is not None and self._error is None:
+                    out_queue.put(burst)
+                else:
+                    self._release_burst(burst[1])
+
+            if out_queue is not None:
+                out_queue.put(None)
+
+    def _publish(self, model, session, signals) -> None:
+        started_at = time.monotonic()
+        model.send_signalbus_messages(signals)
+        seconds = time.monotonic() - started_at
+        new_burst_count = self.burst_sizes[model].observe_publish(
+            len(signals), seconds
+        )
+
+        if self.metrics is not None:
+            self.metrics.observe_publish(model, seconds)
+            self.metrics.observe_burst_size(model, new_burst_count)
+
+    def _delete(self, model, session, signals) -> None:
+        chosen = model.choose_rows([inspect(s).identity for s in signals])
+        pk = tuple_(*inspect(model).primary_key)
+        session.execute(
+            delete(model)
+            .execution_options(synchronize_session=False)
+            .where(pk == tuple_(*chosen.c))
+        )
+        session.commit()
+
+        with self._lock:
+            self.flushed_count += len(signals)
+
+        if self.metrics is not None:
+            self.metrics.observe_flushed(model, len(signals))
+
+        logger = logging.getLogger(__name__)
+        logger.info(
+            "%i %s signals have been successfully processed.",
+            len(signals),
+            model.__name__,
+        )
+        logger.debug("Memoization stats: %s", get_memoization_stats())
+
+    def _release_burst(self, session) -> None:
+        try:
+            session.close()
+        finally:
+            self._bursts_in_flight.release()
+
+    def _fail(self, e: Exception) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = e
+        self._stopped.set()
@@ -0,0 +1,289 @@
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Optional
+from sqlalchemy import text, select
+from sqlalchemy.exc import DBAPIError
+
+# The upper bounds of the publish latency histogram buckets (seconds).
+PUBLISH_LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# The age of the oldest pending signal is queried at most once per
+# OLDEST_SIGNAL_REFRESH_SECONDS for each signal table, and the query
+# is cancelled after OLDEST_SIGNAL_QUERY_TIMEOUT_MILLISECS. The query
+# reads only the first entry of the `inserted_at` index.
+OLDEST_SIGNAL_REFRESH_SECONDS = 15.0
+OLDEST_SIGNAL_QUERY_TIMEOUT_MILLISECS = 1000
+
+_SET_QUERY_TIMEOUT = text(
+    f"SET LOCAL statement_timeout = {OLDEST_SIGNAL_QUERY_TIMEOUT_MILLISECS}"
+)
+
+_ESTIMATE_PENDING_ROWS = text(
+    "SELECT relname, n_live_tup FROM pg_stat_user_tables"
+    " WHERE relname = ANY(:table_names)"
+)
+
+
+class _SignalMetrics:
+    def __init__(self):
+        self.flushed_count = 0
+        self.error_count = 0
+        self.oldest_inserted_at: Optional[datetime] = None
+        self.oldest_inserted_at_refreshed_at = -math.inf
+        self.is_oldest_inserted_at_known = False
+        self.burst_size = 0
+        self.publish_latency_buckets = [0] * len(PUBLISH_LATENCY_BUCKETS)
+        self.publish_latency_count = 0
+        self.publish_latency_sum = 0.0
+
+
+class FlushMetrics:
+    """Collects metrics about the flushing of signals.
+
+    The metrics can be rendered in Prometheus' text exposition format.
+    The number of pending signals is estimated from the statistics
+    collected by PostgreSQL. The age of the oldest pending signal is
+    read from the `inserted_at` index of the signal tables, but not
+    more often than once per `OLDEST_SIGNAL_REFRESH_SECONDS`. If the
+    query fails (for example, because it takes too long), the age is
+    reported as NaN until the next successful query.
+
+    """
+
+    def __init__(self, models: Iterable[type]):
+        self._lock = threading.Lock()
+        self._metrics = {model: _SignalMetrics() for model in models}
+
+    def observe_burst_size(self, model: type, size: int) -> None:
+        """Register the currently chosen burst size."""
+
+        with self._lock:
+            self._metrics[model].burst_size = size
+
+    def observe_publish(self, model: type, seconds: float) -> None:
+        """Register the time it took to publish a burst of signals."""
+
+        with self._lock:
+            m = self._metrics[model]
+            m.publish_latency_count += 1
+            m.publish_latency_sum += seconds
+            for i, bound in enumerate(PUBLISH_LATENCY_BUCKETS):
+                if seconds <= bound:
+                    m.publish_latency_buckets[i] += 1
+
+    def observe_flushed(self, model: type, count: int) -> None:
+        """Register flushed (published and deleted) signals."""
+
+        with self._lock:
+            self._metrics[model].flushed_count += count
+
+    def observe_error(self, model: type) -> None:
+        """Register an error during the flushing of signals."""
+
+        with self._lock:
+            self._metrics[model].error_count += 1
+
+    def render(self, engine) -> str:
+        """Return the metrics in Prometheus' text exposition format."""
+
+        models = list(self._metrics)
+        self._refresh_oldest_signals(engine)
+        with engine.connect() as conn:
+            pending_rows = dict(
+                conn.execute(
+                    _ESTIMATE_PENDING_ROWS,
+                    {"table_names": [m.__table__.name for m in models]},
+                ).all()
+            )
+
+        with self._lock:
+            metrics = {
+                model.__name__: (
+                    pending_rows.get(model.__table__.name, 0),
+                    (
+                        _calc_age(m.oldest_inserted_at)
+                        if m.is_oldest_inserted_at_known
+                        else math.nan
+                    ),
+                    m.burst_size,
+                    m.flushed_count,
+                    m.error_count,
+                    list(m.publish_latency_buckets),
+                    m.publish_latency_count,
+                    m.publish_latency_sum,
+                )
+                for model, m in self._metrics.items()
+            }
+
+        lines = [
+            "# HELP swpt_accounts_pending_signals"
+            " Estimated number of pending signals.",
+            "# TYPE swpt_accounts_pending_signals gauge",
+        ]
+        for name, (pending, *_) in metrics.items():
+            lines.append(
+                f'swpt_accounts_pending_signals{{signal="{name}"}} {pending}'
+            )
+
+        lines += [
+            "# HELP swpt_accounts_oldest_signal_age_seconds"
+            " Age of the oldest pending signal.",
+            "# TYPE swpt_accounts_oldest_signal_age_seconds gauge",
+        ]
+        for name, (_, age, *_) in metrics.items():
+            age = "NaN" if math.isnan(age) else f"{age:.3f}"
+            lines.append(
+                "swpt_accounts_oldest_signal_age_seconds"
+                f'{{signal="{name}"}} {age}'
+            )
+
+        lines += [
+            "# HELP swpt_accounts_burst_size"
+            " Currently chosen number of signals per burst.",
+            "# TYPE swpt_accounts_burst_size gauge",
+        ]
+        for name, (_, _, burst_size, *_) in metrics.items():
+            lines.append(
+                f'swpt_accounts_burst_size{{signal="{name}"}} {burst_size}'
+            )
+
+        lines += [
+            "# HELP swpt_accounts_flushed_signals_total"
+            " Number of flushed signals.",
+            "# TYPE swpt_accounts_flushed_signals_total counter",
+        ]
+        for name, (_, _, _, flushed, *_) in metrics.items():
+            lines.append(
+                f'swpt_accounts_flushed_signals_total{{signal="{name}"}}'
+                f" {flushed}"
+            )
+
+        lines += [
+            "# HELP swpt_accounts_flush_errors_total"
+            " Number of errors during flushing.",
+            "# TYPE swpt_accounts_flush_errors_total counter",
+        ]
+        for name, (_, _, _, _, errors, *_) in metrics.items():
+            lines.append(
+                f'swpt_accounts_flush_errors_total{{signal="{name}"}} {errors}'
+            )
+
+        lines += [
+            "# HELP swpt_accounts_publish_latency_seconds"
+            " Time to publish a burst of signals, and receive the confirms.",
+            "# TYPE swpt_accounts_publish_latency_seconds histogram",
+        ]
+        for name, (*_, buckets, count, total) in metrics.items():
+            prefix = "swpt_accounts_publish_latency_seconds"
+            for bound, bucket_count in zip(PUBLISH_LATENCY_BUCKETS, buckets):
+                lines.append(
+                    f'{prefix}_bucket{{signal="{name}",le="{bound}"}}'
+                    f" {bucket_count}"
+                )
+            lines += [
+                f'{prefix}_bucket{{signal="{name}",le="+Inf"}} {count}',
+                f'{prefix}_sum{{signal="{name}"}} {total:.6f}',
+                f'{prefix}_count{{signal="{name}"}} {count}',
+            ]
+
+        return "\n".join(lines) + "\n"
+
+    def _refresh_oldest_signals(self, engine) -> None:
+        for model, m in self._metrics.items():
+            with self._lock:
+                if (
+                    time.monotonic() - m.oldest_inserted_at_refreshed_at
+                    < OLDEST_SIGNAL_REFRESH_SECONDS
+                ):
+                    continue
+                m.oldest_inserted_at_refreshed_at = time.monotonic()
+
+            try:
+                with engine.begin() as conn:
+                    conn.execute(_SET_QUERY_TIMEOUT)
+                    oldest_inserted_at = conn.execute(
+                        select(model.inserted_at)
+                        .order_by(model.inserted_at)
+                        .limit(1)
+                    ).scalar_one_or_none()
+            except DBAPIError:
+                logging.getLogger(__name__).warning(
+                    "Failed to query the oldest pending %s.", model.__name__
+                )
+                with self._lock:
+                    m.is_oldest_inserted_at_known = False
+                continue
+
+            with self._lock:
+                m.oldest_inserted_at = oldest_inserted_at
+                m.is_oldest_inserted_at_known = True
+
+
+def _calc_age(inserted_at: Optional[datetime]) -> float:
+    if inserted_at is None:
+        return 0.0
+
+    current_ts = datetime.now(tz=timezone.utc)
+    return max((current_ts - inserted_at).total_seconds(), 0.0)
+
+
+def start_metrics_server(
+    metrics: FlushMetrics, engine, port: int, max_port: Optional[int] = None
+) -> ThreadingHTTPServer:
+    """Serve the metrics at `http://<host>:<port>/metrics`.
+
+    When the port is busy (for example, because another flushing
+    process serves its metrics there), the next ports are tried, up to
+    `max_port`. The server runs in a daemon thread.
+
+    """
+    logger = logging.getLogger(__name__)
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            started_at = time.time()
+            try:
+                body = metrics.render(engine).encode("utf8")
+            except Exception:  # pragma: no cover
+                logger.exception("Caught error while rendering metrics.")
+                self.send_error(500)
+                return
+
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+            )
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            logger.debug(
+                "Rendered metrics in %.3f seconds.", time.time() - started_at
+            )
+
+        def log_message(self, format, *args):
+            pass
+
+    max_port = port if max_port is None else max_port
+    while True:
+        try:
+            server = ThreadingHTTPServer(("", port), MetricsHandler)
+            break
+        except OSError:
+            if port >= max_port:
+                raise
+            port += 1
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on port %i.", port)
+    return server
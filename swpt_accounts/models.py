@@ -1,12 +1,15 @@
 import json
 import math
-from typing import NamedTuple, Optional
+from typing import NamedTuple, Optional, Callable, Any
 from base64 import b16encode
-from datetime import datetime, timezone
+from datetime import datetime, date, timezone
+from inspect import signature
+from operator import attrgetter
 from decimal import Decimal
+from functools import lru_cache
 from marshmallow import Schema, fields
 from flask import current_app
-from sqlalchemy import text
+from sqlalchemy import text, Integer
 from sqlalchemy.inspection import inspect
 from sqlalchemy.dialects import postgresql as pg
 from sqlalchemy.sql.expression import func, null, or_, and_
@@ -32,6 +35,7 @@ MIN_INT32 = -1 << 31
 MAX_INT32 = (1 << 31) - 1
 MIN_INT64 = -1 << 63
 MAX_INT64 = (1 << 63) - 1
+MAX_UINT64 = (1 << 64) - 1
 T0 = datetime(1970, 1, 1, tzinfo=timezone.utc)
 T_INFINITY = datetime(9999, 12, 31, 23, 59, 59, tzinfo=timezone.utc)
 SECONDS_IN_DAY = 24 * 60 * 60
@@ -46,6 +50,20 @@ CREDITOR_SUBNET_MASK = 0xffffff0000000000
 DEBTOR_INFO_SHA256_REGEX = r"^([0-9A-F]{64}|[0-9a-f]{64})?$"
 SET_SEQSCAN_ON = text("SET LOCAL enable_seqscan = on")
 DISCARD_PLANS = text("DISCARD PLANS")
+_PG_DIALECT = pg.dialect()
+
+# The maximum number of memoized results for each one of the memoized
+# functions (routing keys, and shard-membership checks).
+MEMOIZATION_CACHE_SIZE = 100000
+_signal_dump_functions: dict = {}
+_message_properties_templates: dict = {}
+_json_encoder = json.JSONEncoder(
+    ensure_ascii=False,
+    check_circular=False,
+    allow_nan=False,
+    separators=(",", ":"),
+)
+_memoized_sharding_realm = None
 
 # The account `(debtor_id, ROOT_CREDITOR_ID)` is special. This is the
 # debtor's account. It issuers all the money. Also, all interest and
@@ -99,6 +117,75 @@ class ChooseRowsMixin:
         )
 
 
+def bulk_insert(
+    model,
+    rows: list,
+    ignore_conflicts: bool = False,
+    returning: tuple[str, ...] = (),
+) -> list:
+    """Insert many rows into the table of the given model.
+
+    Each row can be a dictionary (column key -> value), or a transient
+    instance of the model. Unlike `executemany`, which binds the
+    parameters of every row separately, this function passes one
+    array parameter per column, and inserts all the rows with a single
+    `INSERT ... SELECT * FROM unnest(...)` statement. Omitted columns
+    get their Python-side scalar or callable defaults (if any), and
+    columns without such defaults, which are omitted from all the
+    rows, get their server-side defaults.
+
+    When `returning` is not empty, returns the values of the given
+    columns for the inserted rows.
+
+    """
+    if not rows:
+        return []
+
+    rows = [r if isinstance(r, dict) else inspect(r).dict for r in rows]
+    keys = {key for row in rows for key in row}
+    columns = [
+        c
+        for c in model.__table__.columns
+        if c.key in keys or _has_python_default(c)
+    ]
+    quote = _PG_DIALECT.identifier_preparer.quote
+    params = {}
+    unnest_args = []
+    for i, column in enumerate(columns):
+        key = column.key
+        default = column.default if _has_python_default(column) else None
+        if default is not None and default.is_callable:
+            values = [
+                row[key] if key in row else default.arg(None) for row in rows
+            ]
+        else:
+            default_value = None if default is None else default.arg
+            values = [row.get(key, default_value) for row in rows]
+
+        bindparam_name = f"column{i}_values"
+        params[bindparam_name] = values
+        sql_type = column.type.compile(dialect=_PG_DIALECT)
+        unnest_args.append(f":{bindparam_name} :: {sql_type}[]")
+
+    sql = (
+        f"INSERT INTO {quote(model.__table__.name)}"
+        f" ({', '.join(quote(c.name) for c in columns)})"
+        f" SELECT * FROM unnest({', '.join(unnest_args)})"
+    )
+    if ignore_conflicts:
+        sql += " ON CONFLICT DO NOTHING"
+    if returning:
+        sql += f" RETURNING {', '.join(quote(name) for name in returning)}"
+
+    result = db.session.execute(text(sql), params)
+    return result.all() if returning else []
+
+
+def _has_python_default(column) -> bool:
+    default = column.default
+    return default is not None and (default.is_scalar or default.is_callable)
+
+
 def get_now_utc() -> datetime:
     return datetime.now(tz=timezone.utc)
 
@@ -110,12 +197,77 @@ def calc_k(interest_rate: float) -> float:
 def is_valid_account(
     debtor_id: int, creditor_id: int, match_parent=False
 ) -> bool:
+    global _memoized_sharding_realm
+
     sharding_realm = current_app.config["SHARDING_REALM"]
-    return sharding_realm.match(
+    if sharding_realm is not _memoized_sharding_realm:
+        _match_sharding_realm.cache_clear()
+        _memoized_sharding_realm = sharding_realm
+
+    return _match_sharding_realm(debtor_id, creditor_id, match_parent)
+
+
+@lru_cache(maxsize=MEMOIZATION_CACHE_SIZE)
+def _match_sharding_realm(
+    debtor_id: int, creditor_id: int, match_parent: bool
+) -> bool:
+    return _memoized_sharding_realm.match(
         debtor_id, creditor_id, match_parent=match_parent
     )
 
 
+# The routing keys depend only on the IDs, which repeat heavily
+# within a burst of outgoing messages.
+_cached_hex_routing_key = lru_cache(maxsize=MEMOIZATION_CACHE_SIZE)(
+    i64_to_hex_routing_key
+)
+_cached_bin_routing_key = lru_cache(maxsize=MEMOIZATION_CACHE_SIZE)(
+    calc_bin_routing_key
+)
+
+
+def get_memoization_stats() -> dict:
+    """Return the hits, the misses, the current size, and the hit rate
+    of the memoized routing keys, and shard-membership checks."""
+
+    stats = {}
+    for name, f in [
+        ("hex_routing_keys", _cached_hex_routing_key),
+        ("bin_routing_keys", _cached_bin_routing_key),
+        ("shard_membership", _match_sharding_realm),
+    ]:
+        info = f.cache_info()
+        calls = info.hits + info.misses
+        stats[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "hit_rate": info.hits / calls if calls else 0.0,
+        }
+
+    return stats
+
+
+def account_bucket_clause(
+    debtor_id_column,
+    creditor_id_column,
+    bucket_count: int,
+    bucket_index: int,
+):
+    """Return a clause which is true for the accounts that belong to
+    the given bucket."""
+
+    assert 0 <= bucket_index < bucket_count
+
+    # NOTE: The hashes of the debtor ID and the creditor ID are
+    # combined, so that the accounts of one debtor are distributed
+    # evenly among the buckets.
+    account_hash = func.hashint8(debtor_id_column).op(
+        "#", return_type=Integer
+    )(func.hashint8(creditor_id_column))
+    return func.abs(account_hash % bucket_count) == bucket_index
+
+
 def contain_principal_overflow(value: int) -> int:
     if value <= MIN_INT64:
         return -MAX_INT64
@@ -286,6 +438,17 @@ class Account(db.Model, ChooseRowsMixin):
             " `AccountUpdate` message to be send."
         ),
     )
+    next_due_ts = db.Column(
+        db.TIMESTAMP(timezone=True),
+        nullable=False,
+        default=get_now_utc,
+        server_default=func.now(),
+        comment=(
+            "The moment at which the account should be visited by the due"
+            " accounts scanner. Every change in the account moves it to the"
+            " present, and the due accounts scanner moves it to the future."
+        ),
+    )
     __table_args__ = (
         db.CheckConstraint(
             and_(
@@ -311,6 +474,7 @@ class Account(db.Model, ChooseRowsMixin):
                 func.octet_length(debtor_info_sha256) == 32,
             )
         ),
+        db.Index("idx_account_next_due_ts", next_due_ts),
         {
             "comment": "Tells who owes what to whom.",
         },
@@ -577,15 +741,133 @@ class PendingBalanceChange(db.Model):
     )
 
 
+def compile_schema_dump(schema: Schema) -> Callable[[Any], dict]:
+    """Return a function that does the same as `schema.dump(obj)`, but
+    faster.
+
+    The most often used field types are serialized directly, without
+    going through marshmallow's generic machinery. All other fields
+    are serialized by calling `field.serialize`. The produced
+    dictionaries are equal to the ones produced by `schema.dump`, and
+    their keys go in the same order.
+    """
+    converters = {
+        fields.Integer: int,
+        fields.Float: float,
+        fields.String: str,
+        fields.DateTime: datetime.isoformat,
+        fields.Date: date.isoformat,
+    }
+
+    def make_field_serializer(name, field):
+        field_type = type(field)
+
+        if field_type is fields.Constant:
+            return lambda obj, value=field.constant: value
+
+        if (
+            field_type is fields.Function
+            and field.serialize_func
+            and len(signature(field.serialize_func).parameters) == 1
+        ):
+            return field.serialize_func
+
+        if (
+            field_type in converters
+            and not getattr(field, "as_string", False)
+            and getattr(field, "format", None) in (None, "iso", "iso8601")
+        ):
+            def serialize(
+                obj,
+                get_value=attrgetter(field.attribute or name),
+                convert=converters[field_type],
+            ):
+                value = get_value(obj)
+                return None if value is None else convert(value)
+
+            return serialize
+
+        return lambda obj: field.serialize(name, obj)  # pragma: no cover
+
+    items = [
+        (
+            name if field.data_key is None else field.data_key,
+            make_field_serializer(name, field),
+        )
+        for name, field in schema.dump_fields.items()
+    ]
+
+    def dump(obj) -> dict:
+        return {key: serialize(obj) for key, serialize in items}
+
+    return dump
+
+
+class TableScanCheckpoint(db.Model):
+    table_name = db.Column(db.String, primary_key=True)
+    worker_count = db.Column(db.Integer, primary_key=True)
+    worker_index = db.Column(db.Integer, primary_key=True)
+    pass_started_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+    block_count = db.Column(
+        db.BigInteger,
+        nullable=False,
+        comment=(
+            "The number of blocks in the table at the beginning of the pass."
+            " It determines the range of blocks scanned by the worker."
+        ),
+    )
+    next_block = db.Column(
+        db.BigInteger,
+        nullable=False,
+        comment="The first block which has not been scanned yet.",
+    )
+    estimated_finish_at = db.Column(db.TIMESTAMP(timezone=True))
+    __table_args__ = (
+        db.CheckConstraint(worker_count > 0),
+        db.CheckConstraint(
+            and_(worker_index >= 0, worker_index < worker_count)
+        ),
+        db.CheckConstraint(block_count >= 0),
+        db.CheckConstraint(next_block >= 0),
+        {
+            "comment": (
+                "Represents the position reached by a table scanner worker"
+                " in its current pass through the table. When the worker is"
+                " restarted, it continues the pass from this position."
+            ),
+        },
+    )
+
+
 class Signal(db.Model, ChooseRowsMixin):
     """A pending message that needs to be send to the RabbitMQ server."""
 
     __abstract__ = True
 
+    # When `True`, the messages will be serialized by a function
+    # compiled with `compile_schema_dump`. Otherwise, they will be
+    # serialized by calling `__marshmallow_schema__.dump`.
+    fast_serialization = True
+
+    # When the messages are flushed in priority lanes, the signals
+    # with higher `flush_priority` are flushed first, and up to
+    # `flush_weight` consecutive bursts are flushed from each signal
+    # table, before moving to the next one.
+    flush_priority = 0
+    flush_weight = 1
+
+    @classmethod
+    def get_account_columns(cls) -> tuple:
+        """Return the columns which identify the account that the
+        signal is about: `(debtor_id, creditor_id)`."""
+
+        return cls.debtor_id, cls.creditor_id
+
     @classmethod
     def send_signalbus_messages(cls, objects):
         create_message = cls._create_message
-        messages = (create_message(obj) for obj in objects)
+        dump = cls.get_dump_function()
+        messages = (create_message(obj, dump) for obj in objects)
         publisher.publish_messages([m for m in messages if m is not None])
 
     @classmethod
@@ -593,8 +875,39 @@ class Signal(db.Model, ChooseRowsMixin):
         cls.send_signalbus_messages([obj])
 
     @classmethod
-    def _create_message(cls, obj):
-        data = cls.__marshmallow_schema__.dump(obj)
+    def get_dump_function(cls) -> Callable[[Any], dict]:
+        key = (cls, cls.fast_serialization)
+        try:
+            return _signal_dump_functions[key]
+        except KeyError:
+            schema = cls.__marshmallow_schema__
+            dump = (
+                compile_schema_dump(schema)
+                if cls.fast_serialization
+                else schema.dump
+            )
+            _signal_dump_functions[key] = dump
+            return dump
+
+    @classmethod
+    def get_message_properties_template(cls, message_type: str) -> dict:
+        """Return the message properties which are the same for all
+        messages of the given type (everything except the headers)."""
+
+        try:
+            return _message_properties_templates[message_type]
+        except KeyError:
+            template = _message_properties_templates[message_type] = dict(
+                delivery_mode=2,
+                app_id="swpt_accounts",
+                content_type="application/json",
+                type=message_type,
+            )
+            return template
+
+    @classmethod
+    def _create_message(cls, obj, dump=None):
+        data = (dump or cls.get_dump_function())(obj)
         message_type = data["type"]
         creditor_id = data["creditor_id"]
         debtor_id = data["debtor_id"]
@@ -622,20 +935,16 @@ class Signal(db.Model, ChooseRowsMixin):
             headers["coordinator-id"] = data["coordinator_id"]
             headers["coordinator-type"] = data["coordinator_type"]
 
-        properties = rabbitmq.MessageProperties(
-            delivery_mode=2,
-            app_id="swpt_accounts",
-            content_type="application/json",
-            type=message_type,
-            headers=headers,
-        )
-        body = json.dumps(
-            data,
-            ensure_ascii=False,
-            check_circular=False,
-            allow_nan=False,
-            separators=(",", ":"),
-        ).encode("utf8")
+        # NOTE: The properties object can not be shared between
+        # messages, because the headers contain the IDs of the
+        # account (and the coordinator). Memoizing the properties by
+        # the values of the headers does not pay off, because within
+        # a burst the same values rarely repeat (for example, only
+        # the newest `AccountUpdate` for each account is sent), and a
+        # cache miss costs more than creating the object.
+        template = cls.get_message_properties_template(message_type)
+        properties = rabbitmq.MessageProperties(headers=headers, **template)
+        body = _json_encoder.encode(data).encode("utf8")
 
         return rabbitmq.Message(
             exchange=cls.get_exchange_name(obj),
@@ -656,8 +965,13 @@ class Signal(db.Model, ChooseRowsMixin):
             ),
         )
 
+    # NOTE: The index allows the age of the oldest pending signal to
+    # be reported without scanning the whole table.
     inserted_at = db.Column(
-        db.TIMESTAMP(timezone=True), nullable=False, default=get_now_utc
+        db.TIMESTAMP(timezone=True),
+        nullable=False,
+        default=get_now_utc,
+        index=True,
     )
 
 
@@ -684,6 +998,13 @@ class RejectedTransferSignal(Signal):
     status_code = db.Column(db.String(30), nullable=False)
     total_locked_amount = db.Column(db.BigInteger, nullable=False)
 
+    @classmethod
+    def get_account_columns(cls) -> tuple:
+        return cls.debtor_id, cls.sender_creditor_id
+
+    flush_priority = 2
+    flush_weight = 8
+
     @classproperty
     def signalbus_burst_count(self):
         return current_app.config["APP_FLUSH_REJECTED_TRANSFERS_BURST_COUNT"]
@@ -694,7 +1015,7 @@ class RejectedTransferSignal(Signal):
 
     @staticmethod
     def get_routing_key(obj):
-        return i64_to_hex_routing_key(obj.coordinator_id)
+        return _cached_hex_routing_key(obj.coordinator_id)
 
 
 class PreparedTransferSignal(Signal):
@@ -734,6 +1055,13 @@ class PreparedTransferSignal(Signal):
         db.TIMESTAMP(timezone=True), nullable=False
     )
 
+    @classmethod
+    def get_account_columns(cls) -> tuple:
+        return cls.debtor_id, cls.sender_creditor_id
+
+    flush_priority = 2
+    flush_weight = 8
+
     @classproperty
     def signalbus_burst_count(self):
         return current_app.config["APP_FLUSH_PREPARED_TRANSFERS_BURST_COUNT"]
@@ -744,7 +1072,7 @@ class PreparedTransferSignal(Signal):
 
     @staticmethod
     def get_routing_key(obj):
-        return i64_to_hex_routing_key(obj.coordinator_id)
+        return _cached_hex_routing_key(obj.coordinator_id)
 
 
 class FinalizedTransferSignal(Signal):
@@ -776,6 +1104,13 @@ class FinalizedTransferSignal(Signal):
     total_locked_amount = db.Column(db.BigInteger, nullable=False)
     status_code = db.Column(db.String(30), nullable=False)
 
+    @classmethod
+    def get_account_columns(cls) -> tuple:
+        return cls.debtor_id, cls.sender_creditor_id
+
+    flush_priority = 2
+    flush_weight = 8
+
     @classproperty
     def signalbus_burst_count(self):
         return current_app.config["APP_FLUSH_FINALIZED_TRANSFERS_BURST_COUNT"]
@@ -786,7 +1121,7 @@ class FinalizedTransferSignal(Signal):
 
     @staticmethod
     def get_routing_key(obj):
-        return i64_to_hex_routing_key(obj.coordinator_id)
+        return _cached_hex_routing_key(obj.coordinator_id)
 
 
 class AccountTransferSignal(Signal):
@@ -839,6 +1174,9 @@ class AccountTransferSignal(Signal):
     principal = db.Column(db.BigInteger, nullable=False)
     previous_transfer_number = db.Column(db.BigInteger, nullable=False)
 
+    flush_priority = 1
+    flush_weight = 4
+
     @classproperty
     def signalbus_burst_count(self):
         return current_app.config["APP_FLUSH_ACCOUNT_TRANSFERS_BURST_COUNT"]
@@ -853,7 +1191,7 @@ class AccountTransferSignal(Signal):
 
     @staticmethod
     def get_routing_key(obj):
-        return i64_to_hex_routing_key(
+        return _cached_hex_routing_key(
             obj.debtor_id
             if obj.creditor_id == ROOT_CREDITOR_ID
             else obj.creditor_id
@@ -934,6 +1272,25 @@ class AccountUpdateSignal(Signal):
     debtor_info_content_type = db.Column(db.String)
     debtor_info_sha256 = db.Column(db.LargeBinary)
 
+    @classmethod
+    def send_signalbus_messages(cls, objects):
+        # Only the newest pending update for a given account matters
+        # to the receiver. Therefore, when the same account has more
+        # than one pending update, only the newest one is sent. (The
+        # superseded updates will be deleted together with the sent
+        # ones.)
+        newest_updates = {}
+        for obj in objects:
+            key = (obj.debtor_id, obj.creditor_id)
+            newest_update = newest_updates.get(key)
+            if (
+                newest_update is None
+                or obj.signal_id >= newest_update.signal_id
+            ):
+                newest_updates[key] = obj
+
+        super().send_signalbus_messages(newest_updates.values())
+
     @classproperty
     def signalbus_burst_count(self):
         return current_app.config["APP_FLUSH_ACCOUNT_UPDATES_BURST_COUNT"]
@@ -948,7 +1305,7 @@ class AccountUpdateSignal(Signal):
 
     @staticmethod
     def get_routing_key(obj):
-        return i64_to_hex_routing_key(
+        return _cached_hex_routing_key(
             obj.debtor_id
             if obj.creditor_id == ROOT_CREDITOR_ID
             else obj.creditor_id
@@ -979,7 +1336,7 @@ class AccountPurgeSignal(Signal):
 
     @staticmethod
     def get_routing_key(obj):
-        return i64_to_hex_routing_key(
+        return _cached_hex_routing_key(
             obj.debtor_id
             if obj.creditor_id == ROOT_CREDITOR_ID
             else obj.creditor_id
@@ -1025,12 +1382,15 @@ class RejectedConfigSignal(Signal):
 
     @staticmethod
     def get_routing_key(obj):
-        return i64_to_hex_routing_key(
+        return _cached_hex_routing_key(
             obj.debtor_id
             if obj.creditor_id == ROOT_CREDITOR_ID
             else obj.creditor_id
         )
 
+    flush_priority = 1
+    flush_weight = 4
+
     @classproperty
     def signalbus_burst_count(self):
         return current_app.config["APP_FLUSH_REJECTED_CONFIGS_BURST_COUNT"]
@@ -1067,7 +1427,10 @@ class PendingBalanceChangeSignal(Signal):
 
     @staticmethod
     def get_routing_key(obj):
-        return calc_bin_routing_key(obj.debtor_id, obj.creditor_id)
+        return _cached_bin_routing_key(obj.debtor_id, obj.creditor_id)
+
+    flush_priority = 1
+    flush_weight = 4
 
     @classproperty
     def signalbus_burst_count(self):
@@ -4,7 +4,7 @@ from datetime import datetime, timezone, timedelta
 from typing import TypeVar, Iterable, Tuple, List, Union, Optional, Callable
 from decimal import Decimal
 from flask import current_app
-from sqlalchemy import select, text
+from sqlalchemy import select, update, delete, text
 from sqlalchemy.orm import defer
 from sqlalchemy.sql.expression import tuple_, and_
 from sqlalchemy.exc import IntegrityError
@@ -49,6 +49,8 @@ from swpt_accounts.models import (
     is_negligible_balance,
     contain_principal_overflow,
     are_managed_by_same_agent,
+    account_bucket_clause,
+    bulk_insert,
 )
 
 T = TypeVar("T")
@@ -64,6 +66,9 @@ REGISTERED_BALANCE_CHANGE_PK = tuple_(
     RegisteredBalanceChange.change_id,
 )
 RC_INVALID_CONFIGURATION = "INVALID_CONFIGURATION"
+TRANSFER_REQUESTS_CHANNEL = "swpt_accounts_transfer_requests"
+FINALIZATION_REQUESTS_CHANNEL = "swpt_accounts_finalization_requests"
+PENDING_BALANCE_CHANGES_CHANNEL = "swpt_accounts_pending_balance_changes"
 PREPARED_TRANSFER_JOIN_CLAUSE = and_(
     FinalizationRequest.debtor_id == PreparedTransfer.debtor_id,
     FinalizationRequest.sender_creditor_id
@@ -85,6 +90,10 @@ CALL_PROCESS_FINALIZATION_REQUESTS = text(
 CALL_PENDING_BALANCE_CHANGES = text(
     "SELECT process_pending_balance_changes(:debtor_id, :creditor_id)"
 )
+CALL_PENDING_BALANCE_CHANGES_BATCH = text(
+    "SELECT process_pending_balance_changes_batch("
+    ":accounts :: account_pktype[])"
+)
 DEFER_ACCOUNT_TOASTED_COLUMNS = [
     defer(Account.config_data),
     defer(Account.debtor_info_iri),
@@ -222,6 +231,7 @@ def prepare_transfer(
                 final_interest_rate_ts=final_interest_rate_ts,
             )
         )
+        _notify_processors(TRANSFER_REQUESTS_CHANNEL)
 
 
 @atomic
@@ -256,6 +266,8 @@ def finalize_transfer(
         db.session.flush()
     except IntegrityError:
         db.session.rollback()
+    else:
+        _notify_processors(FINALIZATION_REQUESTS_CHANNEL)
 
 
 @atomic
@@ -276,6 +288,39 @@ def is_reachable_account(debtor_id: int, creditor_id: int) -> bool:
     return db.session.query(account_query.exists()).scalar()
 
 
+@atomic
+def get_reachable_accounts(
+    accounts: Iterable[Tuple[int, int]]
+) -> List[Tuple[int, int]]:
+    """Return the reachable accounts among the given `(debtor_id,
+    creditor_id)` pairs.
+    """
+    accounts = set(accounts)
+    reachable_accounts = [
+        pk for pk in accounts if pk[1] == ROOT_CREDITOR_ID
+    ]
+    other_accounts = [
+        pk for pk in accounts if pk[1] != ROOT_CREDITOR_ID
+    ]
+    if other_accounts:
+        reachable_accounts.extend(
+            tuple(row)
+            for row in db.session.execute(
+                select(Account.debtor_id, Account.creditor_id)
+                .where(
+                    ACCOUNT_PK.in_(other_accounts),
+                    Account.status_flags.op("&")(Account.STATUS_DELETED_FLAG)
+                    == 0,
+                    Account.config_flags.op("&")(
+                        Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG
+                    ) == 0,
+                )
+            ).all()
+        )
+
+    return reachable_accounts
+
+
 @atomic
 def get_account_config_data(debtor_id: int, creditor_id: int) -> Optional[str]:
     return db.session.execute(
@@ -401,24 +446,28 @@ def capitalize_interest(
     min_capitalization_interval: timedelta = timedelta(),
 ) -> None:
     current_ts = datetime.now(tz=timezone.utc)
-    capitalization_cutoff_ts = current_ts - min_capitalization_interval
     account = get_account(
         debtor_id, creditor_id, lock=True, defer_toasted=True
     )
-    if (
-        account
-        and account.last_interest_capitalization_ts <= capitalization_cutoff_ts
-    ):
-        accumulated_interest = math.floor(
-            _calc_account_accumulated_interest(account, current_ts)
-        )
-        accumulated_interest = contain_principal_overflow(accumulated_interest)
+    if account:
+        _capitalize_interest(account, min_capitalization_interval, current_ts)
 
-        if accumulated_interest != 0:
-            account.last_interest_capitalization_ts = current_ts
-            _make_debtor_payment(
-                CT_INTEREST, account, accumulated_interest, current_ts
-            )
+
+@atomic
+def capitalize_interests(
+    accounts: List[Tuple[int, int]],
+    min_capitalization_interval: timedelta = timedelta(),
+) -> None:
+    """Capitalize the interest on several accounts, in a single
+    transaction.
+
+    The accounts are locked in a deterministic order, to avoid
+    deadlocks between concurrent transactions.
+
+    """
+    current_ts = datetime.now(tz=timezone.utc)
+    for account in _lock_accounts(accounts, defer_toasted=True):
+        _capitalize_interest(account, min_capitalization_interval, current_ts)
 
 
 @atomic
@@ -426,56 +475,34 @@ def try_to_delete_account(debtor_id: int, creditor_id: int) -> None:
     current_ts = datetime.now(tz=timezone.utc)
     account = get_account(debtor_id, creditor_id, lock=True)
     if account:
-        account.last_deletion_attempt_ts = current_ts
+        _try_to_delete_account(account, current_ts)
 
-        can_be_deleted = False
-        can_be_deleted_if_balance_is_negligible = (
-            account.config_flags & Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG
-            and account.pending_transfers_count == 0
-        )
-        if can_be_deleted_if_balance_is_negligible:
-            if creditor_id == ROOT_CREDITOR_ID:  # pragma: nocover
-                # NOTE: The debtor's account will only be deleted if
-                # the remaining principal (that is, the total amount
-                # of tokens in circulation with a negative sign) is
-                # exactly zero. However, if there are regular accounts
-                # with negative balances, it is possible for the
-                # deleted debtor's account to be "resurrected" by an
-                # incoming transfer, with its "scheduled for deletion"
-                # flag reset to `False`. To properly delete the
-                # debtor's account in this case, the debtors agent
-                # should automatically schedule the account for
-                # deletion again, in response to the `AccountUpdate`
-                # message sent as a result of the resurrection of the
-                # debtor's account.
-                can_be_deleted = account.principal == 0
-            else:
-                balance = account.calc_current_balance(current_ts)
-                can_be_deleted = is_negligible_balance(
-                    balance, account.negligible_amount
-                )
 
-        if can_be_deleted:
-            if account.principal != 0:
-                _make_debtor_payment(
-                    CT_DELETE, account, -account.principal, current_ts
-                )
-            _mark_account_as_deleted(account, current_ts)
+@atomic
+def try_to_delete_accounts(accounts: List[Tuple[int, int]]) -> None:
+    """Try to delete several accounts, in a single transaction.
+
+    The accounts are locked in a deterministic order, to avoid
+    deadlocks between concurrent transactions.
+
+    """
+    current_ts = datetime.now(tz=timezone.utc)
+    for account in _lock_accounts(accounts):
+        _try_to_delete_account(account, current_ts)
 
 
 def iter_accounts_with_transfer_requests(
-        yield_per: int,
+    yield_per: int,
+    bucket_count: int = 1,
+    bucket_index: int = 0,
 ) -> Iterable[List[Tuple[int, int]]]:
-    with db.engine.connect() as conn:
-        with conn.execution_options(yield_per=yield_per).execute(
-                select(
-                    TransferRequest.debtor_id,
-                    TransferRequest.sender_creditor_id
-                )
-                .distinct()
-        ) as result:
-            for rows in result.partitions():
-                yield rows
+    return _iter_accounts_with_rows(
+        TransferRequest.debtor_id,
+        TransferRequest.sender_creditor_id,
+        yield_per=yield_per,
+        bucket_count=bucket_count,
+        bucket_index=bucket_index,
+    )
 
 
 @atomic
@@ -522,27 +549,22 @@ def process_transfer_requests(
             else:  # pragma: nocover
                 raise RuntimeError("unexpected return type")
 
-        db.session.bulk_save_objects(
-            rejected_transfer_signals, preserve_order=False
-        )
-        db.session.bulk_save_objects(
-            prepared_transfer_signals, preserve_order=False
-        )
+        bulk_insert(RejectedTransferSignal, rejected_transfer_signals)
+        bulk_insert(PreparedTransferSignal, prepared_transfer_signals)
 
 
 def iter_accounts_with_finalization_requests(
     yield_per: int = None,
+    bucket_count: int = 1,
+    bucket_index: int = 0,
 ) -> Iterable[List[Tuple[int, int]]]:
-    with db.engine.connect() as conn:
-        with conn.execution_options(yield_per=yield_per).execute(
-                select(
-                    FinalizationRequest.debtor_id,
-                    FinalizationRequest.sender_creditor_id
-                )
-                .distinct()
-        ) as result:
-            for rows in result.partitions():
-                yield rows
+    return _iter_accounts_with_rows(
+        FinalizationRequest.debtor_id,
+        FinalizationRequest.sender_creditor_id,
+        yield_per=yield_per,
+        bucket_count=bucket_count,
+        bucket_index=bucket_index,
+    )
 
 
 @atomic
@@ -619,24 +641,21 @@ def process_finalization_requests(
                 sender_account, principal_delta, 0.0, current_ts
             )
 
-        db.session.bulk_save_objects(
-            pending_balance_change_signals, preserve_order=False
-        )
+        bulk_insert(PendingBalanceChangeSignal, pending_balance_change_signals)
 
 
 def iter_accounts_with_pending_balance_changes(
     yield_per: int,
+    bucket_count: int = 1,
+    bucket_index: int = 0,
 ) -> Iterable[List[Tuple[int, int]]]:
-    with db.engine.connect() as conn:
-        with conn.execution_options(yield_per=yield_per).execute(
-                select(
-                    PendingBalanceChange.debtor_id,
-                    PendingBalanceChange.creditor_id
-                )
-                .distinct()
-        ) as result:
-            for rows in result.partitions():
-                yield rows
+    return _iter_accounts_with_rows(
+        PendingBalanceChange.debtor_id,
+        PendingBalanceChange.creditor_id,
+        yield_per=yield_per,
+        bucket_count=bucket_count,
+        bucket_index=bucket_index,
+    )
 
 
 @atomic
@@ -651,31 +670,54 @@ def process_pending_balance_changes(debtor_id: int, creditor_id: int) -> None:
         )
         return
 
+    _process_pending_balance_changes_batch([(debtor_id, creditor_id)])
+
+
+@atomic
+def process_pending_balance_changes_batch(
+    accounts: List[Tuple[int, int]]
+) -> None:
+    """Process the pending balance changes for several accounts, in a
+    single transaction.
+
+    The accounts are locked in a deterministic order, to avoid
+    deadlocks between concurrent transactions.
+
+    """
+    accounts = sorted(set(accounts))
+    if not accounts:
+        return
+
+    if current_app.config["APP_USE_PGPLSQL_FUNCTIONS"]:  # pragma: no cover
+        db.session.execute(
+            CALL_PENDING_BALANCE_CHANGES_BATCH, {"accounts": accounts}
+        )
+        return
+
+    _process_pending_balance_changes_batch(accounts)
+
+
+def _process_pending_balance_changes_batch(
+    accounts: List[Tuple[int, int]]
+) -> None:
     current_ts = datetime.now(tz=timezone.utc)
+    applied_change_pks = []
 
-    changes = (
-        PendingBalanceChange.query.filter_by(
-            debtor_id=debtor_id, creditor_id=creditor_id
+    for debtor_id, creditor_id in accounts:
+        changes = (
+            PendingBalanceChange.query.filter_by(
+                debtor_id=debtor_id, creditor_id=creditor_id
+            )
+            .with_for_update(skip_locked=True)
+            .all()
         )
-        .with_for_update(skip_locked=True)
-        .all()
-    )
+        if not changes:
+            continue
 
-    if changes:
-        applied_change_pks = []
         principal_delta = 0
         interest_delta = 0.0
         account = _lock_or_create_account(debtor_id, creditor_id, current_ts)
 
-        def update_registered_balance_changes():
-            RegisteredBalanceChange.query.filter(
-                REGISTERED_BALANCE_CHANGE_PK.in_(applied_change_pks)
-            ).update(
-                {RegisteredBalanceChange.is_applied: True},
-                synchronize_session=False,
-            )
-            applied_change_pks.clear()
-
         for change in changes:
             principal_delta += change.principal_delta
 
@@ -699,20 +741,37 @@ def process_pending_balance_changes(debtor_id: int, creditor_id: int) -> None:
                     account.principal + principal_delta
                 ),
             )
-
             applied_change_pks.append(
                 (change.debtor_id, change.other_creditor_id, change.change_id)
             )
-            if len(applied_change_pks) >= 1000:  # pragma: no cover
-                update_registered_balance_changes()
-
-            db.session.delete(change)
+            db.session.expunge(change)
 
         _apply_account_change(
             account, principal_delta, interest_delta, current_ts
         )
-        if applied_change_pks:
-            update_registered_balance_changes()
+
+    if applied_change_pks:
+        # NOTE: The pending balance changes table does not have its
+        # own primary key type, but its primary key columns are the
+        # same as those of the registered balance changes table.
+        applied = RegisteredBalanceChange.choose_rows(applied_change_pks)
+        db.session.execute(
+            update(RegisteredBalanceChange)
+            .execution_options(synchronize_session=False)
+            .where(REGISTERED_BALANCE_CHANGE_PK == tuple_(*applied.c))
+            .values(is_applied=True)
+        )
+        db.session.execute(
+            delete(PendingBalanceChange)
+            .execution_options(synchronize_session=False)
+            .where(
+                tuple_(
+                    PendingBalanceChange.debtor_id,
+                    PendingBalanceChange.other_creditor_id,
+                    PendingBalanceChange.change_id,
+                ) == tuple_(*applied.c)
+            )
+        )
 
 
 @atomic
@@ -815,6 +874,221 @@ def insert_pending_balance_change(
                 principal_delta=principal_delta,
             )
         )
+        _notify_processors(PENDING_BALANCE_CHANGES_CHANNEL)
+
+
+@atomic
+def insert_request_batch(
+    transfer_requests: List[dict] = (),
+    finalization_requests: List[dict] = (),
+    pending_balance_changes: List[dict] = (),
+) -> None:
+    """Persist a batch of incoming requests in a single transaction.
+
+    The elements of `transfer_requests`, `finalization_requests`, and
+    `pending_balance_changes` must be dictionaries, containing the
+    arguments that `prepare_transfer`, `finalize_transfer`, and
+    `insert_pending_balance_change` would otherwise be called with.
+    Each type of request is inserted with one multi-row INSERT.
+
+    """
+    if transfer_requests:
+        _insert_transfer_requests(transfer_requests)
+
+    if finalization_requests:
+        _insert_finalization_requests(finalization_requests)
+
+    if pending_balance_changes:
+        _insert_pending_balance_changes(pending_balance_changes)
+
+
+def _insert_transfer_requests(requests: List[dict]) -> None:
+    rejected_transfer_signals = []
+    transfer_requests = []
+
+    for r in requests:
+        recipient_creditor_id = r["recipient_creditor_id"]
+
+        if recipient_creditor_id is None:
+            rejected_transfer_signals.append(
+                dict(
+                    debtor_id=r["debtor_id"],
+                    coordinator_type=r["coordinator_type"],
+                    coordinator_id=r["coordinator_id"],
+                    coordinator_request_id=r["coordinator_request_id"],
+                    status_code=SC_RECIPIENT_IS_UNREACHABLE,
+                    total_locked_amount=0,
+                    sender_creditor_id=r["creditor_id"],
+                )
+            )
+        else:
+            transfer_requests.append(
+                dict(
+                    debtor_id=r["debtor_id"],
+                    coordinator_type=r["coordinator_type"],
+                    coordinator_id=r["coordinator_id"],
+                    coordinator_request_id=r["coordinator_request_id"],
+                    min_locked_amount=r["min_locked_amount"],
+                    max_locked_amount=r["max_locked_amount"],
+                    sender_creditor_id=r["creditor_id"],
+                    recipient_creditor_id=recipient_creditor_id,
+                    deadline=r["ts"] + timedelta(
+                        seconds=r.get("max_commit_delay", MAX_INT32)
+                    ),
+                    final_interest_rate_ts=r.get(
+                        "final_interest_rate_ts", T_INFINITY
+                    ),
+                )
+            )
+
+    bulk_insert(RejectedTransferSignal, rejected_transfer_signals)
+
+    if transfer_requests:
+        bulk_insert(TransferRequest, transfer_requests)
+        _notify_processors(TRANSFER_REQUESTS_CHANNEL)
+
+
+def _insert_finalization_requests(requests: List[dict]) -> None:
+    current_ts = datetime.now(tz=timezone.utc)
+
+    # NOTE: Finalization requests for already finalized transfers
+    # must be ignored. This is what `finalize_transfer` does when it
+    # gets an `IntegrityError`.
+    bulk_insert(
+        FinalizationRequest,
+        [
+            dict(
+                debtor_id=r["debtor_id"],
+                sender_creditor_id=r["creditor_id"],
+                transfer_id=r["transfer_id"],
+                coordinator_type=r["coordinator_type"],
+                coordinator_id=r["coordinator_id"],
+                coordinator_request_id=r["coordinator_request_id"],
+                committed_amount=r["committed_amount"],
+                transfer_note_format=r.get("transfer_note_format", ""),
+                transfer_note=r.get("transfer_note", ""),
+                ts=r.get("ts") or current_ts,
+            )
+            for r in requests
+        ],
+        ignore_conflicts=True,
+    )
+    _notify_processors(FINALIZATION_REQUESTS_CHANNEL)
+
+
+def _insert_pending_balance_changes(changes: List[dict]) -> None:
+    for c in changes:
+        assert MIN_INT64 <= c["debtor_id"] <= MAX_INT64
+        assert MIN_INT64 <= c["other_creditor_id"] <= MAX_INT64
+        assert MIN_INT64 <= c["change_id"] <= MAX_INT64
+
+    changes_by_pk = {}
+    for c in changes:
+        if c["committed_at"] >= c.get("cutoff_ts", T0):
+            pk = (c["debtor_id"], c["other_creditor_id"], c["change_id"])
+            changes_by_pk.setdefault(pk, c)
+
+    if not changes_by_pk:
+        return
+
+    # Only the balance changes that have not been registered already
+    # will be returned by the INSERT statement.
+    registered_pks = bulk_insert(
+        RegisteredBalanceChange,
+        [
+            dict(
+                debtor_id=c["debtor_id"],
+                other_creditor_id=c["other_creditor_id"],
+                change_id=c["change_id"],
+                committed_at=c["committed_at"],
+                is_applied=False,
+            )
+            for c in changes_by_pk.values()
+        ],
+        ignore_conflicts=True,
+        returning=("debtor_id", "other_creditor_id", "change_id"),
+    )
+
+    if registered_pks:
+        bulk_insert(
+            PendingBalanceChange,
+            [
+                dict(
+                    debtor_id=c["debtor_id"],
+                    other_creditor_id=c["other_creditor_id"],
+                    change_id=c["change_id"],
+                    creditor_id=c["creditor_id"],
+                    coordinator_type=c["coordinator_type"],
+                    transfer_note_format=c["transfer_note_format"],
+                    transfer_note=c["transfer_note"],
+                    committed_at=c["committed_at"],
+                    principal_delta=c["principal_delta"],
+                )
+                for c in (changes_by_pk[tuple(pk)] for pk in registered_pks)
+            ],
+        )
+        _notify_processors(PENDING_BALANCE_CHANGES_CHANNEL)
+
+
+def _notify_processors(channel: str) -> None:
+    # NOTE: The notification will be delivered to the listening
+    # "process_*" workers when the current transaction commits.
+    # Notifications are optional, because they are serialized in
+    # the database, and may limit the transaction throughput.
+    if current_app.config["APP_NOTIFY_PROCESSORS"]:
+        db.session.execute(
+            text("SELECT pg_notify(:channel, '')"), {"channel": channel}
+        )
+
+
+def _iter_accounts_with_rows(
+    debtor_id_column,
+    creditor_id_column,
+    yield_per: Optional[int],
+    bucket_count: int,
+    bucket_index: int,
+) -> Iterable[List[Tuple[int, int]]]:
+    # NOTE: Instead of `SELECT DISTINCT debtor_id, creditor_id`, which
+    # would read all rows in the table, we do a "loose index scan".
+    # That is: we use the index on `(debtor_id, creditor_id)` to jump
+    # directly from one account to the next one. This way, the cost of
+    # the query depends on the number of accounts that have rows,
+    # rather than on the number of rows.
+    table_name = debtor_id_column.table.name
+    d = debtor_id_column.name
+    c = creditor_id_column.name
+    accounts = (
+        text(
+            f"WITH RECURSIVE a AS ("
+            f"(SELECT {d} AS debtor_id, {c} AS creditor_id FROM {table_name}"
+            f" ORDER BY {d}, {c} LIMIT 1)"
+            f" UNION ALL"
+            f" SELECT n.debtor_id, n.creditor_id FROM a, LATERAL ("
+            f"SELECT {d} AS debtor_id, {c} AS creditor_id FROM {table_name}"
+            f" WHERE ({d}, {c}) > (a.debtor_id, a.creditor_id)"
+            f" ORDER BY {d}, {c} LIMIT 1) AS n"
+            f") SELECT debtor_id, creditor_id FROM a"
+        )
+        .columns(debtor_id=db.BigInteger, creditor_id=db.BigInteger)
+        .subquery("accounts")
+    )
+    query = select(accounts.c.debtor_id, accounts.c.creditor_id)
+    if bucket_count > 1:
+        query = query.where(
+            account_bucket_clause(
+                accounts.c.debtor_id,
+                accounts.c.creditor_id,
+                bucket_count,
+                bucket_index,
+            )
+        )
+
+    with db.engine.connect() as conn:
+        with conn.execution_options(yield_per=yield_per).execute(
+                query
+        ) as result:
+            for rows in result.partitions():
+                yield rows
 
 
 def _insert_account_update_signal(
@@ -822,6 +1096,7 @@ def _insert_account_update_signal(
 ) -> None:
     account.last_heartbeat_ts = current_ts
     account.pending_account_update = False
+    _mark_account_as_due(account, current_ts)
 
     db.session.add(
         AccountUpdateSignal(
@@ -849,6 +1124,97 @@ def _insert_account_update_signal(
     )
 
 
+def _lock_accounts(
+    accounts: Iterable[Tuple[int, int]], defer_toasted: bool = False
+) -> List[Account]:
+    # Returns the existing, not deleted accounts, locked in the order
+    # of their primary keys.
+    accounts = sorted(set(accounts))
+    if not accounts:
+        return []
+
+    chosen = Account.choose_rows(accounts)
+    query = (
+        Account.query
+        .join(chosen, ACCOUNT_PK == tuple_(*chosen.c))
+        .order_by(Account.debtor_id, Account.creditor_id)
+    )
+    if defer_toasted:
+        query = query.options(*DEFER_ACCOUNT_TOASTED_COLUMNS)
+
+    return [
+        account
+        for account in query.with_for_update(key_share=True).all()
+        if not account.status_flags & Account.STATUS_DELETED_FLAG
+    ]
+
+
+def _capitalize_interest(
+    account: Account,
+    min_capitalization_interval: timedelta,
+    current_ts: datetime,
+) -> None:
+    capitalization_cutoff_ts = current_ts - min_capitalization_interval
+    if account.last_interest_capitalization_ts <= capitalization_cutoff_ts:
+        accumulated_interest = math.floor(
+            _calc_account_accumulated_interest(account, current_ts)
+        )
+        accumulated_interest = contain_principal_overflow(accumulated_interest)
+
+        if accumulated_interest != 0:
+            account.last_interest_capitalization_ts = current_ts
+            _make_debtor_payment(
+                CT_INTEREST, account, accumulated_interest, current_ts
+            )
+
+
+def _try_to_delete_account(account: Account, current_ts: datetime) -> None:
+    account.last_deletion_attempt_ts = current_ts
+
+    can_be_deleted = False
+    can_be_deleted_if_balance_is_negligible = (
+        account.config_flags & Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG
+        and account.pending_transfers_count == 0
+    )
+    if can_be_deleted_if_balance_is_negligible:
+        if account.creditor_id == ROOT_CREDITOR_ID:  # pragma: nocover
+            # NOTE: The debtor's account will only be deleted if the
+            # remaining principal (that is, the total amount of tokens
+            # in circulation with a negative sign) is exactly zero.
+            # However, if there are regular accounts with negative
+            # balances, it is possible for the deleted debtor's
+            # account to be "resurrected" by an incoming transfer,
+            # with its "scheduled for deletion" flag reset to `False`.
+            # To properly delete the debtor's account in this case,
+            # the debtors agent should automatically schedule the
+            # account for deletion again, in response to the
+            # `AccountUpdate` message sent as a result of the
+            # resurrection of the debtor's account.
+            can_be_deleted = account.principal == 0
+        else:
+            balance = account.calc_current_balance(current_ts)
+            can_be_deleted = is_negligible_balance(
+                balance, account.negligible_amount
+            )
+
+    if can_be_deleted:
+        if account.principal != 0:
+            _make_debtor_payment(
+                CT_DELETE, account, -account.principal, current_ts
+            )
+        _mark_account_as_deleted(account, current_ts)
+
+
+def _mark_account_as_due(account: Account, current_ts: datetime) -> None:
+    # The due accounts scanner will visit the account, and will
+    # calculate when it should be visited again. Note that when the
+    # account is already due, `next_due_ts` is not changed, so that
+    # the index on it does not prevent HOT updates.
+    next_due_ts = account.next_due_ts
+    if next_due_ts is None or next_due_ts > current_ts:
+        account.next_due_ts = current_ts
+
+
 def _create_account(
     debtor_id: int, creditor_id: int, current_ts: datetime
 ) -> Account:
@@ -993,6 +1359,7 @@ def _apply_account_change(
     account.last_change_seqnum = increment_seqnum(account.last_change_seqnum)
     account.last_change_ts = max(account.last_change_ts, current_ts)
     account.pending_account_update = True
+    _mark_account_as_due(account, current_ts)
 
 
 def _make_debtor_payment(
@@ -1,6 +1,8 @@
-from flask import Blueprint, abort
+from flask import Blueprint, abort, request
+from swpt_pythonlib.utils import u64_to_i64, i64_to_u64
 from swpt_accounts import procedures
-from swpt_accounts.models import is_valid_account
+from swpt_accounts.models import is_valid_account, MAX_UINT64
+from swpt_accounts.fetch_api_client import MAX_BULK_REACHABLE_COUNT
 
 HTTP_HEADERS = {
     "Content-Type": "text/plain; charset=utf-8",
@@ -25,6 +27,44 @@ def reachable(debtorId, creditorId):
     return "", status_code, HTTP_HEADERS
 
 
+@fetch_api.route("/reachable", methods=["POST"])
+def reachable_bulk():
+    """Answer many "reachable" queries at once.
+
+    The request body must be a JSON object with an "accounts" field,
+    containing a list of `[debtorId, creditorId]` pairs. The response
+    is a JSON object with two fields: "reachable", which lists the
+    reachable accounts, and "unknown", which lists the accounts that
+    this server is not responsible for.
+
+    """
+    try:
+        accounts = [
+            (_parse_u64(debtor_id), _parse_u64(creditor_id))
+            for debtor_id, creditor_id in request.get_json()["accounts"]
+        ]
+    except (TypeError, KeyError, ValueError):
+        abort(400)
+
+    if len(accounts) > MAX_BULK_REACHABLE_COUNT:
+        abort(400)
+
+    valid_accounts = []
+    unknown_accounts = []
+    for pk in accounts:
+        if is_valid_account(*pk):
+            valid_accounts.append(pk)
+        else:
+            unknown_accounts.append(pk)
+
+    reachable_accounts = procedures.get_reachable_accounts(valid_accounts)
+
+    return {
+        "reachable": _dump_accounts(reachable_accounts),
+        "unknown": _dump_accounts(unknown_accounts),
+    }
+
+
 @fetch_api.route("/<i64:debtorId>/<i64:creditorId>/config")
 def config(debtorId, creditorId):
     if not is_valid_account(debtorId, creditorId):  # pragma: no cover
@@ -33,3 +73,13 @@ def config(debtorId, creditorId):
     config_data = procedures.get_account_config_data(debtorId, creditorId)
     status_code = 404 if config_data is None else 200
     return config_data or "", status_code, HTTP_HEADERS
+
+
+def _parse_u64(value) -> int:
+    if not (isinstance(value, int) and 0 <= value <= MAX_UINT64):
+        raise ValueError
+    return u64_to_i64(value)
+
+
+def _dump_accounts(accounts):
+    return [[i64_to_u64(d), i64_to_u64(c)] for d, c in accounts]
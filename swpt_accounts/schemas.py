@@ -178,6 +178,47 @@ class TryToDeleteAccountMessageSchema(ValidateChoreMessageMixin, Schema):
     """``TryToDeleteAccount`` message schema."""
 
 
+class ValidateChoreBatchMessageMixin:
+    class Meta:
+        unknown = EXCLUDE
+
+    type = fields.String(required=True)
+    accounts = fields.List(
+        fields.Tuple(
+            (
+                fields.Integer(
+                    validate=validate.Range(min=MIN_INT64, max=MAX_INT64)
+                ),
+                fields.Integer(
+                    validate=validate.Range(min=MIN_INT64, max=MAX_INT64)
+                ),
+            )
+        ),
+        required=True,
+        validate=validate.Length(min=1),
+        metadata=dict(
+            description="A list of (debtor ID, creditor ID) pairs.",
+        ),
+    )
+
+    @validates("type")
+    def validate_type(self, value):
+        if f"{value}MessageSchema" != type(self).__name__:
+            raise ValidationError("Invalid type.")
+
+
+class CapitalizeInterestsMessageSchema(
+    ValidateChoreBatchMessageMixin, Schema
+):
+    """``CapitalizeInterests`` message schema."""
+
+
+class TryToDeleteAccountsMessageSchema(
+    ValidateChoreBatchMessageMixin, Schema
+):
+    """``TryToDeleteAccounts`` message schema."""
+
+
 _ROOT_CONFIG_DATA_SCHEMA = RootConfigDataSchema()
 
 
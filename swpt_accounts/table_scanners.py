@@ -1,10 +1,16 @@
+import logging
 import math
+import time
+from itertools import repeat
+from operator import itemgetter
 from base64 import b16encode
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta, timezone, time as dt_time
+from typing import Optional
 from swpt_pythonlib.scan_table import TableScanner
-from sqlalchemy import insert, update, select, delete
+from sqlalchemy import update, select, delete, text, bindparam
 from sqlalchemy.sql.expression import true, tuple_, or_
 from sqlalchemy.orm import load_only
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from flask import current_app
 from swpt_accounts.extensions import db, chores_publisher
 from swpt_accounts.models import (
@@ -15,23 +21,40 @@ from swpt_accounts.models import (
     PreparedTransferSignal,
     RegisteredBalanceChange,
     ROOT_CREDITOR_ID,
+    MIN_INT64,
+    MAX_INT64,
+    T_INFINITY,
     calc_current_balance,
+    calc_k,
     is_negligible_balance,
     contain_principal_overflow,
     is_valid_account,
     DISCARD_PLANS,
+    TableScanCheckpoint,
+    bulk_insert,
+    account_bucket_clause,
 )
 from swpt_accounts.fetch_api_client import get_root_config_data_dict
-from swpt_accounts.chores import create_chore_message
+from swpt_accounts.chores import (
+    create_chore_message,
+    create_chore_batch_messages,
+)
 
-INSERT_BATCH_SIZE = 5000
 PLANS_DISCARD_INTERVAL = timedelta(seconds=10.0)
+MAX_TID = "(4294967295,0)"
+COUNT_TABLE_BLOCKS = text(
+    "SELECT pg_relation_size(CAST(:table_name AS regclass))"
+    " / current_setting('block_size') :: int"
+)
 
 
 class PlansDiscardingTableScanner(TableScanner):
+    columns = None
+
     def __init__(self):
         super().__init__()
         self.latest_plans_discard_ts = datetime.now(tz=timezone.utc)
+        self.progress: Optional[ScanProgress] = None
 
     def _process_rows_done(self):
         db.session.expunge_all()
@@ -46,6 +69,471 @@ class PlansDiscardingTableScanner(TableScanner):
             db.session.close()
             self.latest_plans_discard_ts = current_ts
 
+    def run_worker(
+        self,
+        engine,
+        completion_goal: timedelta,
+        worker_count: int = 1,
+        worker_index: int = 0,
+        max_blocks_per_second: float = 0.0,
+        quit_early: bool = False,
+    ) -> None:
+        """Scan a part of the table, in parallel with other workers.
+
+        The heap blocks of the table are split into `worker_count`
+        contiguous ranges of (almost) equal size, and this worker
+        scans only the range with the given `worker_index`. Each
+        worker paces its queries so that its range is scanned in
+        `completion_goal`, but the combined reading speed of all the
+        workers never exceeds `max_blocks_per_second` (0 means no
+        limit).
+
+        The position reached in the current pass is saved to the
+        database every `APP_SCAN_CHECKPOINT_SECONDS`. When the worker
+        is restarted, it continues the interrupted pass from the saved
+        position, instead of starting a new pass.
+
+        """
+        assert 0 <= worker_index < worker_count
+        goal_seconds = completion_goal.total_seconds()
+        checkpoint_seconds = current_app.config[
+            "APP_SCAN_CHECKPOINT_SECONDS"
+        ]
+        query = select(*(self.columns or self.table.c)).where(
+            text(
+                "ctid >= CAST(:first_tid AS tid)"
+                " AND ctid < CAST(:last_tid AS tid)"
+            )
+        )
+
+        while True:
+            pass_started_at, block_count, next_block = self._start_pass(
+                engine, completion_goal, worker_count, worker_index
+            )
+            started_at = pass_started_at.timestamp()
+            first = block_count * worker_index // worker_count
+            last = block_count * (worker_index + 1) // worker_count
+            is_last_worker = worker_index == worker_count - 1
+            seconds_per_block = goal_seconds / max(last - first, 1)
+            if max_blocks_per_second > 0.0:
+                seconds_per_block = max(
+                    seconds_per_block, worker_count / max_blocks_per_second
+                )
+
+            self.progress = ScanProgress(
+                pass_started_at=pass_started_at,
+                first_block=first,
+                last_block=last,
+                next_block=max(next_block, first),
+                seconds_per_block=seconds_per_block,
+            )
+            # NOTE: When a pass is continued after a long pause, the
+            # remaining blocks are still scanned at the planned speed.
+            paced_from = max(
+                started_at,
+                time.time() - (max(next_block, first) - first)
+                * seconds_per_block,
+            )
+            checkpoint_at = time.time() + checkpoint_seconds
+            blocks_per_query = max(self.blocks_per_query, 1)
+            for start in range(
+                max(next_block, first),
+                max(last, first + 1),
+                blocks_per_query,
+            ):
+                stop = min(start + blocks_per_query, last)
+
+                # NOTE: The last worker also scans the blocks which
+                # have been added to the table after the beginning of
+                # the pass.
+                last_tid = (
+                    MAX_TID
+                    if is_last_worker and stop >= last
+                    else f"({stop},0)"
+                )
+                with engine.connect() as conn:
+                    rows = conn.execute(
+                        query,
+                        {"first_tid": f"({start},0)", "last_tid": last_tid},
+                    ).mappings().all()
+
+                if rows:
+                    self.process_rows(rows)
+
+                self.progress.observe_scanned(max(stop, start + 1))
+                if time.time() >= checkpoint_at:
+                    self._save_checkpoint(
+                        engine, worker_count, worker_index, block_count
+                    )
+                    checkpoint_at = time.time() + checkpoint_seconds
+
+                delay = (
+                    paced_from + (stop - first) * seconds_per_block
+                    - time.time()
+                )
+                if delay > 0.0:
+                    time.sleep(delay)
+
+            self.progress.observe_scanned(last)
+            self._save_checkpoint(
+                engine, worker_count, worker_index, block_count
+            )
+            if quit_early:
+                break
+
+            delay = started_at + goal_seconds - time.time()
+            if delay > 0.0:
+                time.sleep(delay)
+
+    def _start_pass(
+        self, engine, completion_goal, worker_count, worker_index
+    ):
+        # Returns the start time, the table size (in blocks), and the
+        # next block to scan, for the current pass. An interrupted
+        # pass is continued, unless it has been completed already.
+        current_ts = datetime.now(tz=timezone.utc)
+        cp = TableScanCheckpoint
+        with engine.connect() as conn:
+            checkpoint = conn.execute(
+                select(cp.pass_started_at, cp.block_count, cp.next_block)
+                .where(
+                    cp.table_name == self.table.name,
+                    cp.worker_count == worker_count,
+                    cp.worker_index == worker_index,
+                )
+            ).one_or_none()
+
+            if checkpoint is not None:
+                pass_started_at, block_count, next_block = checkpoint
+                last = block_count * (worker_index + 1) // worker_count
+                is_completed = next_block >= last
+                if not (
+                    is_completed
+                    and pass_started_at + completion_goal <= current_ts
+                ):
+                    logging.getLogger(__name__).info(
+                        "Continuing the %s pass started at %s.",
+                        self.table.name,
+                        pass_started_at.isoformat(),
+                    )
+                    return pass_started_at, block_count, next_block
+
+            block_count = conn.execute(
+                COUNT_TABLE_BLOCKS, {"table_name": self.table.name}
+            ).scalar_one()
+
+        return current_ts, block_count, 0
+
+    def _save_checkpoint(
+        self, engine, worker_count, worker_index, block_count
+    ):
+        progress = self.progress
+        values = {
+            "pass_started_at": progress.pass_started_at,
+            "block_count": block_count,
+            "next_block": progress.next_block,
+            "estimated_finish_at": progress.estimated_finish_at,
+        }
+        with engine.begin() as conn:
+            conn.execute(
+                pg_insert(TableScanCheckpoint)
+                .values(
+                    table_name=self.table.name,
+                    worker_count=worker_count,
+                    worker_index=worker_index,
+                    **values,
+                )
+                .on_conflict_do_update(
+                    index_elements=[
+                        TableScanCheckpoint.table_name,
+                        TableScanCheckpoint.worker_count,
+                        TableScanCheckpoint.worker_index,
+                    ],
+                    set_=values,
+                )
+            )
+
+        logging.getLogger(__name__).info(
+            "Scanned %.1f%% of %s (worker %i of %i). The pass is expected"
+            " to finish at %s.",
+            progress.percent,
+            self.table.name,
+            worker_index + 1,
+            worker_count,
+            progress.estimated_finish_at.isoformat(),
+        )
+
+
+class ScanProgress:
+    """The progress of a table scanner worker in its current pass.
+
+    The estimated finish time is calculated from the planned reading
+    speed (`seconds_per_block`), or from the reading speed observed
+    since the worker has been started, whichever is slower.
+
+    """
+
+    def __init__(
+        self,
+        pass_started_at: datetime,
+        first_block: int,
+        last_block: int,
+        next_block: int,
+        seconds_per_block: float,
+    ):
+        self.pass_started_at = pass_started_at
+        self.first_block = first_block
+        self.last_block = last_block
+        self.next_block = next_block
+        self.seconds_per_block = seconds_per_block
+        self._resumed_at = time.time()
+        self._resumed_block = next_block
+
+    def observe_scanned(self, next_block: int) -> None:
+        """Register that all the blocks before `next_block` have been
+        scanned."""
+
+        self.next_block = min(
+            max(next_block, self.next_block), self.last_block
+        )
+
+    @property
+    def percent(self) -> float:
+        """The completed part of the pass, in percents."""
+
+        total = self.last_block - self.first_block
+        if total <= 0:
+            return 100.0
+        return 100.0 * (self.next_block - self.first_block) / total
+
+    @property
+    def estimated_finish_at(self) -> datetime:
+        """The moment at which the pass is expected to be completed."""
+
+        current_time = time.time()
+        scanned_blocks = self.next_block - self._resumed_block
+        seconds_per_block = self.seconds_per_block
+        if scanned_blocks > 0:
+            seconds_per_block = max(
+                seconds_per_block,
+                (current_time - self._resumed_at) / scanned_blocks,
+            )
+
+        remaining_seconds = (
+            (self.last_block - self.next_block) * seconds_per_block
+        )
+        return datetime.fromtimestamp(
+            current_time + remaining_seconds, tz=timezone.utc
+        )
+
+
+def exceeds_max_interest_ratio(
+    *,
+    creditor_id: int,
+    principal: int,
+    interest: float,
+    interest_rate: float,
+    last_change_ts: datetime,
+    current_ts: datetime,
+    max_ratio: float,
+) -> bool:
+    """Return whether the accumulated interest on the account, divided
+    by the principal, exceeds `max_ratio`."""
+
+    current_balance = calc_current_balance(
+        creditor_id=creditor_id,
+        principal=principal,
+        interest=interest,
+        interest_rate=interest_rate,
+        last_change_ts=last_change_ts,
+        current_ts=current_ts,
+    )
+    accumulated_interest = abs(
+        contain_principal_overflow(math.floor(current_balance - principal))
+    )
+    return accumulated_interest / (1 + abs(principal)) > max_ratio
+
+
+def calc_max_interest_ratio_ts(
+    *,
+    creditor_id: int,
+    principal: int,
+    interest: float,
+    interest_rate: float,
+    last_change_ts: datetime,
+    max_ratio: float,
+) -> datetime:
+    """Return the earliest moment at which `exceeds_max_interest_ratio`
+    could become true, if the account does not change meanwhile.
+
+    The returned moment may be a bit earlier than the real one, but
+    never later. It can be in the past, and is `T_INFINITY` when the
+    accumulated interest will never exceed the maximum.
+
+    """
+    if creditor_id == ROOT_CREDITOR_ID:
+        return T_INFINITY
+
+    # NOTE: `math.floor()` is applied to the accumulated interest
+    # before comparing it, and therefore, the ratio can be exceeded
+    # when the interest is above `threshold`, or below
+    # `-threshold + 1`.
+    threshold = max_ratio * (1 + abs(principal))
+    balance = principal + interest
+    if not -threshold + 1 <= interest <= threshold:
+        return last_change_ts
+
+    k = calc_k(interest_rate)
+    if balance <= 0 or k == 0.0:
+        # The accumulated interest will not change.
+        return T_INFINITY
+
+    # The accumulated interest changes monotonically with time.
+    target_balance = (
+        principal + threshold if k > 0.0 else principal - threshold + 1
+    )
+    if target_balance <= 0:
+        return T_INFINITY
+
+    seconds = math.log(target_balance / balance) / k
+    seconds = max(seconds * (1.0 - AccountsBlock.RELATIVE_ERROR) - 1.0, 0.0)
+    if seconds >= (T_INFINITY - last_change_ts).total_seconds():
+        return T_INFINITY
+
+    return last_change_ts + timedelta(seconds=seconds)
+
+
+class AccountsBlock:
+    """A block of account rows, converted to columns.
+
+    The values are extracted from the rows only once, and then every
+    pass of `AccountScanner.process_rows` works on the columns. The
+    accumulated interest is calculated with floats, together with an
+    upper bound of the rounding error. Only when the error could
+    change the result, the exact calculation (with `Decimal`s) is
+    done.
+
+    NOTE: The float calculation is done in a single loop over the
+    selected rows. Splitting it into column-wise steps (`map` over
+    `array`s) was measured to be slower, because every step is one
+    more pass over the values.
+
+    """
+
+    # The relative error of the float calculations is much smaller
+    # than this.
+    RELATIVE_ERROR = 1e-12
+
+    def __init__(self, rows, columns):
+        self.size = len(rows)
+
+        # NOTE: The rows are `RowMapping`s from Core queries, which
+        # can not be indexed by ORM attributes (like
+        # `Account.debtor_id`). Therefore, the values are obtained by
+        # the table columns having the same keys.
+        table_columns = Account.__table__.c
+        get_values = itemgetter(*(table_columns[c.key] for c in columns))
+        values = zip(*map(get_values, rows)) if rows else repeat(())
+        for column, column_values in zip(columns, values):
+            setattr(self, column.key, list(column_values))
+
+        deleted_flag = Account.STATUS_DELETED_FLAG
+        self.is_deleted = [bool(f & deleted_flag) for f in self.status_flags]
+
+    def mark_as_heartbeated(self, pks: set, current_ts: datetime) -> None:
+        """Update the columns of the accounts with the given primary
+        keys, after an `AccountUpdateSignal` has been sent for each
+        one of them."""
+
+        last_heartbeat_tss = self.last_heartbeat_ts
+        pending_account_updates = self.pending_account_update
+        for i, pk in enumerate(zip(self.debtor_id, self.creditor_id)):
+            if pk in pks:
+                last_heartbeat_tss[i] = current_ts
+                pending_account_updates[i] = False
+
+    def exceed_max_interest_ratio(
+        self, indexes: list[int], current_ts: datetime, max_ratio: float
+    ) -> list[bool]:
+        """For each one of the given row indexes, return whether the
+        accumulated interest, divided by the principal, exceeds
+        `max_ratio`.
+
+        The result is always the same as the result from
+        `exceeds_max_interest_ratio`.
+
+        """
+        creditor_ids = self.creditor_id
+        principals = self.principal
+        interests = self.interest
+        interest_rates = self.interest_rate
+        last_change_tss = self.last_change_ts
+        relative_error = self.RELATIVE_ERROR
+        k_by_rate = {}
+        results = []
+
+        for i in indexes:
+            if creditor_ids[i] == ROOT_CREDITOR_ID:
+                # Interest is not accumulated on the debtor's account.
+                results.append(False)
+                continue
+
+            principal = principals[i]
+            interest = interests[i]
+            interest_rate = interest_rates[i]
+            balance = principal + interest
+            error = relative_error * (abs(principal) + abs(interest))
+            if abs(balance) <= error:
+                # The sign of the balance is not certain.
+                lowest, highest = MIN_INT64, MAX_INT64
+            else:
+                if balance > 0:
+                    try:
+                        k = k_by_rate[interest_rate]
+                    except KeyError:
+                        k = k_by_rate[interest_rate] = calc_k(interest_rate)
+                    passed_seconds = max(
+                        0.0,
+                        (current_ts - last_change_tss[i]).total_seconds(),
+                    )
+                    factor = math.exp(k * passed_seconds)
+                    balance *= factor
+                    error *= max(factor, 1.0)
+
+                # The exact accumulated interest (rounded down) is
+                # between `lowest` and `highest`.
+                accumulated_interest = balance - principal
+                lowest = contain_principal_overflow(
+                    math.floor(accumulated_interest - error)
+                )
+                highest = contain_principal_overflow(
+                    math.floor(accumulated_interest + error)
+                )
+
+            max_abs = max(abs(lowest), abs(highest))
+            min_abs = (
+                0 if lowest <= 0 <= highest else min(abs(lowest), abs(highest))
+            )
+            divisor = 1 + abs(principal)
+            if min_abs / divisor > max_ratio:
+                results.append(True)
+            elif max_abs / divisor <= max_ratio:
+                results.append(False)
+            else:
+                results.append(
+                    exceeds_max_interest_ratio(
+                        creditor_id=creditor_ids[i],
+                        principal=principal,
+                        interest=interest,
+                        interest_rate=interest_rate,
+                        last_change_ts=last_change_tss[i],
+                        current_ts=current_ts,
+                        max_ratio=max_ratio,
+                    )
+                )
+
+        return results
+
 
 class AccountScanner(PlansDiscardingTableScanner):
     """Sends account heartbeat signals, purge deleted accounts."""
@@ -73,6 +561,11 @@ class AccountScanner(PlansDiscardingTableScanner):
         Account.debtor_info_sha256,
     ]
 
+    due_columns = columns + [
+        Account.last_change_seqnum,
+        Account.next_due_ts,
+    ]
+
     def __init__(self):
         super().__init__()
         message_max_delay = timedelta(
@@ -104,6 +597,9 @@ class AccountScanner(PlansDiscardingTableScanner):
         self.min_interest_cap_interval = timedelta(
             days=current_app.config["APP_MIN_INTEREST_CAPITALIZATION_DAYS"]
         )
+        self.due_accounts_revisit_interval = timedelta(
+            minutes=current_app.config["APP_SCAN_DUE_ACCOUNTS_REVISIT_MINUTES"]
+        )
 
         # To prevent clogging the signal bus with heartbeat signals,
         # we ensure that the account heartbeat interval is not shorter
@@ -113,25 +609,169 @@ class AccountScanner(PlansDiscardingTableScanner):
         )
 
         assert self.max_interest_to_principal_ratio > 0.0
+        assert self.due_accounts_revisit_interval > timedelta(0)
 
     @property
     def blocks_per_query(self) -> int:
         return current_app.config["APP_ACCOUNTS_SCAN_BLOCKS_PER_QUERY"]
 
-    @property
-    def target_beat_duration(self) -> int:
-        return current_app.config["APP_ACCOUNTS_SCAN_BEAT_MILLISECS"]
-
     def process_rows(self, rows):
         current_ts = datetime.now(tz=timezone.utc)
+        self._process_accounts(rows, self.columns, current_ts)
+        self._process_rows_done()
+
+    def process_due_rows(self, rows):
+        current_ts = datetime.now(tz=timezone.utc)
+        block = self._process_accounts(rows, self.due_columns, current_ts)
+        self._schedule_next_visits(block, current_ts)
+        self._process_rows_done()
+
+    def run_due(
+        self,
+        engine,
+        wait: float,
+        bucket_count: int = 1,
+        bucket_index: int = 0,
+        quit_early: bool = False,
+    ) -> None:
+        """Visit only the accounts whose `next_due_ts` has passed.
+
+        The due accounts are obtained from an index, in batches of
+        `APP_SCAN_DUE_ACCOUNTS_BATCH_SIZE`, and after the maintenance
+        operations have been executed, the moment of the next visit
+        is calculated for each one of the visited accounts. Thus, the
+        cost of the scanning depends on the amount of due work, not on
+        the size of the table. When there are no more due accounts,
+        the scanner waits `wait` seconds before querying the index
+        again.
+
+        Several scanners can share the load by visiting only the
+        accounts in their own bucket (see `bucket_count` and
+        `bucket_index`).
+
+        """
+        batch_size = current_app.config["APP_SCAN_DUE_ACCOUNTS_BATCH_SIZE"]
+        query = (
+            select(*self.due_columns)
+            .where(Account.next_due_ts <= bindparam("current_ts"))
+            .order_by(Account.next_due_ts)
+            .limit(batch_size)
+        )
+        if bucket_count > 1:
+            query = query.where(
+                account_bucket_clause(
+                    Account.debtor_id,
+                    Account.creditor_id,
+                    bucket_count,
+                    bucket_index,
+                )
+            )
+
+        while True:
+            current_ts = datetime.now(tz=timezone.utc)
+            with engine.connect() as conn:
+                rows = conn.execute(
+                    query, {"current_ts": current_ts}
+                ).mappings().all()
+
+            if rows:
+                self.process_due_rows(rows)
+
+            if len(rows) < batch_size:
+                if quit_early:
+                    break
+                time.sleep(wait)
+
+    def _process_accounts(self, rows, columns, current_ts):
         if current_app.config["DELETE_PARENT_SHARD_RECORDS"]:
             self._delete_parent_shard_accounts(rows, current_ts)
-        self._purge_accounts(rows, current_ts)
-        self._send_heartbeats(rows, current_ts)
-        self._delete_accounts(rows, current_ts)
-        self._capitalize_interests(rows, current_ts)
-        self._change_debtor_settings(rows, current_ts)
-        self._process_rows_done()
+        block = AccountsBlock(rows, columns)
+        self._purge_accounts(block, current_ts)
+        self._send_heartbeats(block, current_ts)
+        self._delete_accounts(block, current_ts)
+        self._capitalize_interests(block, current_ts)
+        self._change_debtor_settings(block, current_ts)
+        return block
+
+    def _calc_next_visit_ts(self, block, i, current_ts):
+        if not is_valid_account(block.debtor_id[i], block.creditor_id[i]):
+            # Accounts that do not belong to this shard are never
+            # due. They are deleted by the regular accounts scanner.
+            return T_INFINITY
+
+        if block.is_deleted[i]:
+            creation_ts = datetime.combine(
+                block.creation_date[i], dt_time(), tzinfo=timezone.utc
+            )
+            return max(
+                block.last_change_ts[i] + self.account_purge_delay,
+                creation_ts + timedelta(days=1) + self.few_days_interval,
+            )
+
+        if block.pending_account_update[i]:
+            return current_ts
+
+        next_visit_ts = (
+            block.last_heartbeat_ts[i] + self.account_heartbeat_interval
+        )
+        if block.config_flags[i] & Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG:
+            next_visit_ts = min(
+                next_visit_ts,
+                block.last_deletion_attempt_ts[i]
+                + self.deletion_attempts_min_interval,
+            )
+
+        capitalization_ts = max(
+            block.last_interest_capitalization_ts[i]
+            + self.min_interest_cap_interval,
+            calc_max_interest_ratio_ts(
+                creditor_id=block.creditor_id[i],
+                principal=block.principal[i],
+                interest=block.interest[i],
+                interest_rate=block.interest_rate[i],
+                last_change_ts=block.last_change_ts[i],
+                max_ratio=self.max_interest_to_principal_ratio,
+            ),
+        )
+        return min(next_visit_ts, capitalization_ts)
+
+    def _schedule_next_visits(self, block, current_ts):
+        # NOTE: The next visit is scheduled not sooner than
+        # `due_accounts_revisit_interval`. Thus, when a maintenance
+        # operation is performed asynchronously (by a chore), the
+        # account will not be visited again and again, before the
+        # chore has been processed.
+        min_next_visit_ts = current_ts + self.due_accounts_revisit_interval
+        c = self.table.c
+        to_update = [
+            {
+                "b_debtor_id": block.debtor_id[i],
+                "b_creditor_id": block.creditor_id[i],
+                "b_last_change_seqnum": block.last_change_seqnum[i],
+                "b_next_due_ts": block.next_due_ts[i],
+                "b_new_next_due_ts": max(
+                    self._calc_next_visit_ts(block, i, current_ts),
+                    min_next_visit_ts,
+                ),
+            }
+            for i in range(block.size)
+        ]
+
+        # NOTE: When the account has been changed after it has been
+        # read, it will not be updated here. It has been made due
+        # again by the change, and will be visited again soon.
+        db.session.execute(
+            update(self.table)
+            .where(
+                c.debtor_id == bindparam("b_debtor_id"),
+                c.creditor_id == bindparam("b_creditor_id"),
+                c.last_change_seqnum == bindparam("b_last_change_seqnum"),
+                c.next_due_ts == bindparam("b_next_due_ts"),
+            )
+            .values(next_due_ts=bindparam("b_new_next_due_ts")),
+            to_update,
+        )
+        db.session.commit()
 
     def _delete_parent_shard_accounts(self, rows, current_ts):
         c = self.table.c
@@ -165,13 +805,7 @@ class AccountScanner(PlansDiscardingTableScanner):
 
             db.session.commit()
 
-    def _purge_accounts(self, rows, current_ts):
-        c = self.table.c
-        c_debtor_id = c.debtor_id
-        c_creditor_id = c.creditor_id
-        c_status_flags = c.status_flags
-        c_last_change_ts = c.last_change_ts
-        c_creation_date = c.creation_date
+    def _purge_accounts(self, block, current_ts):
         deleted_flag = Account.STATUS_DELETED_FLAG
         date_few_days_ago = (current_ts - self.few_days_interval).date()
         purge_cutoff_ts = current_ts - self.account_purge_delay
@@ -181,13 +815,25 @@ class AccountScanner(PlansDiscardingTableScanner):
         # the same as the `creation_date` of the old account. We need
         # to make sure this never happens.
         pks_to_purge = [
-            (row[c_debtor_id], row[c_creditor_id])
-            for row in rows
+            (debtor_id, creditor_id)
+            for (
+                debtor_id,
+                creditor_id,
+                is_deleted,
+                last_change_ts,
+                creation_date,
+            ) in zip(
+                block.debtor_id,
+                block.creditor_id,
+                block.is_deleted,
+                block.last_change_ts,
+                block.creation_date,
+            )
             if (
-                row[c_status_flags] & deleted_flag
-                and row[c_last_change_ts] < purge_cutoff_ts
-                and row[c_creation_date] < date_few_days_ago
-                and is_valid_account(row[c_debtor_id], row[c_creditor_id])
+                is_deleted
+                and last_change_ts < purge_cutoff_ts
+                and creation_date < date_few_days_ago
+                and is_valid_account(debtor_id, creditor_id)
             )
         ]
 
@@ -218,37 +864,36 @@ class AccountScanner(PlansDiscardingTableScanner):
                     )
                     db.session.delete(account)
 
-                db.session.execute(
-                    insert(AccountPurgeSignal)
-                    .execution_options(
-                        insertmanyvalues_page_size=INSERT_BATCH_SIZE,
-                        synchronize_session=False,
-                    ),
-                    to_insert,
-                )
+                bulk_insert(AccountPurgeSignal, to_insert)
 
             db.session.commit()
 
-    def _send_heartbeats(self, rows, current_ts):
-        c = self.table.c
-        c_debtor_id = c.debtor_id
-        c_creditor_id = c.creditor_id
-        c_status_flags = c.status_flags
-        c_last_heartbeat_ts = c.last_heartbeat_ts
-        c_pending_account_update = c.pending_account_update
+    def _send_heartbeats(self, block, current_ts):
         deleted_flag = Account.STATUS_DELETED_FLAG
         heartbeat_cutoff_ts = current_ts - self.account_heartbeat_interval
 
         pks_to_heartbeat = [
-            (row[c_debtor_id], row[c_creditor_id])
-            for row in rows
+            (debtor_id, creditor_id)
+            for (
+                debtor_id,
+                creditor_id,
+                is_deleted,
+                last_heartbeat_ts,
+                pending_account_update,
+            ) in zip(
+                block.debtor_id,
+                block.creditor_id,
+                block.is_deleted,
+                block.last_heartbeat_ts,
+                block.pending_account_update,
+            )
             if (
-                not row[c_status_flags] & deleted_flag
+                not is_deleted
                 and (
-                    row[c_last_heartbeat_ts] < heartbeat_cutoff_ts
-                    or row[c_pending_account_update]
+                    last_heartbeat_ts < heartbeat_cutoff_ts
+                    or pending_account_update
                 )
-                and is_valid_account(row[c_debtor_id], row[c_creditor_id])
+                and is_valid_account(debtor_id, creditor_id)
             )
         ]
 
@@ -273,6 +918,7 @@ class AccountScanner(PlansDiscardingTableScanner):
                     (account.debtor_id, account.creditor_id)
                     for account in to_heartbeat
                 ]
+                block.mark_as_heartbeated(set(pks_to_remind), current_ts)
                 to_update = Account.choose_rows(pks_to_remind)
                 db.session.execute(
                     update(Account)
@@ -284,12 +930,8 @@ class AccountScanner(PlansDiscardingTableScanner):
                     )
                 )
 
-                db.session.execute(
-                    insert(AccountUpdateSignal)
-                    .execution_options(
-                        insertmanyvalues_page_size=INSERT_BATCH_SIZE,
-                        synchronize_session=False,
-                    ),
+                bulk_insert(
+                    AccountUpdateSignal,
                     [
                         dict(
                             debtor_id=account.debtor_id,
@@ -327,159 +969,128 @@ class AccountScanner(PlansDiscardingTableScanner):
 
             db.session.commit()
 
-    def _delete_accounts(self, rows, current_ts):
-        c = self.table.c
-        c_debtor_id = c.debtor_id
-        c_creditor_id = c.creditor_id
-        c_last_deletion_attempt_ts = c.last_deletion_attempt_ts
-        c_status_flags = c.status_flags
-        c_config_flags = c.config_flags
-        c_negligible_amount = c.negligible_amount
-        c_principal = c.principal
-        c_interest = c.interest
-        c_interest_rate = c.interest_rate
-        c_last_change_ts = c.last_change_ts
+    def _delete_accounts(self, block, current_ts):
         scheduled_for_deletion_flag = (
             Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG
         )
-        deleted_flag = Account.STATUS_DELETED_FLAG
         cutoff_ts = current_ts - self.deletion_attempts_min_interval
-        chores = []
-
-        for row in rows:
-            creditor_id = row[c_creditor_id]
-            should_be_deleted = False
-            should_be_deleted_if_balance_is_negligible = (
-                row[c_last_deletion_attempt_ts] <= cutoff_ts
-                and row[c_config_flags] & scheduled_for_deletion_flag
-                and not row[c_status_flags] & deleted_flag
-            )
-            if should_be_deleted_if_balance_is_negligible:
-                if creditor_id == ROOT_CREDITOR_ID:  # pragma: nocover
-                    should_be_deleted = row[c_principal] == 0
-                else:
-                    balance = calc_current_balance(
-                        creditor_id=creditor_id,
-                        principal=row[c_principal],
-                        interest=row[c_interest],
-                        interest_rate=row[c_interest_rate],
-                        last_change_ts=row[c_last_change_ts],
-                        current_ts=current_ts,
-                    )
-                    should_be_deleted = is_negligible_balance(
-                        balance, row[c_negligible_amount]
-                    )
-
-            if should_be_deleted:
-                chores.append(
-                    create_chore_message(
-                        {
-                            "type": "TryToDeleteAccount",
-                            "debtor_id": row[c_debtor_id],
-                            "creditor_id": creditor_id,
-                        }
+        pks_to_delete = []
+
+        # NOTE: Very few accounts are scheduled for deletion, so the
+        # balances of the candidates are calculated one by one.
+        candidates = [
+            i
+            for i, (last_deletion_attempt_ts, config_flags, is_deleted) in (
+                enumerate(
+                    zip(
+                        block.last_deletion_attempt_ts,
+                        block.config_flags,
+                        block.is_deleted,
                     )
                 )
-
-        chores_publisher.publish_messages(chores)
-
-    def _capitalize_interests(self, rows, current_ts):
-        c = self.table.c
-        c_debtor_id = c.debtor_id
-        c_creditor_id = c.creditor_id
-        c_last_interest_capitalization_ts = c.last_interest_capitalization_ts
-        c_principal = c.principal
-        c_interest = c.interest
-        c_interest_rate = c.interest_rate
-        c_last_change_ts = c.last_change_ts
-        c_status_flags = c.status_flags
-        deleted_flag = Account.STATUS_DELETED_FLAG
-        cutoff_ts = current_ts - self.min_interest_cap_interval
-        max_ratio = self.max_interest_to_principal_ratio
-        chores = []
-
-        for row in rows:
-            creditor_id = row[c_creditor_id]
-            can_capitalize_interest = (
-                creditor_id != ROOT_CREDITOR_ID
-                and row[c_last_interest_capitalization_ts] <= cutoff_ts
-                and not row[c_status_flags] & deleted_flag
             )
-            if can_capitalize_interest:
-                current_balance = calc_current_balance(
+            if (
+                last_deletion_attempt_ts <= cutoff_ts
+                and config_flags & scheduled_for_deletion_flag
+                and not is_deleted
+            )
+        ]
+        for i in candidates:
+            creditor_id = block.creditor_id[i]
+            if creditor_id == ROOT_CREDITOR_ID:  # pragma: nocover
+                should_be_deleted = block.principal[i] == 0
+            else:
+                balance = calc_current_balance(
                     creditor_id=creditor_id,
-                    principal=row[c_principal],
-                    interest=row[c_interest],
-                    interest_rate=row[c_interest_rate],
-                    last_change_ts=row[c_last_change_ts],
+                    principal=block.principal[i],
+                    interest=block.interest[i],
+                    interest_rate=block.interest_rate[i],
+                    last_change_ts=block.last_change_ts[i],
                     current_ts=current_ts,
                 )
-                accumulated_interest = abs(
-                    contain_principal_overflow(
-                        math.floor(current_balance - row[c_principal])
-                    )
+                should_be_deleted = is_negligible_balance(
+                    balance, block.negligible_amount[i]
                 )
-                ratio = accumulated_interest / (1 + abs(row[c_principal]))
 
-                if ratio > max_ratio:
-                    chores.append(
-                        create_chore_message(
-                            {
-                                "type": "CapitalizeInterest",
-                                "debtor_id": row[c_debtor_id],
-                                "creditor_id": creditor_id,
-                            }
-                        )
+            if should_be_deleted:
+                pks_to_delete.append((block.debtor_id[i], creditor_id))
+
+        chores_publisher.publish_messages(
+            create_chore_batch_messages("TryToDeleteAccounts", pks_to_delete)
+        )
+
+    def _capitalize_interests(self, block, current_ts):
+        cutoff_ts = current_ts - self.min_interest_cap_interval
+        candidates = [
+            i
+            for i, (creditor_id, last_capitalization_ts, is_deleted) in (
+                enumerate(
+                    zip(
+                        block.creditor_id,
+                        block.last_interest_capitalization_ts,
+                        block.is_deleted,
                     )
+                )
+            )
+            if (
+                creditor_id != ROOT_CREDITOR_ID
+                and last_capitalization_ts <= cutoff_ts
+                and not is_deleted
+            )
+        ]
+        exceed_max_ratio = block.exceed_max_interest_ratio(
+            candidates, current_ts, self.max_interest_to_principal_ratio
+        )
+        pks_to_capitalize = [
+            (block.debtor_id[i], block.creditor_id[i])
+            for i, exceeds in zip(candidates, exceed_max_ratio)
+            if exceeds
+        ]
 
-        chores_publisher.publish_messages(chores)
+        chores_publisher.publish_messages(
+            create_chore_batch_messages(
+                "CapitalizeInterests", pks_to_capitalize
+            )
+        )
 
-    def _change_debtor_settings(self, rows, current_ts):
-        c = self.table.c
-        c_debtor_id = c.debtor_id
-        c_creditor_id = c.creditor_id
-        c_last_interest_rate_change_ts = c.last_interest_rate_change_ts
-        c_status_flags = c.status_flags
-        c_interest_rate = c.interest_rate
-        c_debtor_info_iri = c.debtor_info_iri
-        c_debtor_info_content_type = c.debtor_info_content_type
-        c_debtor_info_sha256 = c.debtor_info_sha256
-        deleted_flag = Account.STATUS_DELETED_FLAG
+    def _change_debtor_settings(self, block, current_ts):
         interest_rate_change_cutoff_ts = (
             current_ts - self.interest_rate_change_min_interval
         )
 
-        def should_change_interest_rate(row, current_interest_rate):
+        def should_change_interest_rate(i, current_interest_rate):
             return (
-                row[c_interest_rate] != current_interest_rate
-                and row[c_last_interest_rate_change_ts]
+                block.interest_rate[i] != current_interest_rate
+                and block.last_interest_rate_change_ts[i]
                 <= interest_rate_change_cutoff_ts
-                and not row[c_status_flags] & deleted_flag
+                and not block.is_deleted[i]
             )
 
         def should_update_debtor_info(
-            row, debtor_info_iri, debtor_info_content_type, debtor_info_sha256
+            i, debtor_info_iri, debtor_info_content_type, debtor_info_sha256
         ):
-            return not row[c_status_flags] & deleted_flag and (
-                row[c_debtor_info_iri] != debtor_info_iri
-                or row[c_debtor_info_content_type] != debtor_info_content_type
-                or row[c_debtor_info_sha256] != debtor_info_sha256
+            return not block.is_deleted[i] and (
+                block.debtor_info_iri[i] != debtor_info_iri
+                or (
+                    block.debtor_info_content_type[i]
+                    != debtor_info_content_type
+                )
+                or block.debtor_info_sha256[i] != debtor_info_sha256
             )
 
-        debtor_ids = {row[c_debtor_id] for row in rows}
-        config_data_dict = get_root_config_data_dict(debtor_ids)
+        config_data_dict = get_root_config_data_dict(set(block.debtor_id))
         chores = []
 
-        for row in rows:
-            creditor_id = row[c_creditor_id]
+        for i, (debtor_id, creditor_id) in enumerate(
+            zip(block.debtor_id, block.creditor_id)
+        ):
             if creditor_id == ROOT_CREDITOR_ID:
                 continue
 
-            debtor_id = row[c_debtor_id]
             config_data = config_data_dict.get(debtor_id)
             if config_data:
                 interest_rate = config_data.interest_rate_target
-                if should_change_interest_rate(row, interest_rate):
+                if should_change_interest_rate(i, interest_rate):
                     chores.append(
                         create_chore_message(
                             {
@@ -496,7 +1107,7 @@ class AccountScanner(PlansDiscardingTableScanner):
                 debtor_info_content_type = config_data.info_content_type
                 debtor_info_sha256 = config_data.info_sha256
                 if should_update_debtor_info(
-                    row,
+                    i,
                     debtor_info_iri,
                     debtor_info_content_type,
                     debtor_info_sha256,
@@ -553,10 +1164,6 @@ class PreparedTransferScanner(PlansDiscardingTableScanner):
             "APP_PREPARED_TRANSFERS_SCAN_BLOCKS_PER_QUERY"
         ]
 
-    @property
-    def target_beat_duration(self) -> int:
-        return current_app.config["APP_PREPARED_TRANSFERS_SCAN_BEAT_MILLISECS"]
-
     def process_rows(self, rows):
         c = self.table.c
         c_debtor_id = c.debtor_id
@@ -628,12 +1235,8 @@ class PreparedTransferScanner(PlansDiscardingTableScanner):
                     .where(self.pk == tuple_(*to_update.c))
                     .values(last_reminder_ts=current_ts)
                 )
-                db.session.execute(
-                    insert(PreparedTransferSignal)
-                    .execution_options(
-                        insertmanyvalues_page_size=INSERT_BATCH_SIZE,
-                        synchronize_session=False,
-                    ),
+                bulk_insert(
+                    PreparedTransferSignal,
                     [
                         v
                         for k, v in prepared_transfer_signal_mappings.items()
@@ -668,12 +1271,6 @@ class RegisteredBalanceChangeScanner(PlansDiscardingTableScanner):
             "APP_REGISTERED_BALANCE_CHANGES_SCAN_BLOCKS_PER_QUERY"
         ]
 
-    @property
-    def target_beat_duration(self) -> int:
-        return current_app.config[
-            "APP_REGISTERED_BALANCE_CHANGES_SCAN_BEAT_MILLISECS"
-        ]
-
     def process_rows(self, rows):
         c = self.table.c
         c_debtor_id = c.debtor_id
@@ -4,6 +4,7 @@ import flask_migrate
 from datetime import datetime, timezone
 from swpt_accounts import create_app
 from swpt_accounts.extensions import db
+from swpt_accounts.fetch_api_client import _clear_reachability
 
 server_name = "example.com"
 config_dict = {
@@ -21,6 +22,14 @@ config_dict = {
 
 def pytest_addoption(parser):
     parser.addoption("--use-pgplsql", action="store", default="false")
+    parser.addoption(
+        "--benchmark-output",
+        action="store",
+        default=None,
+        help="Run the benchmarks, and write the results to this file.",
+    )
+    parser.addoption("--benchmark-accounts", action="store", default="1000")
+    parser.addoption("--benchmark-rows", action="store", default="3")
 
 
 @pytest.fixture(scope="module")
@@ -43,6 +52,7 @@ def db_session(app):
     yield db.session
 
     # Cleanup:
+    _clear_reachability()
     db.session.remove()
     for cmd in [
         "TRUNCATE TABLE account CASCADE",
@@ -58,6 +68,7 @@ def db_session(app):
         "TRUNCATE TABLE account_purge_signal",
         "TRUNCATE TABLE rejected_config_signal",
         "TRUNCATE TABLE pending_balance_change_signal",
+        "TRUNCATE TABLE table_scan_checkpoint",
     ]:
         db.session.execute(sqlalchemy.text(cmd))
     db.session.commit()
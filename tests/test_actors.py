@@ -1,3 +1,5 @@
+import json
+import threading
 import pytest
 from datetime import datetime, timezone
 from swpt_accounts import procedures as p
@@ -155,6 +157,186 @@ def test_consumer(db_session, actors):
     )
 
 
+def test_batching_consumer(db_session, actors):
+    from swpt_accounts.models import FinalizationRequest
+
+    consumer = actors.SmpConsumer(batch_size=10, batch_wait=0.0)
+    props = MessageProperties(
+        content_type="application/json", type="FinalizeTransfer"
+    )
+    assert (
+        consumer.process_message(
+            b"""
+    {
+      "type": "FinalizeTransfer",
+      "debtor_id": -1,
+      "creditor_id": 1,
+      "transfer_id": 666,
+      "coordinator_type": "test",
+      "coordinator_id": 1,
+      "coordinator_request_id": 2,
+      "committed_amount": 100,
+      "transfer_note_format": "",
+      "transfer_note": "",
+      "ts": "2099-12-31T00:00:00+00:00"
+    }
+    """,
+            props,
+        )
+        is True
+    )
+    frs = FinalizationRequest.query.all()
+    assert len(frs) == 1
+    assert frs[0].transfer_id == 666
+    assert frs[0].committed_amount == 100
+
+
+PREPARE_TRANSFER_MESSAGE = {
+    "type": "PrepareTransfer",
+    "coordinator_type": "direct",
+    "coordinator_id": 1,
+    "coordinator_request_id": 2,
+    "min_locked_amount": 1,
+    "max_locked_amount": 200,
+    "debtor_id": D_ID,
+    "creditor_id": C_ID,
+    "recipient": "1234",
+    "final_interest_rate_ts": "9999-12-31T23:59:59+00:00",
+    "max_commit_delay": 1000000,
+    "ts": "2099-12-31T00:00:00+00:00",
+}
+
+FINALIZE_TRANSFER_MESSAGE = {
+    "type": "FinalizeTransfer",
+    "debtor_id": D_ID,
+    "creditor_id": C_ID,
+    "transfer_id": 666,
+    "coordinator_type": "direct",
+    "coordinator_id": 1,
+    "coordinator_request_id": 3,
+    "committed_amount": 100,
+    "transfer_note_format": "",
+    "transfer_note": "",
+    "ts": "2099-12-31T00:00:00+00:00",
+}
+
+PENDING_BALANCE_CHANGE_MESSAGE = {
+    "type": "PendingBalanceChange",
+    "debtor_id": D_ID,
+    "creditor_id": C_ID,
+    "change_id": 1,
+    "coordinator_type": "direct",
+    "transfer_note_format": "",
+    "transfer_note": "",
+    "committed_at": "2099-12-31T00:00:00+00:00",
+    "principal_delta": 1000,
+    "other_creditor_id": 123,
+}
+
+
+def _process_concurrently(app, consumer, messages):
+    # Passes each message to the consumer from a different thread,
+    # like the consumer threads do. Returns the result of each call
+    # (or the raised exception).
+    results = [None] * len(messages)
+
+    def process(i, message):
+        props = MessageProperties(
+            content_type="application/json", type=message["type"]
+        )
+        with app.app_context():
+            try:
+                results[i] = consumer.process_message(
+                    json.dumps(message).encode("utf8"), props
+                )
+            except Exception as e:
+                results[i] = e
+
+    threads = [
+        threading.Thread(target=process, args=(i, message))
+        for i, message in enumerate(messages)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def test_batching_consumer_mixed_batch(app, db_session, actors, mocker):
+    from swpt_accounts.models import (
+        TransferRequest,
+        FinalizationRequest,
+        PendingBalanceChange,
+    )
+
+    mocker.patch(
+        "swpt_accounts.actors.get_reachable_accounts",
+        return_value={(D_ID, 1234)},
+    )
+    insert_request_batch = mocker.spy(p, "insert_request_batch")
+    consumer = actors.SmpConsumer(batch_size=3, batch_wait=10.0)
+    messages = [
+        PREPARE_TRANSFER_MESSAGE,
+        FINALIZE_TRANSFER_MESSAGE,
+        PENDING_BALANCE_CHANGE_MESSAGE,
+    ]
+    assert _process_concurrently(app, consumer, messages) == [True] * 3
+
+    # All the messages have been persisted in a single batch.
+    insert_request_batch.assert_called_once()
+    requests = insert_request_batch.call_args.kwargs
+    assert len(requests["transfer_requests"]) == 1
+    assert len(requests["finalization_requests"]) == 1
+    assert len(requests["pending_balance_changes"]) == 1
+
+    trs = TransferRequest.query.all()
+    assert len(trs) == 1
+    assert trs[0].recipient_creditor_id == 1234
+    frs = FinalizationRequest.query.all()
+    assert len(frs) == 1
+    assert frs[0].transfer_id == 666
+    pbcs = PendingBalanceChange.query.all()
+    assert len(pbcs) == 1
+    assert pbcs[0].principal_delta == 1000
+
+
+def test_batching_consumer_duplicates(app, db_session, actors):
+    from swpt_accounts.models import FinalizationRequest, PendingBalanceChange
+
+    consumer = actors.SmpConsumer(batch_size=4, batch_wait=10.0)
+    messages = [
+        FINALIZE_TRANSFER_MESSAGE,
+        FINALIZE_TRANSFER_MESSAGE,
+        PENDING_BALANCE_CHANGE_MESSAGE,
+        PENDING_BALANCE_CHANGE_MESSAGE,
+    ]
+    assert _process_concurrently(app, consumer, messages) == [True] * 4
+
+    # Messages which have been persisted in previous batches are
+    # ignored too.
+    assert _process_concurrently(app, consumer, messages) == [True] * 4
+    assert len(FinalizationRequest.query.all()) == 1
+    assert len(PendingBalanceChange.query.all()) == 1
+
+
+def test_batching_consumer_failure(app, db_session, actors, mocker):
+    from swpt_accounts.models import FinalizationRequest, PendingBalanceChange
+
+    mocker.patch.object(
+        p, "insert_request_batch", side_effect=RuntimeError("failure")
+    )
+    consumer = actors.SmpConsumer(batch_size=2, batch_wait=10.0)
+    messages = [FINALIZE_TRANSFER_MESSAGE, PENDING_BALANCE_CHANGE_MESSAGE]
+
+    # None of the messages in the failed batch gets acknowledged.
+    results = _process_concurrently(app, consumer, messages)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert len(FinalizationRequest.query.all()) == 0
+    assert len(PendingBalanceChange.query.all()) == 0
+
+
 def test_set_interest_rate_on_new_accounts(app, db_session):
     from swpt_accounts.models import AccountUpdateSignal
     from swpt_accounts.fetch_api_client import _clear_root_config_data
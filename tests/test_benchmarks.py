@@ -0,0 +1,409 @@
+"""Throughput benchmarks for the transfer pipeline stages, and for the
+serialization of outgoing messages.
+
+The benchmarks are skipped, unless the `--benchmark-output` option is
+given. For example:
+
+    pytest tests/test_benchmarks.py --benchmark-output=results.jsonl \\
+      --benchmark-accounts=1000 --benchmark-rows=3
+
+Each stage is run in both Python and PL/pgSQL modes, and a JSON object
+is appended to the output file for each stage/mode combination. Also,
+a JSON object is appended for each signal class, comparing the
+marshmallow serialization with the fast serialization, and one more
+JSON object shows the per-message saving from the memoization of
+routing keys and shard-membership checks. An allocation profile of
+the creation of a 5000-message burst is appended, and finally, the
+per-row interest capitalization check that the accounts scanner did
+before the introduction of `AccountsBlock` is compared with the
+current one.
+"""
+
+import json
+import random
+import time
+import timeit
+import tracemalloc
+import pytest
+from datetime import datetime, timezone, timedelta
+from flask import current_app
+from sqlalchemy import insert, update
+from swpt_pythonlib.utils import calc_bin_routing_key
+from swpt_accounts import procedures as p
+from tests.test_models import _make_signals
+from swpt_accounts.models import (
+    Account,
+    TransferRequest,
+    FinalizationRequest,
+    PreparedTransfer,
+    PendingBalanceChangeSignal,
+    MAX_INT32,
+    T_INFINITY,
+)
+
+D_ID = -1
+
+
+@pytest.fixture(scope="function")
+def benchmark(request):
+    output = request.config.option.benchmark_output
+    if output is None:
+        pytest.skip("no --benchmark-output option")
+
+    return dict(
+        output=output,
+        accounts=int(request.config.option.benchmark_accounts),
+        rows=int(request.config.option.benchmark_rows),
+    )
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[int(q * (len(sorted_values) - 1))]
+
+
+def _run_stage(benchmark, stage, use_pgplsql, rows_count, process, args):
+    latencies = []
+    started_at = time.perf_counter()
+    for a in args:
+        t = time.perf_counter()
+        process(*a)
+        latencies.append(time.perf_counter() - t)
+    seconds = time.perf_counter() - started_at
+    latencies.sort()
+
+    result = {
+        "stage": stage,
+        "mode": "pgplsql" if use_pgplsql else "python",
+        "accounts": len(args),
+        "rows": rows_count,
+        "seconds": seconds,
+        "rows_per_second": rows_count / seconds,
+        "transactions_per_second": len(args) / seconds,
+        "latency_p50_ms": 1000 * _percentile(latencies, 0.5),
+        "latency_p99_ms": 1000 * _percentile(latencies, 0.99),
+    }
+    with open(benchmark["output"], "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("use_pgplsql", [False, True])
+def test_pipeline_throughput(db_session, benchmark, use_pgplsql):
+    orig_use_pgplsql = current_app.config["APP_USE_PGPLSQL_FUNCTIONS"]
+    current_app.config["APP_USE_PGPLSQL_FUNCTIONS"] = use_pgplsql
+    current_ts = datetime.now(tz=timezone.utc)
+    n = benchmark["accounts"]
+    creditor_ids = list(range(1, n + 1))
+    for creditor_id in creditor_ids:
+        p.configure_account(D_ID, creditor_id, current_ts, 0)
+
+    db_session.execute(
+        update(Account)
+        .where(Account.debtor_id == D_ID)
+        .values(principal=1000000000)
+    )
+    db_session.commit()
+
+    # Stage 1: Process transfer requests.
+    transfer_requests = [
+        dict(
+            debtor_id=D_ID,
+            coordinator_type="direct",
+            coordinator_id=creditor_id,
+            coordinator_request_id=i,
+            min_locked_amount=1,
+            max_locked_amount=1,
+            sender_creditor_id=creditor_id,
+            recipient_creditor_id=creditor_id % n + 1,
+            deadline=current_ts + timedelta(days=1),
+            final_interest_rate_ts=T_INFINITY,
+        )
+        for creditor_id in creditor_ids
+        for i in range(benchmark["rows"])
+    ]
+    db_session.execute(insert(TransferRequest), transfer_requests)
+    db_session.commit()
+    _run_stage(
+        benchmark,
+        "process_transfer_requests",
+        use_pgplsql,
+        len(transfer_requests),
+        p.process_transfer_requests,
+        [(D_ID, creditor_id, MAX_INT32) for creditor_id in creditor_ids],
+    )
+
+    # Stage 2: Process finalization requests.
+    finalization_requests = [
+        dict(
+            debtor_id=pt.debtor_id,
+            sender_creditor_id=pt.sender_creditor_id,
+            transfer_id=pt.transfer_id,
+            coordinator_type=pt.coordinator_type,
+            coordinator_id=pt.coordinator_id,
+            coordinator_request_id=pt.coordinator_request_id,
+            committed_amount=1,
+            transfer_note_format="",
+            transfer_note="",
+            ts=current_ts,
+        )
+        for pt in PreparedTransfer.query.all()
+    ]
+    db_session.execute(insert(FinalizationRequest), finalization_requests)
+    db_session.commit()
+    _run_stage(
+        benchmark,
+        "process_finalization_requests",
+        use_pgplsql,
+        len(finalization_requests),
+        p.process_finalization_requests,
+        [(D_ID, creditor_id) for creditor_id in creditor_ids],
+    )
+
+    # Stage 3: Process pending balance changes.
+    pending_balance_changes = [
+        dict(
+            debtor_id=s.debtor_id,
+            other_creditor_id=s.other_creditor_id,
+            change_id=s.change_id,
+            creditor_id=s.creditor_id,
+            coordinator_type=s.coordinator_type,
+            transfer_note_format=s.transfer_note_format,
+            transfer_note=s.transfer_note,
+            committed_at=s.committed_at,
+            principal_delta=s.principal_delta,
+        )
+        for s in PendingBalanceChangeSignal.query.all()
+    ]
+    p.insert_request_batch(pending_balance_changes=pending_balance_changes)
+    _run_stage(
+        benchmark,
+        "process_pending_balance_changes",
+        use_pgplsql,
+        len(pending_balance_changes),
+        p.process_pending_balance_changes,
+        [(D_ID, creditor_id) for creditor_id in creditor_ids],
+    )
+
+    current_app.config["APP_USE_PGPLSQL_FUNCTIONS"] = orig_use_pgplsql
+
+
+@pytest.mark.slow
+def test_signal_serialization_speed(app, benchmark):
+    number = 10000
+    for s in _make_signals(datetime.now(tz=timezone.utc)):
+        cls = type(s)
+        marshmallow_seconds = min(
+            timeit.repeat(
+                lambda: cls.__marshmallow_schema__.dump(s),
+                number=number,
+                repeat=3,
+            )
+        )
+        fast_seconds = min(
+            timeit.repeat(
+                lambda: cls.get_dump_function()(s), number=number, repeat=3
+            )
+        )
+        result = {
+            "stage": "serialization",
+            "signal": cls.__name__,
+            "marshmallow_us_per_message": 1e6 * marshmallow_seconds / number,
+            "fast_us_per_message": 1e6 * fast_seconds / number,
+            "speedup": marshmallow_seconds / fast_seconds,
+        }
+        with open(benchmark["output"], "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+@pytest.mark.slow
+def test_memoization_speed(app, benchmark):
+    from swpt_accounts import models as m
+
+    burst_size = 5000
+    accounts = [(D_ID, i % 100) for i in range(burst_size)]
+    sharding_realm = current_app.config["SHARDING_REALM"]
+
+    def run_unmemoized():
+        for debtor_id, creditor_id in accounts:
+            sharding_realm.match(debtor_id, creditor_id)
+            calc_bin_routing_key(debtor_id, creditor_id)
+
+    def run_memoized():
+        for debtor_id, creditor_id in accounts:
+            m.is_valid_account(debtor_id, creditor_id)
+            m._cached_bin_routing_key(debtor_id, creditor_id)
+
+    unmemoized_seconds = min(timeit.repeat(run_unmemoized, number=1, repeat=5))
+    memoized_seconds = min(timeit.repeat(run_memoized, number=1, repeat=5))
+    result = {
+        "stage": "memoization",
+        "burst_size": burst_size,
+        "unmemoized_us_per_message": 1e6 * unmemoized_seconds / burst_size,
+        "memoized_us_per_message": 1e6 * memoized_seconds / burst_size,
+        "saved_us_per_message": (
+            1e6 * (unmemoized_seconds - memoized_seconds) / burst_size
+        ),
+        "hit_rates": {
+            name: stats["hit_rate"]
+            for name, stats in m.get_memoization_stats().items()
+        },
+    }
+    with open(benchmark["output"], "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+@pytest.mark.slow
+def test_message_allocations(app, benchmark, mocker):
+    publisher = mocker.patch("swpt_accounts.models.publisher")
+    burst_size = 5000
+    signal = _make_signals(datetime.now(tz=timezone.utc))[0]
+    cls = type(signal)
+    burst = [signal] * burst_size
+    cls.send_signalbus_messages(burst[:1])  # warm up the caches
+    publisher.reset_mock()
+
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    cls.send_signalbus_messages(burst)
+    seconds = time.perf_counter() - started_at
+    snapshot = tracemalloc.take_snapshot()
+    _, peak_size = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = snapshot.statistics("lineno")
+    assert len(publisher.publish_messages.call_args[0][0]) == burst_size
+    result = {
+        "stage": "message_allocations",
+        "signal": cls.__name__,
+        "burst_size": burst_size,
+        "us_per_message": 1e6 * seconds / burst_size,
+        "peak_kib": peak_size / 1024,
+        "retained_kib": sum(s.size for s in stats) / 1024,
+        "retained_blocks_per_message": (
+            sum(s.count for s in stats) / burst_size
+        ),
+        "top_allocations": [
+            {
+                "line": str(s.traceback[0]),
+                "kib": s.size / 1024,
+                "blocks": s.count,
+            }
+            for s in stats[:5]
+        ],
+    }
+    with open(benchmark["output"], "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+@pytest.mark.slow
+def test_account_predicates_speed(app, benchmark):
+    import math
+    from swpt_accounts.models import (
+        ROOT_CREDITOR_ID,
+        calc_current_balance,
+        contain_principal_overflow,
+    )
+    from swpt_accounts.table_scanners import AccountScanner, AccountsBlock
+
+    # About 40 table blocks, with about 25 accounts per block. (Unlike
+    # the rows from `_make_account_rows`, which are full of edge
+    # cases, these are typical accounts.)
+    rows_count = 1000
+    current_ts = datetime.now(tz=timezone.utc)
+    cutoff_ts = current_ts - timedelta(days=14)
+    rnd = random.Random(0)
+    columns = AccountScanner.columns
+    c = Account.__table__.c
+    rows = []
+    for _ in range(rows_count):
+        row = dict.fromkeys(c[column.key] for column in columns)
+        row.update(
+            {
+                c.debtor_id: D_ID,
+                c.creditor_id: rnd.randint(1, 10**6),
+                c.status_flags: 0,
+                c.principal: rnd.randint(0, 10**9),
+                c.interest: rnd.uniform(0.0, 1e5),
+                c.interest_rate: rnd.choice([0.0, 2.5, 5.0]),
+                c.last_change_ts: current_ts - timedelta(
+                    seconds=rnd.uniform(0.0, 3e7)
+                ),
+                c.last_interest_capitalization_ts: current_ts - timedelta(
+                    days=30
+                ),
+            }
+        )
+        rows.append(row)
+
+    max_ratio = current_app.config["APP_MAX_INTEREST_TO_PRINCIPAL_RATIO"]
+    deleted_flag = Account.STATUS_DELETED_FLAG
+
+    def run_baseline():
+        # The per-row code that the accounts scanner used before the
+        # introduction of `AccountsBlock`.
+        pks = []
+        for row in rows:
+            creditor_id = row[c.creditor_id]
+            if (
+                creditor_id != ROOT_CREDITOR_ID
+                and row[c.last_interest_capitalization_ts] <= cutoff_ts
+                and not row[c.status_flags] & deleted_flag
+            ):
+                current_balance = calc_current_balance(
+                    creditor_id=creditor_id,
+                    principal=row[c.principal],
+                    interest=row[c.interest],
+                    interest_rate=row[c.interest_rate],
+                    last_change_ts=row[c.last_change_ts],
+                    current_ts=current_ts,
+                )
+                accumulated_interest = abs(
+                    contain_principal_overflow(
+                        math.floor(current_balance - row[c.principal])
+                    )
+                )
+                ratio = accumulated_interest / (1 + abs(row[c.principal]))
+                if ratio > max_ratio:
+                    pks.append((row[c.debtor_id], creditor_id))
+        return pks
+
+    def run_block():
+        block = AccountsBlock(rows, columns)
+        candidates = [
+            i
+            for i, (creditor_id, last_capitalization_ts, is_deleted) in (
+                enumerate(
+                    zip(
+                        block.creditor_id,
+                        block.last_interest_capitalization_ts,
+                        block.is_deleted,
+                    )
+                )
+            )
+            if (
+                creditor_id != ROOT_CREDITOR_ID
+                and last_capitalization_ts <= cutoff_ts
+                and not is_deleted
+            )
+        ]
+        exceed_max_ratio = block.exceed_max_interest_ratio(
+            candidates, current_ts, max_ratio
+        )
+        return [
+            (block.debtor_id[i], block.creditor_id[i])
+            for i, exceeds in zip(candidates, exceed_max_ratio)
+            if exceeds
+        ]
+
+    assert run_baseline() == run_block()
+    baseline_seconds = min(timeit.repeat(run_baseline, number=1, repeat=5))
+    block_seconds = min(timeit.repeat(run_block, number=1, repeat=5))
+    result = {
+        "stage": "account_predicates",
+        "rows": rows_count,
+        "baseline_us_per_row": 1e6 * baseline_seconds / rows_count,
+        "block_us_per_row": 1e6 * block_seconds / rows_count,
+        "speedup": baseline_seconds / block_seconds,
+    }
+    with open(benchmark["output"], "a") as f:
+        f.write(json.dumps(result) + "\n")
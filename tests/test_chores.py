@@ -43,6 +43,14 @@ def test_try_to_delete_account(db_session):
     )
 
 
+def test_capitalize_interests(db_session):
+    chores._on_capitalize_interests(accounts=[(D_ID, C_ID), (D_ID, 2)])
+
+
+def test_try_to_delete_accounts(db_session):
+    chores._on_try_to_delete_accounts(accounts=[(D_ID, C_ID), (D_ID, 2)])
+
+
 def test_change_interest_rate_schema():
     s = schemas.ChangeInterestRateMessageSchema()
 
@@ -127,6 +135,49 @@ def test_update_debtor_info_schema():
         )
 
 
+def test_try_to_delete_accounts_schema():
+    s = schemas.TryToDeleteAccountsMessageSchema()
+
+    data = s.loads(
+        """{
+    "type": "TryToDeleteAccounts",
+    "accounts": [[-2, -1], [-2, 5]],
+    "unknown": "ignored"
+    }"""
+    )
+    assert data["type"] == "TryToDeleteAccounts"
+    assert data["accounts"] == [(-2, -1), (-2, 5)]
+    assert "unknown" not in data
+
+    with pytest.raises(ValidationError, match="Invalid type."):
+        schemas.CapitalizeInterestsMessageSchema().loads(s.dumps(data))
+
+    with pytest.raises(ValidationError):
+        s.loads('{"type": "TryToDeleteAccounts", "accounts": []}')
+
+    with pytest.raises(ValidationError):
+        s.loads('{"type": "TryToDeleteAccounts", "accounts": [[1]]}')
+
+
+def test_create_chore_batch_messages(app):
+    orig_max_count = app.config["APP_CHORES_MAX_ACCOUNTS_PER_MESSAGE"]
+    app.config["APP_CHORES_MAX_ACCOUNTS_PER_MESSAGE"] = 2
+    try:
+        messages = chores.create_chore_batch_messages(
+            "CapitalizeInterests", [(-2, 3), (-2, 1), (-1, 5)]
+        )
+    finally:
+        app.config["APP_CHORES_MAX_ACCOUNTS_PER_MESSAGE"] = orig_max_count
+
+    s = schemas.CapitalizeInterestsMessageSchema()
+    assert [s.loads(m.body.decode())["accounts"] for m in messages] == [
+        [(-2, 1), (-2, 3)],
+        [(-1, 5)],
+    ]
+    assert all(m.properties.type == "CapitalizeInterests" for m in messages)
+    assert chores.create_chore_batch_messages("CapitalizeInterests", []) == []
+
+
 def test_create_chore_message():
     current_ts = datetime.now()
     s = schemas.UpdateDebtorInfoMessageSchema()
@@ -190,3 +241,19 @@ def test_consumer(db_session):
         )
         is True
     )
+
+    props = MessageProperties(
+        content_type="application/json", type="TryToDeleteAccounts"
+    )
+    assert (
+        consumer.process_message(
+            b"""
+    {
+      "type": "TryToDeleteAccounts",
+      "accounts": [[1, 2], [1, 3]]
+    }
+    """,
+            props,
+        )
+        is True
+    )
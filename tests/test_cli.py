@@ -1,3 +1,4 @@
+import os
 import pytest
 import sqlalchemy
 from unittest.mock import Mock
@@ -92,6 +93,98 @@ def test_process_transfers_transfer_requests(app, db_session):
     assert len(TransferRequest.query.all()) == 0
 
 
+def test_process_transfers_transfer_requests_in_buckets(app, db_session):
+    current_ts = datetime.now(tz=timezone.utc)
+    for creditor_id in range(1, 21):
+        p.prepare_transfer(
+            coordinator_type="test",
+            coordinator_id=1,
+            coordinator_request_id=2,
+            min_locked_amount=1,
+            max_locked_amount=200,
+            debtor_id=D_ID,
+            creditor_id=creditor_id,
+            recipient_creditor_id=1234,
+            ts=current_ts,
+        )
+
+    buckets = [
+        {
+            tuple(row)
+            for rows in p.iter_accounts_with_transfer_requests(
+                yield_per=100, bucket_count=3, bucket_index=i
+            )
+            for row in rows
+        }
+        for i in range(3)
+    ]
+    assert sum(len(b) for b in buckets) == 20
+    assert set.union(*buckets) == {(D_ID, c) for c in range(1, 21)}
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        args=[
+            "swpt_accounts",
+            "process_transfer_requests",
+            "--quit-early",
+            "--wait=0",
+            "--bucket-count=3",
+            "--bucket-index=3",
+        ]
+    )
+    assert result.exit_code == 1
+
+    for i in range(3):
+        result = runner.invoke(
+            args=[
+                "swpt_accounts",
+                "process_transfer_requests",
+                "--quit-early",
+                "--wait=0",
+                "--bucket-count=3",
+                f"--bucket-index={i}",
+            ]
+        )
+        assert result.exit_code == 0
+        db_session.close()
+        assert len(TransferRequest.query.all()) == 20 - sum(
+            len(b) for b in buckets[:i + 1]
+        )
+
+
+def test_process_transfers_with_notifications(app, db_session):
+    orig_notify_processors = app.config["APP_NOTIFY_PROCESSORS"]
+    app.config["APP_NOTIFY_PROCESSORS"] = True
+    current_ts = datetime.now(tz=timezone.utc)
+    p.configure_account(D_ID, 1234, current_ts, 0)
+    p.prepare_transfer(
+        coordinator_type="test",
+        coordinator_id=1,
+        coordinator_request_id=2,
+        min_locked_amount=1,
+        max_locked_amount=200,
+        debtor_id=D_ID,
+        creditor_id=C_ID,
+        recipient_creditor_id=1234,
+        ts=current_ts,
+    )
+    assert len(TransferRequest.query.all()) == 1
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        args=[
+            "swpt_accounts",
+            "process_transfer_requests",
+            "--quit-early",
+            "--wait=0",
+        ]
+    )
+    assert result.exit_code == 0
+    db_session.close()
+    assert len(RejectedTransferSignal.query.all()) == 1
+    assert len(TransferRequest.query.all()) == 0
+    app.config["APP_NOTIFY_PROCESSORS"] = orig_notify_processors
+
+
 def test_process_transfers_finalization_requests(app, db_session):
     p.make_debtor_payment("test", D_ID, C_ID, 1000)
     p.process_pending_balance_changes(D_ID, C_ID)
@@ -469,6 +562,194 @@ def test_delete_parent_accounts(app, db_session):
     _clear_root_config_data()
 
 
+def test_scan_accounts_in_parallel(app, db_session, mocker):
+    from swpt_accounts.models import Account
+    from swpt_accounts.table_scanners import AccountScanner
+
+    for creditor_id in range(1, 301):
+        db.session.add(
+            Account(
+                debtor_id=D_ID,
+                creditor_id=creditor_id,
+                creation_date=date(1970, 1, 1),
+                config_data="x" * 200,
+            )
+        )
+    db.session.commit()
+
+    scanned = []
+    mocker.patch.object(
+        AccountScanner,
+        "process_rows",
+        lambda self, rows: scanned.append(
+            {row[Account.creditor_id] for row in rows}
+        ),
+    )
+    mocker.patch.object(AccountScanner, "blocks_per_query", 1)
+    parts = []
+    for worker_index in range(3):
+        AccountScanner().run_worker(
+            db.engine,
+            timedelta(seconds=0.01),
+            3,
+            worker_index,
+            quit_early=True,
+        )
+        parts.append(set().union(*scanned))
+        scanned.clear()
+
+    assert sum(len(part) for part in parts) == 300
+    assert set().union(*parts) == set(range(1, 301))
+    assert len([part for part in parts if part]) > 1
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        args=["swpt_accounts", "scan_accounts", "--workers", "0"]
+    )
+    assert result.exit_code == 1
+
+
+def test_scan_accounts_checkpoint(app, db_session, mocker):
+    from swpt_accounts.models import Account, TableScanCheckpoint
+    from swpt_accounts.table_scanners import (
+        AccountScanner,
+        COUNT_TABLE_BLOCKS,
+    )
+
+    for creditor_id in range(1, 301):
+        db.session.add(
+            Account(
+                debtor_id=D_ID,
+                creditor_id=creditor_id,
+                creation_date=date(1970, 1, 1),
+                config_data="x" * 200,
+            )
+        )
+    db.session.commit()
+
+    scanned = set()
+    mocker.patch.object(
+        AccountScanner,
+        "process_rows",
+        lambda self, rows: scanned.update(
+            row[Account.creditor_id] for row in rows
+        ),
+    )
+    mocker.patch.object(AccountScanner, "blocks_per_query", 1)
+    block_count = db.session.execute(
+        COUNT_TABLE_BLOCKS, {"table_name": "account"}
+    ).scalar_one()
+    assert block_count > 1
+
+    # Continue an interrupted pass.
+    pass_started_at = datetime.now(tz=timezone.utc) - timedelta(minutes=1)
+    db.session.add(
+        TableScanCheckpoint(
+            table_name="account",
+            worker_count=1,
+            worker_index=0,
+            pass_started_at=pass_started_at,
+            block_count=block_count,
+            next_block=block_count // 2,
+        )
+    )
+    db.session.commit()
+    scanner = AccountScanner()
+    scanner.run_worker(
+        db.engine, timedelta(milliseconds=10), quit_early=True
+    )
+    assert 0 < len(scanned) < 300
+    assert scanner.progress.percent == 100.0
+    db.session.expire_all()
+    cp = TableScanCheckpoint.query.one()
+    assert cp.pass_started_at == pass_started_at
+    assert cp.next_block == block_count
+    assert cp.estimated_finish_at is not None
+
+    # The pass is completed, and its completion goal has not elapsed.
+    scanned.clear()
+    AccountScanner().run_worker(
+        db.engine, timedelta(hours=1), quit_early=True
+    )
+    assert len(scanned) == 0
+
+    # The completion goal has elapsed, and a new pass is started.
+    AccountScanner().run_worker(
+        db.engine, timedelta(milliseconds=10), quit_early=True
+    )
+    assert scanned == set(range(1, 301))
+    db.session.expire_all()
+    cp = TableScanCheckpoint.query.one()
+    assert cp.pass_started_at > pass_started_at
+    assert cp.next_block == cp.block_count
+
+
+def test_scan_due_accounts(app, db_session, mocker):
+    mocker.patch(
+        "swpt_accounts.extensions.chores_publisher", new=Mock()
+    )
+    from swpt_accounts.models import (
+        Account,
+        AccountUpdateSignal,
+        AccountPurgeSignal,
+    )
+
+    current_ts = datetime.now(tz=timezone.utc)
+    past_ts = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    for creditor_id, status_flags, next_due_ts in [
+        (12, 0, past_ts),
+        (123, Account.STATUS_DELETED_FLAG, past_ts),
+        (1234, 0, current_ts + timedelta(days=1)),
+    ]:
+        db.session.add(
+            Account(
+                debtor_id=D_ID,
+                creditor_id=creditor_id,
+                creation_date=date(1970, 1, 1),
+                status_flags=status_flags,
+                last_change_ts=past_ts,
+                last_heartbeat_ts=past_ts,
+                next_due_ts=next_due_ts,
+            )
+        )
+    db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        args=["swpt_accounts", "scan_due_accounts", "--quit-early"]
+    )
+    assert result.exit_code == 0
+
+    # Only the due accounts have been visited.
+    acs = AccountUpdateSignal.query.one()
+    assert acs.creditor_id == 12
+    aps = AccountPurgeSignal.query.one()
+    assert aps.creditor_id == 123
+    account = Account.query.filter_by(debtor_id=D_ID, creditor_id=12).one()
+    assert not account.pending_account_update
+    assert account.next_due_ts > current_ts + timedelta(days=6)
+    account = Account.query.filter_by(debtor_id=D_ID, creditor_id=1234).one()
+    assert account.last_heartbeat_ts == past_ts
+    assert account.next_due_ts == current_ts + timedelta(days=1)
+
+    # Changing the account makes it due.
+    p.configure_account(D_ID, 1234, current_ts, 0, negligible_amount=10.0)
+    account = Account.query.filter_by(debtor_id=D_ID, creditor_id=1234).one()
+    assert account.next_due_ts <= datetime.now(tz=timezone.utc)
+
+    result = runner.invoke(
+        args=[
+            "swpt_accounts",
+            "scan_due_accounts",
+            "--bucket-count",
+            "2",
+            "--bucket-index",
+            "2",
+        ]
+    )
+    assert result.exit_code == 1
+
+
 def test_scan_prepared_transfers(app, db_session):
     from swpt_accounts.models import (
         Account,
@@ -649,6 +930,45 @@ def test_verify_shard_content(app, db_session, realm):
     app.config["SHARDING_REALM"] = orig_sharding_realm
 
 
+def test_verify_shard_content_in_parallel(app, db_session, tmp_path):
+    orig_sharding_realm = app.config["SHARDING_REALM"]
+    orig_blocks_per_range = app.config["APP_VERIFY_SHARD_BLOCKS_PER_RANGE"]
+    app.config["SHARDING_REALM"] = sharding_realm = ShardingRealm("1.#")
+    app.config["APP_VERIFY_SHARD_BLOCKS_PER_RANGE"] = 1
+    current_ts = datetime.now(tz=timezone.utc)
+    for creditor_id in range(1, 200):
+        if sharding_realm.match(D_ID, creditor_id):
+            p.configure_account(D_ID, creditor_id, current_ts, 0)
+
+    checkpoint = str(tmp_path / "checkpoint.json")
+    runner = app.test_cli_runner()
+    args = [
+        "swpt_accounts",
+        "verify_shard_content",
+        "--threads",
+        "2",
+        "--checkpoint",
+        checkpoint,
+    ]
+    result = runner.invoke(args=args)
+    assert result.exit_code == 0
+    assert not os.path.exists(checkpoint)
+
+    app.config["SHARDING_REALM"] = ShardingRealm("0.#")
+    result = runner.invoke(args=args)
+    assert result.exit_code == 1
+    assert os.path.exists(checkpoint)
+
+    # The already verified ranges are skipped.
+    app.config["SHARDING_REALM"] = sharding_realm
+    result = runner.invoke(args=args)
+    assert result.exit_code == 0
+    assert not os.path.exists(checkpoint)
+
+    app.config["SHARDING_REALM"] = orig_sharding_realm
+    app.config["APP_VERIFY_SHARD_BLOCKS_PER_RANGE"] = orig_blocks_per_range
+
+
 def test_alembic_current_head(app, request, capfd):
     if request.config.option.capture != "no":
         pytest.skip("needs to be run with --capture=no")
@@ -8,6 +8,8 @@ from swpt_accounts.fetch_api_client import (
     parse_root_config_data,
     get_root_config_data_dict,
     get_if_account_is_reachable,
+    forget_account_reachability,
+    _clear_reachability,
 )
 
 D_ID = -1
@@ -110,6 +112,8 @@ def test_get_if_account_is_reachable(app, db_session, caplog):
     assert not get_if_account_is_reachable(666, C_ID)
 
     current_app.config["FETCH_API_URL"] = "localhost:1111"
+    assert get_if_account_is_reachable(D_ID, C_ID)  # cached
+    _clear_reachability()
     with caplog.at_level(logging.ERROR):
         assert not get_if_account_is_reachable(D_ID, C_ID)
         assert ["Caught error while making a fetch request."] == [
@@ -151,3 +155,89 @@ def test_get_root_account_config_data(app, db_session, caplog):
         assert len(caplog.records) == 0
 
     _clear_root_config_data()
+
+
+def test_root_config_data_cache(app, db_session):
+    from swpt_accounts import procedures as p
+    from swpt_accounts.fetch_api_client import (
+        _clear_root_config_data,
+        _root_config_data_lru_cache,
+        get_root_config_data_cache_stats,
+    )
+
+    _clear_root_config_data()
+    cache_size = current_app.config["APP_FETCH_DATA_CACHE_SIZE"]
+    current_app.config["APP_FETCH_DATA_CACHE_SIZE"] = 2
+    current_ts = datetime.now(tz=timezone.utc)
+    p.configure_account(
+        D_ID, p.ROOT_CREDITOR_ID, current_ts, 0, config_data='{"rate": 2.0}'
+    )
+
+    # Concurrent fetches for the same debtor are coalesced.
+    assert get_root_config_data_dict([D_ID, D_ID, 666]) == {
+        D_ID: RootConfigData(2.0),
+        666: None,
+    }
+    stats = get_root_config_data_cache_stats()
+    assert stats["misses"] == 3
+    assert stats["coalesced"] == 1
+    assert stats["size"] == 2
+
+    # A hit moves the entry to the end, so that 666 gets evicted.
+    assert get_root_config_data_dict([D_ID]) == {D_ID: RootConfigData(2.0)}
+    assert get_root_config_data_dict([777]) == {777: None}
+    assert list(_root_config_data_lru_cache) == [D_ID, 777]
+    stats = get_root_config_data_cache_stats()
+    assert stats["hits"] == 1
+    assert stats["evictions"] == 1
+
+    # Negative results expire sooner than positive ones.
+    assert get_root_config_data_dict(
+        [D_ID, 777], negative_cache_seconds=-1.0
+    ) == {D_ID: RootConfigData(2.0), 777: None}
+    stats = get_root_config_data_cache_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 5
+
+    current_app.config["APP_FETCH_DATA_CACHE_SIZE"] = cache_size
+    _clear_root_config_data()
+
+
+def test_get_reachable_accounts(app, db_session):
+    from swpt_accounts import procedures as p
+    from swpt_accounts.fetch_api_client import get_reachable_accounts
+
+    current_ts = datetime.now(tz=timezone.utc)
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    assert get_reachable_accounts([]) == set()
+    assert get_reachable_accounts(
+        [(D_ID, C_ID), (D_ID, C_ID), (666, C_ID), (666, p.ROOT_CREDITOR_ID)]
+    ) == {(D_ID, C_ID), (666, p.ROOT_CREDITOR_ID)}
+
+
+def test_reachability_cache(app, db_session):
+    from swpt_accounts import procedures as p
+    from swpt_accounts.models import Account
+
+    current_ts = datetime.now(tz=timezone.utc)
+    assert not get_if_account_is_reachable(D_ID, C_ID)
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+
+    # Cached answers are not evicted when the account changes.
+    assert not get_if_account_is_reachable(D_ID, C_ID)
+    forget_account_reachability(D_ID, C_ID)
+    assert get_if_account_is_reachable(D_ID, C_ID)
+    p.configure_account(
+        D_ID,
+        C_ID,
+        current_ts,
+        1,
+        config_flags=Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG,
+    )
+    assert get_if_account_is_reachable(D_ID, C_ID)
+
+    # Cached answers expire.
+    cache_seconds = current_app.config["APP_FETCH_REACHABLE_CACHE_SECONDS"]
+    current_app.config["APP_FETCH_REACHABLE_CACHE_SECONDS"] = -1.0
+    assert not get_if_account_is_reachable(D_ID, C_ID)
+    current_app.config["APP_FETCH_REACHABLE_CACHE_SECONDS"] = cache_seconds
@@ -0,0 +1,293 @@
+import pytest
+from datetime import date
+from unittest.mock import Mock
+from swpt_accounts.extensions import db
+from swpt_accounts.flusher import PipelinedFlusher, BurstSizeController
+from swpt_accounts.models import RejectedTransferSignal, AccountPurgeSignal
+
+D_ID = -1
+C_ID = 1
+
+
+def test_pipelined_flusher(app, db_session, mocker):
+    burst_count = app.config["APP_FLUSH_REJECTED_TRANSFERS_BURST_COUNT"]
+    max_burst_count = app.config["APP_FLUSH_MAX_BURST_COUNT"]
+    app.config["APP_FLUSH_REJECTED_TRANSFERS_BURST_COUNT"] = 3
+    app.config["APP_FLUSH_MAX_BURST_COUNT"] = 3
+    send_signalbus_messages = Mock()
+    mocker.patch.object(
+        RejectedTransferSignal,
+        "send_signalbus_messages",
+        send_signalbus_messages,
+    )
+    for i in range(10):
+        db.session.add(
+            RejectedTransferSignal(
+                debtor_id=D_ID,
+                sender_creditor_id=C_ID,
+                coordinator_type="direct",
+                coordinator_id=C_ID,
+                coordinator_request_id=i,
+                status_code="FAILURE",
+                total_locked_amount=0,
+            )
+        )
+    db.session.commit()
+
+    flusher = PipelinedFlusher(
+        [RejectedTransferSignal, AccountPurgeSignal], max_wait=0.1, depth=2
+    )
+    assert flusher.run(quit_early=True) == 10
+    assert len(RejectedTransferSignal.query.all()) == 0
+    bursts = [c.args[0] for c in send_signalbus_messages.call_args_list]
+    assert [len(burst) for burst in bursts] == [3, 3, 3, 1]
+    assert sorted(
+        s.coordinator_request_id for burst in bursts for s in burst
+    ) == list(range(10))
+
+    app.config["APP_FLUSH_REJECTED_TRANSFERS_BURST_COUNT"] = burst_count
+    app.config["APP_FLUSH_MAX_BURST_COUNT"] = max_burst_count
+
+
+@pytest.mark.parametrize("priority_lanes", [False, True])
+def test_pipelined_flusher_priority_lanes(
+    app, db_session, mocker, priority_lanes
+):
+    max_burst_count = app.config["APP_FLUSH_MAX_BURST_COUNT"]
+    app.config["APP_FLUSH_MAX_BURST_COUNT"] = 1
+    published = []
+
+    def record_published(model):
+        return Mock(side_effect=lambda signals: published.append(model))
+
+    for model in [RejectedTransferSignal, AccountPurgeSignal]:
+        mocker.patch.object(model, "signalbus_burst_count", 1)
+        mocker.patch.object(
+            model, "send_signalbus_messages", record_published(model)
+        )
+    for i in range(5):
+        db.session.add(
+            RejectedTransferSignal(
+                debtor_id=D_ID,
+                sender_creditor_id=C_ID,
+                coordinator_type="direct",
+                coordinator_id=C_ID,
+                coordinator_request_id=i,
+                status_code="FAILURE",
+                total_locked_amount=0,
+            )
+        )
+        db.session.add(
+            AccountPurgeSignal(
+                debtor_id=D_ID,
+                creditor_id=C_ID + i,
+                creation_date=date(2020, 1, 1),
+            )
+        )
+    db.session.commit()
+
+    flusher = PipelinedFlusher(
+        [AccountPurgeSignal, RejectedTransferSignal],
+        max_wait=0.1,
+        priority_lanes=priority_lanes,
+    )
+    assert flusher.run(quit_early=True) == 10
+    if priority_lanes:
+        assert published == (
+            5 * [RejectedTransferSignal] + 5 * [AccountPurgeSignal]
+        )
+    else:
+        assert published == 5 * [AccountPurgeSignal, RejectedTransferSignal]
+
+    app.config["APP_FLUSH_MAX_BURST_COUNT"] = max_burst_count
+
+
+def test_pipelined_flusher_shrinks_lower_priority_lanes(
+    app, db_session, mocker
+):
+    min_burst_count = app.config["APP_FLUSH_MIN_BURST_COUNT"]
+    max_burst_count = app.config["APP_FLUSH_MAX_BURST_COUNT"]
+    app.config["APP_FLUSH_MIN_BURST_COUNT"] = 1
+    app.config["APP_FLUSH_MAX_BURST_COUNT"] = 2
+    published = []
+
+    def record_published(model):
+        return Mock(
+            side_effect=lambda signals: published.append(
+                (model, len(signals))
+            )
+        )
+
+    for model, priority in [
+        (RejectedTransferSignal, 1),
+        (AccountPurgeSignal, 0),
+    ]:
+        mocker.patch.object(model, "signalbus_burst_count", 2)
+        mocker.patch.object(model, "flush_priority", priority)
+        mocker.patch.object(model, "flush_weight", 2)
+        mocker.patch.object(
+            model, "send_signalbus_messages", record_published(model)
+        )
+    for i in range(6):
+        db.session.add(
+            RejectedTransferSignal(
+                debtor_id=D_ID,
+                sender_creditor_id=C_ID,
+                coordinator_type="direct",
+                coordinator_id=C_ID,
+                coordinator_request_id=i,
+                status_code="FAILURE",
+                total_locked_amount=0,
+            )
+        )
+    for i in range(4):
+        db.session.add(
+            AccountPurgeSignal(
+                debtor_id=D_ID,
+                creditor_id=C_ID + i,
+                creation_date=date(2020, 1, 1),
+            )
+        )
+    db.session.commit()
+
+    flusher = PipelinedFlusher(
+        [AccountPurgeSignal, RejectedTransferSignal],
+        max_wait=0.1,
+        priority_lanes=True,
+    )
+    assert flusher.run(quit_early=True) == 10
+
+    # While the rejected transfers fill their bursts, only the
+    # smallest bursts are fetched from the account purges.
+    assert published == [
+        (RejectedTransferSignal, 2),
+        (RejectedTransferSignal, 2),
+        (AccountPurgeSignal, 1),
+        (RejectedTransferSignal, 2),
+        (AccountPurgeSignal, 2),
+        (AccountPurgeSignal, 1),
+    ]
+
+    app.config["APP_FLUSH_MIN_BURST_COUNT"] = min_burst_count
+    app.config["APP_FLUSH_MAX_BURST_COUNT"] = max_burst_count
+
+
+def test_burst_size_controller():
+    c = BurstSizeController(
+        initial_size=100, min_size=10, max_size=200, target_seconds=2.0
+    )
+    assert c.size == 100
+
+    # Full and fast bursts make the burst size grow.
+    assert c.observe_fetch(0.1) == 100
+    assert c.observe_publish(100, 0.1) == 150
+    assert c.observe_publish(150, 0.1) == 200
+    assert c.observe_publish(200, 0.1) == 200
+
+    # Partial bursts do not change the burst size.
+    assert c.observe_publish(50, 0.1) == 200
+
+    # Slow fetches and publishes make the burst size shrink.
+    assert c.observe_fetch(3.0) == 100
+    assert c.observe_publish(100, 0.1) == 100
+    assert c.observe_publish(100, 5.0) == 50
+    assert c.observe_fetch(0.1) == 50
+    for _ in range(10):
+        c.observe_publish(50, 5.0)
+    assert c.size == 10
+
+    # The memory limit makes the burst size shrink.
+    c = BurstSizeController(
+        initial_size=100,
+        min_size=10,
+        max_size=200,
+        target_seconds=2.0,
+        max_memory_mb=0.001,
+    )
+    assert c.observe_publish(100, 0.1) == 50
+
+    # The bounds always include the initial size.
+    c = BurstSizeController(
+        initial_size=3, min_size=10, max_size=2, target_seconds=2.0
+    )
+    assert (c.size, c.min_size, c.max_size) == (3, 3, 3)
+
+
+def test_pipelined_flusher_error(app, db_session, mocker):
+    mocker.patch.object(
+        RejectedTransferSignal,
+        "send_signalbus_messages",
+        Mock(side_effect=RuntimeError),
+    )
+    db.session.add(
+        RejectedTransferSignal(
+            debtor_id=D_ID,
+            sender_creditor_id=C_ID,
+            coordinator_type="direct",
+            coordinator_id=C_ID,
+            coordinator_request_id=1,
+            status_code="FAILURE",
+            total_locked_amount=0,
+        )
+    )
+    db.session.commit()
+
+    flusher = PipelinedFlusher([RejectedTransferSignal], max_wait=0.1)
+    with pytest.raises(RuntimeError):
+        flusher.run()
+
+    # The signal has not been deleted, and is not locked anymore.
+    assert len(
+        RejectedTransferSignal.query.with_for_update(skip_locked=True).all()
+    ) == 1
+
+
+def test_pipelined_flusher_buckets(app, db_session, mocker):
+    send_signalbus_messages = Mock()
+    mocker.patch.object(
+        RejectedTransferSignal,
+        "send_signalbus_messages",
+        send_signalbus_messages,
+    )
+    for creditor_id in range(1, 21):
+        for i in range(2):
+            db.session.add(
+                RejectedTransferSignal(
+                    debtor_id=D_ID,
+                    sender_creditor_id=creditor_id,
+                    coordinator_type="direct",
+                    coordinator_id=C_ID,
+                    coordinator_request_id=i,
+                    status_code="FAILURE",
+                    total_locked_amount=0,
+                )
+            )
+    db.session.commit()
+
+    flushed = []
+    for bucket_index in range(2):
+        flusher = PipelinedFlusher(
+            [RejectedTransferSignal],
+            max_wait=0.1,
+            bucket_count=2,
+            bucket_index=bucket_index,
+        )
+        flusher.run(quit_early=True)
+        flushed.append(
+            [
+                (s.sender_creditor_id, s.coordinator_request_id)
+                for c in send_signalbus_messages.call_args_list
+                for s in c.args[0]
+            ]
+        )
+        send_signalbus_messages.reset_mock()
+
+    # Each account is flushed by exactly one of the flushers, and the
+    # signals for each account are flushed in order.
+    assert 0 < len(flushed[0]) < 40
+    assert len(flushed[0]) + len(flushed[1]) == 40
+    assert not {c for c, _ in flushed[0]} & {c for c, _ in flushed[1]}
+    for signals in flushed:
+        for creditor_id in {c for c, _ in signals}:
+            assert [i for c, i in signals if c == creditor_id] == [0, 1]
+    assert len(RejectedTransferSignal.query.all()) == 0
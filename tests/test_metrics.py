@@ -0,0 +1,123 @@
+import math
+import requests
+import sqlalchemy
+from datetime import date, datetime, timezone, timedelta
+from unittest.mock import Mock
+from swpt_accounts.extensions import db
+from swpt_accounts.flusher import PipelinedFlusher
+from swpt_accounts.metrics import FlushMetrics, start_metrics_server
+from swpt_accounts.models import RejectedTransferSignal, AccountPurgeSignal
+
+D_ID = -1
+C_ID = 1
+
+
+def test_flush_metrics(app, db_session, mocker):
+    mocker.patch.object(
+        RejectedTransferSignal, "send_signalbus_messages", Mock()
+    )
+    for i in range(5):
+        db.session.add(
+            RejectedTransferSignal(
+                debtor_id=D_ID,
+                sender_creditor_id=C_ID,
+                coordinator_type="direct",
+                coordinator_id=C_ID,
+                coordinator_request_id=i,
+                status_code="FAILURE",
+                total_locked_amount=0,
+            )
+        )
+    db.session.commit()
+
+    models = [RejectedTransferSignal, AccountPurgeSignal]
+    metrics = FlushMetrics(models)
+    flusher = PipelinedFlusher(models, max_wait=0.1, metrics=metrics)
+    assert flusher.run(quit_early=True) == 5
+    metrics.observe_error(AccountPurgeSignal)
+
+    text = metrics.render(db.engine)
+    lines = text.splitlines()
+    assert (
+        'swpt_accounts_flushed_signals_total{signal="RejectedTransferSignal"}'
+        " 5"
+    ) in lines
+    assert (
+        'swpt_accounts_flush_errors_total{signal="AccountPurgeSignal"} 1'
+    ) in lines
+    assert (
+        "swpt_accounts_publish_latency_seconds_count"
+        '{signal="RejectedTransferSignal"} 1'
+    ) in lines
+    assert 'swpt_accounts_pending_signals{signal="AccountPurgeSignal"}' in text
+    assert (
+        'swpt_accounts_burst_size{signal="RejectedTransferSignal"} '
+        f"{flusher.burst_sizes[RejectedTransferSignal].size}"
+    ) in lines
+    assert (
+        'swpt_accounts_oldest_signal_age_seconds{signal="AccountPurgeSignal"}'
+        " 0.000"
+    ) in lines
+
+    server = start_metrics_server(metrics, db.engine, 0)
+    try:
+        port = server.server_address[1]
+        r = requests.get(f"http://localhost:{port}/metrics")
+        assert r.status_code == 200
+        assert r.headers["Content-Type"].startswith("text/plain")
+        assert "swpt_accounts_flushed_signals_total" in r.text
+        r = requests.get(f"http://localhost:{port}/other")
+        assert r.status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_oldest_signal_age(app, db_session, mocker):
+    db.session.add(
+        AccountPurgeSignal(
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            creation_date=date(1970, 1, 1),
+            inserted_at=datetime.now(tz=timezone.utc) - timedelta(hours=1),
+        )
+    )
+    db.session.add(
+        AccountPurgeSignal(
+            debtor_id=D_ID,
+            creditor_id=C_ID + 1,
+            creation_date=date(1970, 1, 1),
+        )
+    )
+    db.session.commit()
+
+    metrics = FlushMetrics([AccountPurgeSignal])
+    assert 3600.0 <= _render_oldest_signal_age(metrics) < 3700.0
+
+    # The signal tables are not queried again until
+    # OLDEST_SIGNAL_REFRESH_SECONDS have passed.
+    AccountPurgeSignal.query.delete()
+    db.session.commit()
+    assert 3600.0 <= _render_oldest_signal_age(metrics) < 3700.0
+
+    metrics._metrics[AccountPurgeSignal].oldest_inserted_at_refreshed_at = (
+        float("-inf")
+    )
+    assert _render_oldest_signal_age(metrics) == 0.0
+
+    # When the age can not be determined, NaN is reported.
+    mocker.patch(
+        "swpt_accounts.metrics._SET_QUERY_TIMEOUT",
+        new=sqlalchemy.text("SELECT 1 / 0"),
+    )
+    metrics._metrics[AccountPurgeSignal].oldest_inserted_at_refreshed_at = (
+        float("-inf")
+    )
+    assert math.isnan(_render_oldest_signal_age(metrics))
+
+
+def _render_oldest_signal_age(metrics):
+    prefix = "swpt_accounts_oldest_signal_age_seconds{"
+    for line in metrics.render(db.engine).splitlines():
+        if line.startswith(prefix):
+            return float(line.split()[-1])
@@ -1,3 +1,4 @@
+import json
 from datetime import datetime, date, timezone, timedelta
 from swpt_accounts.models import Account
 
@@ -84,6 +85,256 @@ def test_send_signalbus_message(app, mocker):
     aus.send_signalbus_message(aus)
 
 
+def _make_signals(current_ts):
+    from swpt_accounts import models as m
+
+    return [
+        m.RejectedTransferSignal(
+            debtor_id=D_ID,
+            sender_creditor_id=C_ID,
+            coordinator_type="direct",
+            coordinator_id=666,
+            coordinator_request_id=777,
+            status_code="TEST_ERROR",
+            total_locked_amount=0,
+            inserted_at=current_ts,
+        ),
+        m.PreparedTransferSignal(
+            debtor_id=D_ID,
+            sender_creditor_id=C_ID,
+            transfer_id=123,
+            coordinator_type="direct",
+            coordinator_id=666,
+            coordinator_request_id=777,
+            locked_amount=1000,
+            recipient_creditor_id=-2,
+            prepared_at=current_ts,
+            demurrage_rate=-50.0,
+            deadline=m.T_INFINITY,
+            final_interest_rate_ts=m.T0,
+            inserted_at=current_ts,
+        ),
+        m.FinalizedTransferSignal(
+            debtor_id=D_ID,
+            sender_creditor_id=C_ID,
+            transfer_id=123,
+            coordinator_type="direct",
+            coordinator_id=666,
+            coordinator_request_id=777,
+            prepared_at=current_ts,
+            finalized_at=current_ts,
+            committed_amount=100,
+            total_locked_amount=0,
+            status_code="OK",
+        ),
+        m.AccountTransferSignal(
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            creation_date=m.T0.date(),
+            transfer_number=5,
+            coordinator_type="direct",
+            committed_at=current_ts,
+            acquired_amount=-100,
+            other_creditor_id=-2,
+            transfer_note_format="text",
+            transfer_note="Съобщение",
+            principal=1000,
+            previous_transfer_number=4,
+            inserted_at=current_ts,
+        ),
+        m.AccountUpdateSignal(
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            last_change_ts=current_ts,
+            last_change_seqnum=1,
+            principal=1000,
+            interest=12.5,
+            interest_rate=3.5,
+            last_interest_rate_change_ts=m.T0,
+            last_transfer_number=1,
+            last_transfer_committed_at=m.T0,
+            last_config_ts=m.T0,
+            last_config_seqnum=1,
+            creation_date=m.T0.date(),
+            negligible_amount=1e30,
+            config_data='{"rate": 2.0}',
+            config_flags=0,
+            debtor_info_iri="https://example.com/info",
+            debtor_info_content_type="text/plain",
+            debtor_info_sha256=32 * b"\xff",
+            inserted_at=current_ts,
+        ),
+        m.AccountPurgeSignal(
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            creation_date=m.T0.date(),
+            inserted_at=current_ts,
+        ),
+        m.RejectedConfigSignal(
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            config_ts=current_ts,
+            config_seqnum=1,
+            config_flags=0,
+            config_data="",
+            negligible_amount=0.0,
+            rejection_code="TEST_ERROR",
+            inserted_at=current_ts,
+        ),
+        m.PendingBalanceChangeSignal(
+            debtor_id=D_ID,
+            other_creditor_id=-2,
+            change_id=1,
+            creditor_id=C_ID,
+            coordinator_type="direct",
+            transfer_note_format="",
+            transfer_note="",
+            committed_at=current_ts,
+            principal_delta=100,
+        ),
+    ]
+
+
+def test_fast_serialization(app):
+    for s in _make_signals(datetime.now(tz=timezone.utc)):
+        cls = type(s)
+        assert cls.fast_serialization
+        fast_message = cls._create_message(s)
+        cls.fast_serialization = False
+        try:
+            message = cls._create_message(s)
+        finally:
+            cls.fast_serialization = True
+
+        schema = cls.__marshmallow_schema__
+        assert cls.get_dump_function()(s) == schema.dump(s)
+        assert fast_message.body == message.body
+        assert fast_message.properties.headers == message.properties.headers
+        assert fast_message.properties.type == message.properties.type
+        assert fast_message.routing_key == message.routing_key
+        assert fast_message.mandatory == message.mandatory
+
+
+def test_coalesce_account_updates(app, mocker):
+    from swpt_accounts import models as m
+
+    publisher = mocker.patch("swpt_accounts.models.publisher")
+    current_ts = datetime.now(tz=timezone.utc)
+    updates = []
+    for signal_id, creditor_id in [(3, C_ID), (1, C_ID), (2, C_ID), (4, 2)]:
+        aus = _make_signals(current_ts)[4]
+        assert isinstance(aus, m.AccountUpdateSignal)
+        aus.signal_id = signal_id
+        aus.creditor_id = creditor_id
+        aus.principal = signal_id
+        updates.append(aus)
+
+    m.AccountUpdateSignal.send_signalbus_messages(updates)
+    publisher.publish_messages.assert_called_once()
+    messages = publisher.publish_messages.call_args[0][0]
+    assert [json.loads(msg.body)["principal"] for msg in messages] == [3, 4]
+
+
+def test_memoization(app):
+    from swpt_accounts import models as m
+    from swpt_pythonlib.utils import ShardingRealm
+
+    orig_sharding_realm = app.config["SHARDING_REALM"]
+    app.config["SHARDING_REALM"] = ShardingRealm("0.#")
+    is_valid = m.is_valid_account(D_ID, 1234)
+    assert m.is_valid_account(D_ID, 1234) == is_valid
+    stats = m.get_memoization_stats()["shard_membership"]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
+
+    # Changing the sharding realm invalidates the memoized results.
+    app.config["SHARDING_REALM"] = ShardingRealm("1.#")
+    assert m.is_valid_account(D_ID, 1234) != is_valid
+    assert m.get_memoization_stats()["shard_membership"]["size"] == 1
+
+    hex_routing_key = m._cached_hex_routing_key(D_ID)
+    assert m._cached_hex_routing_key(D_ID) == hex_routing_key
+    assert m.get_memoization_stats()["hex_routing_keys"]["hits"] >= 1
+
+    app.config["SHARDING_REALM"] = orig_sharding_realm
+
+
+def test_bulk_insert(app, db_session):
+    from swpt_accounts import models as m
+
+    assert m.bulk_insert(m.RejectedTransferSignal, []) == []
+    m.bulk_insert(
+        m.RejectedTransferSignal,
+        [
+            m.RejectedTransferSignal(
+                debtor_id=D_ID,
+                sender_creditor_id=C_ID,
+                coordinator_type="direct",
+                coordinator_id=C_ID,
+                coordinator_request_id=1,
+                status_code="FAILURE",
+                total_locked_amount=0,
+            ),
+            dict(
+                debtor_id=D_ID,
+                sender_creditor_id=C_ID,
+                coordinator_type="direct",
+                coordinator_id=C_ID,
+                coordinator_request_id=2,
+                status_code="TIMEOUT",
+                total_locked_amount=5,
+            ),
+        ],
+    )
+    signals = m.RejectedTransferSignal.query.order_by(
+        m.RejectedTransferSignal.coordinator_request_id
+    ).all()
+    assert [s.coordinator_request_id for s in signals] == [1, 2]
+    assert [s.status_code for s in signals] == ["FAILURE", "TIMEOUT"]
+    assert [s.total_locked_amount for s in signals] == [0, 5]
+    assert all(s.inserted_at is not None for s in signals)
+    assert signals[0].signal_id != signals[1].signal_id
+
+    def register(change_ids):
+        return m.bulk_insert(
+            m.RegisteredBalanceChange,
+            [
+                dict(
+                    debtor_id=D_ID,
+                    other_creditor_id=C_ID,
+                    change_id=change_id,
+                    committed_at=datetime.now(tz=timezone.utc),
+                )
+                for change_id in change_ids
+            ],
+            ignore_conflicts=True,
+            returning=("change_id",),
+        )
+
+    assert sorted(r.change_id for r in register([1, 2])) == [1, 2]
+    assert [r.change_id for r in register([2, 3])] == [3]
+    assert not any(r.is_applied for r in m.RegisteredBalanceChange.query)
+
+
+def test_bulk_insert_python_defaults(app, db_session):
+    from swpt_accounts import models as m
+
+    before_insert = datetime.now(tz=timezone.utc)
+    m.bulk_insert(
+        m.AccountPurgeSignal,
+        [
+            dict(
+                debtor_id=D_ID,
+                creditor_id=C_ID,
+                creation_date=date(1970, 1, 1),
+            ),
+        ],
+    )
+    signal = m.AccountPurgeSignal.query.one()
+    assert signal.inserted_at >= before_insert
+
+
 def test_send_signalbus_message_wrong_shard(app, mocker):
     from swpt_accounts import models as m
     from swpt_pythonlib.utils import ShardingRealm
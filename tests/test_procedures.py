@@ -20,6 +20,7 @@ from swpt_accounts.models import (
     RejectedConfigSignal,
     AccountPurgeSignal,
     FinalizationRequest,
+    TransferRequest,
     RegisteredBalanceChange,
     PendingBalanceChange,
     ROOT_CREDITOR_ID,
@@ -392,6 +393,39 @@ def test_make_debtor_interest_payment(db_session, current_ts, amount):
     cts.principal == amount
 
 
+def test_iter_accounts_with_transfer_requests(db_session, current_ts):
+    assert list(p.iter_accounts_with_transfer_requests(yield_per=10)) == []
+    for creditor_id in [3, 1, 2, 1, 3, 3]:
+        p.prepare_transfer(
+            coordinator_type="test",
+            coordinator_id=1,
+            coordinator_request_id=2,
+            min_locked_amount=1,
+            max_locked_amount=200,
+            debtor_id=D_ID,
+            creditor_id=creditor_id,
+            recipient_creditor_id=1234,
+            ts=current_ts,
+        )
+    p.prepare_transfer(
+        coordinator_type="test",
+        coordinator_id=1,
+        coordinator_request_id=2,
+        min_locked_amount=1,
+        max_locked_amount=200,
+        debtor_id=D_ID - 1,
+        creditor_id=2,
+        recipient_creditor_id=1234,
+        ts=current_ts,
+    )
+    accounts = [
+        tuple(row)
+        for rows in p.iter_accounts_with_transfer_requests(yield_per=2)
+        for row in rows
+    ]
+    assert accounts == [(D_ID - 1, 2), (D_ID, 1), (D_ID, 2), (D_ID, 3)]
+
+
 def test_process_pending_balance_changes(db_session, current_ts):
     p.configure_account(D_ID, C_ID, current_ts, 0)
     _flush_balance_change_signals()
@@ -413,6 +447,43 @@ def test_process_pending_balance_changes(db_session, current_ts):
     assert p.get_account(D_ID, p.ROOT_CREDITOR_ID).principal == -10000
 
 
+def test_process_pending_balance_changes_batch(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.configure_account(D_ID, 2, current_ts, 0)
+    for change_id, creditor_id, amount in [
+        (1, C_ID, 10000),
+        (2, 2, 5000),
+        (3, 2, 3000),
+        (4, p.ROOT_CREDITOR_ID, -18000),
+    ]:
+        p.insert_pending_balance_change(
+            debtor_id=D_ID,
+            other_creditor_id=1234,
+            change_id=change_id,
+            creditor_id=creditor_id,
+            coordinator_type=CT_DIRECT,
+            transfer_note_format="",
+            transfer_note="",
+            committed_at=current_ts,
+            principal_delta=amount,
+        )
+
+    p.process_pending_balance_changes_batch([])
+    p.process_pending_balance_changes_batch(
+        [(D_ID, 2), (D_ID, p.ROOT_CREDITOR_ID), (D_ID, C_ID), (D_ID, 2)]
+    )
+    p.process_pending_balance_changes_batch([(D_ID, C_ID), (D_ID, 2)])
+
+    assert p.get_account(D_ID, C_ID).principal == 10000
+    assert p.get_account(D_ID, 2).principal == 8000
+    assert p.get_account(D_ID, p.ROOT_CREDITOR_ID).principal == -18000
+    assert len(AccountTransferSignal.query.all()) == 3
+    assert PendingBalanceChange.query.all() == []
+    rbcs = RegisteredBalanceChange.query.all()
+    assert len(rbcs) == 4
+    assert all(rbc.is_applied for rbc in rbcs)
+
+
 def test_process_pending_balance_changes_with_interest(db_session, current_ts):
     p.configure_account(D_ID, C_ID, current_ts, 0)
     q = Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID)
@@ -589,6 +660,36 @@ def test_capitalize_negative_interest(db_session, current_ts):
     assert 4408 <= a.principal <= 4412
 
 
+def test_capitalize_interests(db_session, current_ts):
+    for creditor_id in [C_ID, 2, 3]:
+        p.configure_account(D_ID, creditor_id, current_ts, 0)
+    Account.query.filter(Account.creditor_id.in_([C_ID, 3])).update(
+        {
+            Account.interest: 100.0,
+            Account.principal: 5000,
+            Account.interest_rate: 10.00,
+            Account.last_change_ts: current_ts - timedelta(days=365),
+            Account.last_change_seqnum: 666,
+        },
+        synchronize_session=False,
+    )
+    p.capitalize_interests([(D_ID, 3), (D_ID, 2), (D_ID, C_ID), (D_ID, 4)])
+    _flush_balance_change_signals()
+    for creditor_id in [C_ID, 2, 3]:
+        p.process_pending_balance_changes(D_ID, creditor_id)
+
+    for creditor_id in [C_ID, 3]:
+        a = p.get_account(D_ID, creditor_id)
+        assert abs(a.interest) <= 1.0
+        assert 5608 <= a.principal <= 5612
+
+    a = p.get_account(D_ID, 2)
+    assert a.principal == 0
+    assert a.last_interest_capitalization_ts < current_ts
+    assert p.get_account(D_ID, 4) is None
+    p.capitalize_interests([])
+
+
 def test_debtor_account_capitalization(db_session, current_ts):
     p.configure_account(D_ID, p.ROOT_CREDITOR_ID, current_ts, 0)
     q = Account.query.filter_by(debtor_id=D_ID, creditor_id=p.ROOT_CREDITOR_ID)
@@ -624,6 +725,27 @@ def test_delete_account(db_session, current_ts):
     assert len(AccountUpdateSignal.query.all()) == 3
 
 
+def test_delete_accounts(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    for creditor_id in [2, 3]:
+        p.configure_account(
+            D_ID,
+            creditor_id,
+            current_ts,
+            0,
+            config_flags=Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG,
+        )
+
+    p.try_to_delete_accounts([(D_ID, 3), (D_ID, C_ID), (D_ID, 2), (D_ID, 3)])
+    assert p.get_account(D_ID, C_ID) is not None
+    assert p.get_account(D_ID, 2) is None
+    assert p.get_account(D_ID, 3) is None
+    deleted = Account.query.filter(
+        Account.status_flags.op("&")(Account.STATUS_DELETED_FLAG) != 0
+    ).all()
+    assert sorted(a.creditor_id for a in deleted) == [2, 3]
+
+
 def test_delete_account_negative_balance(db_session, current_ts):
     p.configure_account(D_ID, C_ID, current_ts, 0)
     q = Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID)
@@ -1492,6 +1614,99 @@ def test_finalize_transfer_twice(db_session):
     assert len(FinalizationRequest.query.all()) == 1
 
 
+def test_get_reachable_accounts(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.configure_account(D_ID, 2, current_ts, 0)
+    p.configure_account(
+        D_ID,
+        3,
+        current_ts,
+        0,
+        config_flags=Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG,
+    )
+    assert p.get_reachable_accounts([]) == []
+    assert sorted(
+        p.get_reachable_accounts(
+            [(D_ID, C_ID), (D_ID, C_ID), (D_ID, 2), (D_ID, 3), (D_ID, 4),
+             (D_ID, ROOT_CREDITOR_ID)]
+        )
+    ) == [(D_ID, ROOT_CREDITOR_ID), (D_ID, C_ID), (D_ID, 2)]
+
+
+def test_insert_request_batch(db_session, current_ts):
+    transfer_request = dict(
+        coordinator_type="test",
+        coordinator_id=1,
+        coordinator_request_id=2,
+        min_locked_amount=1,
+        max_locked_amount=200,
+        debtor_id=D_ID,
+        creditor_id=C_ID,
+        recipient_creditor_id=1234,
+        ts=current_ts,
+        max_commit_delay=1000,
+    )
+    finalization_request = dict(
+        debtor_id=D_ID,
+        creditor_id=C_ID,
+        transfer_id=1,
+        coordinator_type="test",
+        coordinator_id=1,
+        coordinator_request_id=2,
+        committed_amount=0,
+    )
+    pending_balance_change = dict(
+        debtor_id=D_ID,
+        other_creditor_id=1234,
+        change_id=1,
+        creditor_id=C_ID,
+        coordinator_type=CT_DIRECT,
+        transfer_note_format="",
+        transfer_note="",
+        committed_at=current_ts,
+        principal_delta=1000,
+    )
+    p.finalize_transfer(D_ID, C_ID, 1, "test", 1, 2, 0)
+    p.insert_request_batch(
+        transfer_requests=[
+            transfer_request,
+            {**transfer_request, "recipient_creditor_id": None},
+        ],
+        finalization_requests=[
+            finalization_request,
+            {**finalization_request, "transfer_id": 2},
+        ],
+        pending_balance_changes=[
+            pending_balance_change,
+            pending_balance_change,
+            {**pending_balance_change, "change_id": 2},
+            {
+                **pending_balance_change,
+                "change_id": 3,
+                "cutoff_ts": current_ts + timedelta(days=1),
+            },
+        ],
+    )
+    p.insert_request_batch(
+        pending_balance_changes=[pending_balance_change],
+    )
+
+    trs = TransferRequest.query.all()
+    assert len(trs) == 1
+    assert trs[0].recipient_creditor_id == 1234
+    assert trs[0].deadline == current_ts + timedelta(seconds=1000)
+    rts = RejectedTransferSignal.query.one()
+    assert rts.sender_creditor_id == C_ID
+    assert rts.total_locked_amount == 0
+    assert len(FinalizationRequest.query.all()) == 2
+    assert len(RegisteredBalanceChange.query.all()) == 2
+    pbcs = PendingBalanceChange.query.all()
+    assert sorted(pbc.change_id for pbc in pbcs) == [1, 2]
+
+    p.process_pending_balance_changes(D_ID, C_ID)
+    assert p.get_account(D_ID, C_ID).principal == 2000
+
+
 def test_account_purge_signal(db_session, current_ts):
     db_session.add(
         AccountPurgeSignal(
@@ -88,3 +88,36 @@ def test_get_config(client, account, current_ts):
     r = client.get("/accounts/18446744073709551615/0/config")
     assert r.status_code == 200
     assert r.get_data() == b""
+
+
+def test_post_reachable_bulk(client, account, current_ts):
+    r = client.get("/accounts/reachable")
+    assert r.status_code == 405
+    r = client.post("/accounts/reachable", json={})
+    assert r.status_code == 400
+    r = client.post("/accounts/reachable", json={"accounts": [[-1, 1]]})
+    assert r.status_code == 400
+    r = client.post("/accounts/reachable", json={"accounts": [[1, 1, 1]]})
+    assert r.status_code == 400
+    r = client.post(
+        "/accounts/reachable", json={"accounts": 1001 * [[1, 1]]}
+    )
+    assert r.status_code == 400
+
+    r = client.post(
+        "/accounts/reachable",
+        json={
+            "accounts": [
+                [18446744073709551615, 1],
+                [18446744073709551615, 2],
+                [18446744073709551614, 0],
+            ]
+        },
+    )
+    assert r.status_code == 200
+    data = r.get_json()
+    assert sorted(data["reachable"]) == [
+        [18446744073709551614, 0],
+        [18446744073709551615, 1],
+    ]
+    assert data["unknown"] == []
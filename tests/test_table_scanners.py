@@ -0,0 +1,137 @@
+import random
+from datetime import datetime, timezone, timedelta
+from swpt_accounts.models import (
+    Account,
+    MIN_INT64,
+    MAX_INT64,
+    T_INFINITY,
+    ROOT_CREDITOR_ID,
+)
+from swpt_accounts.table_scanners import (
+    AccountScanner,
+    AccountsBlock,
+    exceeds_max_interest_ratio,
+    calc_max_interest_ratio_ts,
+)
+
+
+def _make_account_rows(count, current_ts, seed=0):
+    rnd = random.Random(seed)
+    c = Account.__table__.c
+    rows = []
+    for _ in range(count):
+        principal = rnd.choice(
+            [
+                0,
+                1,
+                100,
+                10**12,
+                -10**9,
+                rnd.randint(-1000, 1000),
+                rnd.randint(MIN_INT64 + 1, MAX_INT64),
+            ]
+        )
+        interest = rnd.choice(
+            [
+                0.0,
+                0.5,
+                rnd.uniform(-1e4, 1e4),
+                rnd.uniform(-1e15, 1e15),
+                float(-principal),
+            ]
+        )
+        rows.append(
+            {
+                c.debtor_id: -1,
+                c.creditor_id: rnd.choice([0, 1, 2]),
+                c.status_flags: rnd.choice([0, Account.STATUS_DELETED_FLAG]),
+                c.principal: principal,
+                c.interest: interest,
+                c.interest_rate: rnd.choice([0.0, -50.0, 100.0, 2.5]),
+                c.last_change_ts: current_ts - timedelta(
+                    seconds=rnd.choice([0, 3600, 86400 * 365, 3e8])
+                ),
+            }
+        )
+    return rows
+
+
+def test_accounts_block():
+    current_ts = datetime.now(tz=timezone.utc)
+    rows = _make_account_rows(5000, current_ts)
+    c = Account.__table__.c
+    block = AccountsBlock(rows, AccountScanner.columns[:3] + [
+        c.principal,
+        c.interest,
+        c.interest_rate,
+        c.last_change_ts,
+    ])
+    assert block.size == 5000
+    assert block.principal == [row[c.principal] for row in rows]
+    assert block.is_deleted == [
+        bool(row[c.status_flags] & Account.STATUS_DELETED_FLAG)
+        for row in rows
+    ]
+
+    indexes = list(range(0, 5000, 2))
+    for max_ratio in [0.0001, 0.01, 0.1]:
+        assert block.exceed_max_interest_ratio(
+            indexes, current_ts, max_ratio
+        ) == [
+            exceeds_max_interest_ratio(
+                creditor_id=rows[i][c.creditor_id],
+                principal=rows[i][c.principal],
+                interest=rows[i][c.interest],
+                interest_rate=rows[i][c.interest_rate],
+                last_change_ts=rows[i][c.last_change_ts],
+                current_ts=current_ts,
+                max_ratio=max_ratio,
+            )
+            for i in indexes
+        ]
+
+    empty_block = AccountsBlock([], AccountScanner.columns)
+    assert empty_block.size == 0
+    assert empty_block.principal == []
+    assert empty_block.is_deleted == []
+
+
+def test_calc_max_interest_ratio_ts():
+    t0 = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    params = dict(
+        creditor_id=1,
+        principal=1000,
+        interest=0.0,
+        interest_rate=10.0,
+        last_change_ts=t0,
+    )
+
+    def exceeds(ts, **kwargs):
+        return exceeds_max_interest_ratio(
+            **dict(params, **kwargs), current_ts=ts, max_ratio=0.01
+        )
+
+    ts = calc_max_interest_ratio_ts(**params, max_ratio=0.01)
+    assert t0 < ts < T_INFINITY
+    assert not exceeds(ts - timedelta(days=1))
+    assert exceeds(ts + timedelta(days=10))
+
+    ts = calc_max_interest_ratio_ts(
+        **dict(params, interest_rate=-10.0), max_ratio=0.01
+    )
+    assert t0 < ts < T_INFINITY
+    assert not exceeds(ts - timedelta(days=1), interest_rate=-10.0)
+    assert exceeds(ts + timedelta(days=10), interest_rate=-10.0)
+
+    assert calc_max_interest_ratio_ts(
+        **dict(params, interest=50.0), max_ratio=0.01
+    ) == t0
+    assert calc_max_interest_ratio_ts(
+        **dict(params, interest_rate=0.0), max_ratio=0.01
+    ) == T_INFINITY
+    assert calc_max_interest_ratio_ts(
+        **dict(params, principal=-1000), max_ratio=0.01
+    ) == T_INFINITY
+    assert calc_max_interest_ratio_ts(
+        **dict(params, creditor_id=ROOT_CREDITOR_ID), max_ratio=0.01
+    ) == T_INFINITY